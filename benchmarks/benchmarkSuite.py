@@ -0,0 +1,215 @@
+# Times the expression cleaning functions, showEquation and the report builder on synthetic workloads
+# of increasing size, saves the results, and compares them with a stored baseline so that performance
+# regressions show up.
+#
+#   python benchmarks/benchmarkSuite.py [--quick] [--runs 5] [--output results.json]
+#                                       [--baseline baseline.json] [--save-baseline] [--tolerance 1.5]
+#
+# With --baseline, every benchmark that is more than tolerance times slower than its baseline is listed
+# and the script exits with an error.  --save-baseline writes the results to the baseline file instead.
+#
+# The report builder is timed with the stub jupyter and pandoc executables of the tests (put first on the PATH) so
+# that what is measured is the pipeline itself and not the kernel or LaTeX.  The stubs are POSIX
+# scripts, so the report benchmarks are skipped on Windows.
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+repositoryDirectory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repositoryDirectory)
+sys.path.insert(0, os.path.join(repositoryDirectory, "tests"))
+import sympy as sy
+import sympyPaperPrinter as spp
+import startupBenchmark
+from stubExecutables import writeStubExecutables
+
+t = sy.Symbol('t')
+x = sy.Symbol('x')
+y = sy.Symbol('y')
+
+fullSizes = {"functions" : [5, 10, 20, 40], "derivatives" : [2, 4, 8, 16], "matrix" : [3, 6, 9, 12], "cells" : [5, 20, 50]}
+quickSizes = {"functions" : [5, 10], "derivatives" : [2, 4], "matrix" : [3, 6], "cells" : [5]}
+
+def makeFunctionsExpression(count : int) -> sy.Expr :
+    """
+    A sum of products of count undefined functions of several arguments (and their time derivatives).
+    """
+    functions = [sy.Function("f_{" + str(i) + "}")(t, x, y) for i in range(count)]
+    expression = 0
+    for i in range(count) :
+        expression += functions[i] * sy.cos(functions[(i + 1) % count]) + functions[i].diff(t) * x**i
+    return expression
+
+def makeNestedDerivativeExpression(count : int) -> sy.Expr :
+    """
+    count functions of time with derivatives of increasing order, some nested in unevaluated derivatives of products.
+    """
+    functions = [sy.Function("q_{" + str(i) + "}")(t) for i in range(count + 1)]
+    expression = 0
+    for i in range(count) :
+        order = i % 4 + 1
+        expression += functions[i].diff(t, order) * functions[i + 1].diff(t)
+        expression += sy.Derivative(functions[i].diff(t) * functions[i + 1], t)
+    return expression
+
+def makeMatrix(size : int) -> sy.Matrix :
+    """
+    A dense size by size matrix of expressions in functions of time and their derivatives.
+    """
+    theta = sy.Function(r'\theta')(t, x)
+    return sy.Matrix(size, size, lambda i, j : sy.Function("m_{" + str(i) + str(j) + "}")(t, x).diff(t) * sy.cos(theta) + sy.Function("m_{" + str(j) + str(i) + "}")(t, x) * theta.diff(t, 2))
+
+def makeScript(cells : int) -> str :
+    """
+    The text of a report script like the demo, with the given number of #%% cells.
+    """
+    lines = ["#%%",
+             "import sys",
+             "sys.path.insert(0, " + repr(repositoryDirectory) + ")",
+             "import sympy as sy",
+             "import sympyPaperPrinter as spp",
+             "t = sy.Symbol('t')",
+             "x = sy.Function('x')(t)",
+             "spp.printMarkdown(r'# Benchmark report {-}')"]
+    for i in range(cells - 1) :
+        lines.extend(["#%%",
+                      "spp.printMarkdown(r'Cell " + str(i) + " shows the equation of motion of $x_{" + str(i) + "}$ @Source.')",
+                      "k" + str(i) + " = sy.Symbol('k_{" + str(i) + "}', positive=True)",
+                      "spp.showEquation(x.diff(t, 2), -k" + str(i) + " * x - x.diff(t) * sy.sin(x)**" + str(i + 1) + ")"])
+    return "\n".join(lines) + "\n"
+
+def timeFunction(function, runs : int, setup = None) -> float :
+    """
+    The median wall time (in seconds) of calling the function, calling setup (untimed) before each call.
+    """
+    times = []
+    for i in range(runs) :
+        if setup != None :
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def benchmarkCleaning(sizes : dict, runs : int) -> dict :
+    results = {}
+    previousSilent = spp.silent
+    spp.silent = True
+    try :
+        workloads = [("functions", n, makeFunctionsExpression(n)) for n in sizes["functions"]]
+        workloads += [("derivatives", n, makeNestedDerivativeExpression(n)) for n in sizes["derivatives"]]
+        workloads += [("matrix", n, makeMatrix(n)) for n in sizes["matrix"]]
+        for (kind, size, expression) in workloads :
+            label = " " + kind + "=" + str(size)
+            results["cleanOutUnwantedArguments" + label] = timeFunction(lambda : spp.cleanOutUnwantedArguments(expression), runs)
+            results["convertTimeDerivativeToDotSymbol" + label] = timeFunction(lambda : spp.convertTimeDerivativeToDotSymbol(expression), runs)
+            # the cleaning cache is cleared first so that it is the cleaning that is timed and not a lookup
+            results["showEquation" + label] = timeFunction(lambda : spp.showEquation("y", expression), runs, spp.cleaningCache.clear)
+    finally :
+        spp.silent = previousSilent
+    return results
+
+def clearCaches() -> None :
+    # so that it is the cleaning and printing that is timed and not a lookup
+    spp.cleaningCache.clear()
+    spp.latexCache.clear(removeFiles=True)
+
+def benchmarkReports(sizes : dict, runs : int) -> dict :
+    results = {}
+    if os.name == "nt" :
+        return results
+    from sympyPaperPrinterReports import ReportGeneratorFromPythonFileWithCells
+    directory = tempfile.mkdtemp(prefix="sppBenchmark")
+    previousPath = os.environ.get("PATH", "")
+    os.environ["PATH"] = writeStubExecutables(directory) + os.pathsep + previousPath
+    # the builds cache their LaTeX in the temporary folder, not in the real cache of the user
+    previousCaches = (spp.latexCache, spp.lambdifyCache)
+    spp.latexCache = spp.LatexCache(os.path.join(directory, "cache", "latex"))
+    spp.lambdifyCache = spp.LambdifyCache(os.path.join(directory, "cache", "lambdify"))
+    try :
+        reportDirectory = os.path.join(directory, "report")
+        os.makedirs(reportDirectory)
+        with open(os.path.join(reportDirectory, "sources.bib"), "w", encoding="utf-8") as f :
+            f.write("@book{Source, title={Benchmarks}, author={Spp}, year={2024}}\n")
+        with open(os.path.join(reportDirectory, "style.csl"), "w", encoding="utf-8") as f :
+            f.write("<style/>\n")
+        for cells in sizes["cells"] :
+            scriptPath = os.path.join(reportDirectory, "report" + str(cells) + ".py")
+            with open(scriptPath, "w", encoding="utf-8") as f :
+                f.write(makeScript(cells))
+            results["report notebook cells=" + str(cells)] = timeFunction(lambda : ReportGeneratorFromPythonFileWithCells.WriteIpynbToDesiredFormatWithPandoc(scriptPath), runs)
+            results["report capture cells=" + str(cells)] = timeFunction(lambda : ReportGeneratorFromPythonFileWithCells.WriteDirectlyToDesiredFormatWithPandoc(scriptPath), runs, clearCaches)
+    finally :
+        os.environ["PATH"] = previousPath
+        (spp.latexCache, spp.lambdifyCache) = previousCaches
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+def runBenchmarks(quick : bool = False, runs : int = 5) -> dict :
+    """
+    Runs all of the benchmarks and returns the results (median seconds by benchmark name) along with
+    what they were run on.
+    """
+    sizes = quickSizes if quick else fullSizes
+    results = {"import sympyPaperPrinter" : startupBenchmark.measureImportMilliseconds(runs) / 1000.0}
+    results.update(benchmarkCleaning(sizes, runs))
+    results.update(benchmarkReports(sizes, runs))
+    return {"python" : platform.python_version(),
+            "sympy" : sy.__version__,
+            "machine" : platform.platform(),
+            "quick" : quick,
+            "runs" : runs,
+            "results" : results}
+
+def compareToBaseline(results : dict, baseline : dict, tolerance : float = 1.5) -> list :
+    """
+    Prints how long each benchmark took compared with the baseline, and returns the names of the
+    benchmarks that are more than tolerance times slower than their baseline.
+    """
+    regressions = []
+    for (name, seconds) in results["results"].items() :
+        baselineSeconds = baseline["results"].get(name)
+        if baselineSeconds == None :
+            print("{:<60} {:>10.4f} s   (not in the baseline)".format(name, seconds))
+            continue
+        ratio = seconds / baselineSeconds if baselineSeconds > 0 else float("inf")
+        flag = ""
+        if ratio > tolerance :
+            regressions.append(name)
+            flag = "  SLOWER"
+        print("{:<60} {:>10.4f} s  {:>6.2f}x{}".format(name, seconds, ratio, flag))
+    return regressions
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Benchmark the expression cleaning and report generation of sympyPaperPrinter")
+    parser.add_argument("--quick", action="store_true", help="only the smaller workload sizes")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default=None, help="json file to save the results to")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.realpath(__file__)), "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    arguments = parser.parse_args()
+
+    results = runBenchmarks(arguments.quick, arguments.runs)
+    if arguments.output != None :
+        with open(arguments.output, "w", encoding="utf-8") as f :
+            json.dump(results, f, indent=1)
+    if arguments.save_baseline :
+        with open(arguments.baseline, "w", encoding="utf-8") as f :
+            json.dump(results, f, indent=1)
+        print("saved the baseline to " + arguments.baseline)
+    elif os.path.isfile(arguments.baseline) :
+        with open(arguments.baseline, "r", encoding="utf-8") as f :
+            regressions = compareToBaseline(results, json.load(f), arguments.tolerance)
+        if len(regressions) > 0 :
+            print("{} benchmarks are more than {}x slower than the baseline".format(len(regressions), arguments.tolerance))
+            sys.exit(1)
+    else :
+        for (name, seconds) in results["results"].items() :
+            print("{:<60} {:>10.4f} s".format(name, seconds))
@@ -0,0 +1,44 @@
+# Times how long it takes to start python and import sympyPaperPrinter (compared to just starting python), 
+# since the module gets imported by small scripts and by every worker process of a parallel build.
+#
+#   python benchmarks/startupBenchmark.py [--runs 10] [--max-milliseconds 150]
+#
+# With --max-milliseconds, the script exits with an error if the import takes longer than that.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+repositoryDirectory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def timeCommand(code : str, runs : int) -> float :
+    """
+    The median wall time (in seconds) of running the code in a new python process.
+    """
+    times = []
+    for i in range(runs) :
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, cwd=repositoryDirectory)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def measureImportMilliseconds(runs : int = 10) -> float :
+    """
+    The median time (in milliseconds) that importing sympyPaperPrinter adds to starting python.
+    """
+    emptyTime = timeCommand("pass", runs)
+    importTime = timeCommand("import sys; sys.path.insert(0, " + repr(repositoryDirectory) + "); import sympyPaperPrinter", runs)
+    return (importTime - emptyTime) * 1000.0
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Time importing sympyPaperPrinter")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-milliseconds", type=float, default=None)
+    arguments = parser.parse_args()
+    milliseconds = measureImportMilliseconds(arguments.runs)
+    print("import sympyPaperPrinter: {:.1f} ms".format(milliseconds))
+    if arguments.max_milliseconds != None and milliseconds > arguments.max_milliseconds :
+        print("slower than the allowed {:.1f} ms".format(arguments.max_milliseconds))
+        sys.exit(1)
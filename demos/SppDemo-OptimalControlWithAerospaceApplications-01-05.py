@@ -81,9 +81,10 @@ t = np.arange(1, 40.0, 0.01)
     # evaluate some numbers.  If you are doing it once or twice, you can just substitute in values
     # and evaluate it.  But if you need to evaluate the expression many many times, that will be 
     # too slow.  But lambdify will convert the expression to a callback using python's default 
-    # math library, numpy, scipy, or others.  That will be MUCH faster.  
-dvHoh = sy.lambdify(alpha, dvTotSimplified)(t)
-dvPar = sy.lambdify(alpha, dvParSubs)(t)
+    # math library, numpy, scipy, or others.  That will be MUCH faster.  spp.lambdifyCached does the 
+    # same thing, but keeps the generated code around so the next build of the report doesn't regenerate it.
+dvHoh = spp.lambdifyCached(alpha, dvTotSimplified)(t)
+dvPar = spp.lambdifyCached(alpha, dvParSubs)(t)
 
 fig, ax = plt.subplots()
 ax.plot(t, dvHoh, label="Hohmann")
@@ -104,9 +105,10 @@ eqForAlpha = sy.Eq(dvTotSimplified, dvParSubs)
 spp.showEquation(eqForAlpha)
 spp.showEquation(0, eqForAlpha.lhs - eqForAlpha.rhs)
 
-    # again, using lambdify (making it a more stand-alone example instead of refactoring to use the similar expressions in part C)
-alphaEqLhs = sy.lambdify(alpha, dvTotSimplified)
-alphaEqRhs = sy.lambdify(alpha, dvParSubs)
+    # again, using lambdify (making it a more stand-alone example instead of refactoring to use the similar expressions in part C, 
+    # although since these are the same expressions, the cache hands back the callbacks made there)
+alphaEqLhs = spp.lambdifyCached(alpha, dvTotSimplified)
+alphaEqRhs = spp.lambdifyCached(alpha, dvParSubs)
 def EqToSolve(alp) :
     return alphaEqLhs(alp) - alphaEqRhs(alp)
 
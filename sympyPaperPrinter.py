@@ -1,18 +1,274 @@
 # This is a set of helper function to display pretty printed equations and markdown in a Jupyter (or Jupyter-like window like in VS Code).
 # This is just for outputting purposes and I don't plan on adding tests or thorough documentation to this (for now).
-from IPython.display import  display, Markdown
-import sympy as sy
-from sympy.core.function import AppliedUndef
+# To keep importing this module fast, sympy and IPython are only imported when they are first used 
+# and the report generation classes (in sympyPaperPrinterReports) are loaded the first time they are accessed.
+from __future__ import annotations
 import sys
+import time
+import functools
+import importlib
+from os import makedirs, cpu_count
+from os.path import join, basename, realpath
 from typing import List
+from collections import OrderedDict
+
+class _LazyModule :
+    """
+    Stands in for a module that is only imported the first time one of its attributes is used.
+    """
+    def __init__(self, name : str) :
+        self._name = name
+
+    def __getattr__(self, attribute : str) :
+        value = getattr(importlib.import_module(self._name), attribute)
+        setattr(self, attribute, value) # so the next look up doesn't come through here
+        return value
+
+sy = _LazyModule("sympy")
+
 defaultCleanEquations = True
 silent = False
 syFunctions = ['cos', 'sin', 'tan', 'exp', 'log', 're', 'im', 'Abs'] # this list might need to grow
 tStr = "t"
-t0Str = sy.Symbol("t_0", real=True)
-tfStr = sy.Symbol("t_f", real=True)
 
-t = sy.symbols(tStr)
+_lazySymbols = {"t0Str" : lambda : sy.Symbol("t_0", real=True),
+                "tfStr" : lambda : sy.Symbol("t_f", real=True),
+                "t" : lambda : sy.symbols(tStr)}
+_reportNames = ["ReportGeneratorFromPythonFileWithCells", "ReportBuildResult", "AsyncReportGenerator", "ReportWatcher", "WarmKernelPool", "NotebookCellCache", "CleanDirectoryScope", "ScopeIfFileDoesNotExist"]
+
+def __getattr__(name : str) :
+    # module level attributes that are made the first time they are used
+    if name in _lazySymbols :
+        value = _lazySymbols[name]()
+    elif name in _reportNames :
+        value = getattr(importlib.import_module("sympyPaperPrinterReports"), name)
+    elif name == "Markdown" :
+        from IPython.display import Markdown as value
+    else :
+        raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+    globals()[name] = value
+    return value
+
+performanceRecorder = None # the PerformanceRecorder that is timing things, if one is active
+
+class PerformanceRecorder :
+    """
+    A scope that records how long each stage of building a report takes (and optionally its peak memory), 
+    how long each executed notebook cell took (and optionally its peak memory), and how long the calls to 
+    the cleaning functions (in this process) took.  Use writeJson to save what was recorded and summary for 
+    a readable version.
+
+    Memory is traced with tracemalloc (which slows everything down) only if traceMemory is True, in this 
+    process and in the kernels that execute the notebooks.  tracemalloc has a single peak for the whole 
+    process, so only the stages of the main thread record their peak (stages recorded from other threads, 
+    like concurrent pandoc runs, nest under what the main thread has open but have no peak).  Stages that run a 
+    command also record the peak resident memory of the command when it is the largest child process so far 
+    (where the resource module is available).  If profileStage is the name of a stage, that 
+    stage is run under cProfile and its stats are saved to profileFile (<stage name>.prof by default).
+    """
+    def __init__(self, traceMemory : bool = False, profileStage : str = None, profileFile : str = None) :
+        self.traceMemory = traceMemory
+        self.profileStage = profileStage
+        self.profileFile = profileFile
+        self.stages = []
+        self.cells = []
+        self.calls = {}
+        import threading
+        self._mainThreadStages = []
+        self._threadStages = threading.local()
+
+    @property
+    def _openStages(self) -> list :
+        # the stages that are open on this thread (so stages recorded from worker threads, like concurrent pandoc runs, don't nest in each other)
+        if _isMainThread() :
+            return self._mainThreadStages
+        if not hasattr(self._threadStages, "stages") :
+            self._threadStages.stages = []
+        return self._threadStages.stages
+
+    def __enter__(self) :
+        global performanceRecorder
+        self._previousRecorder = performanceRecorder
+        performanceRecorder = self
+        self._startedTracing = False
+        if self.traceMemory :
+            import tracemalloc
+            if not tracemalloc.is_tracing() : # otherwise the caller is tracing memory too, and keeps doing so afterwards
+                tracemalloc.start()
+                self._startedTracing = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        global performanceRecorder
+        if self._startedTracing :
+            import tracemalloc
+            tracemalloc.stop()
+        performanceRecorder = self._previousRecorder
+
+    def stage(self, name : str, **details) -> "_RecordedStage" :
+        """
+        A scope that records the wall time (and memory) of a stage.  The details are saved with it.
+        """
+        return _RecordedStage(self, name, details)
+
+    def recordCall(self, functionName : str, seconds : float) -> None :
+        if functionName not in self.calls :
+            self.calls[functionName] = {"count" : 0, "totalSeconds" : 0.0, "maxSeconds" : 0.0}
+        call = self.calls[functionName]
+        call["count"] += 1
+        call["totalSeconds"] += seconds
+        call["maxSeconds"] = max(call["maxSeconds"], seconds)
+
+    def recordCells(self, stageName : str, cells, cellPeaks : dict = None) -> None :
+        """
+        Records the time each code cell of an executed notebook took (from the timing that 
+        nbclient and nbconvert put in the metadata of the cells), and its peak memory if cellPeaks 
+        (which maps the execution count of a cell to its peak) has it.  Cells are numbered by their 
+        place among the code cells of the notebook, or by the sppCellIndex in their metadata (which 
+        incremental builds set, since they only execute the cells from the first one that changed).
+        """
+        from datetime import datetime
+        index = 0
+        for cell in cells :
+            if cell["cell_type"] != "code" or cell.get("metadata", {}).get("sppInternal", False) :
+                continue
+            execution = cell.get("metadata", {}).get("execution", {})
+            if "iopub.execute_input" in execution and "shell.execute_reply" in execution :
+                start = datetime.fromisoformat(execution["iopub.execute_input"].replace("Z", "+00:00"))
+                end = datetime.fromisoformat(execution["shell.execute_reply"].replace("Z", "+00:00"))
+                source = cell["source"] if isinstance(cell["source"], str) else "".join(cell["source"])
+                record = {"stage" : stageName, "index" : cell.get("metadata", {}).get("sppCellIndex", index), "seconds" : (end - start).total_seconds(), "firstLine" : source.split("\n")[0]}
+                if cellPeaks != None and cell.get("execution_count") in cellPeaks :
+                    record["peakMemoryBytes"] = cellPeaks[cell["execution_count"]]
+                self.cells.append(record)
+            index += 1
+
+    def toDictionary(self) -> dict :
+        return {"stages" : self.stages, "cells" : self.cells, "calls" : self.calls}
+
+    def writeJson(self, fileName : str) -> None :
+        import json
+        with open(fileName, "w", encoding="utf-8") as f :
+            json.dump(self.toDictionary(), f, indent=1)
+
+    def summary(self) -> str :
+        """
+        A plain text table of the stages, the slowest cells, and the timed functions.
+        """
+        lines = ["Stages:"]
+        for stage in self.stages :
+            line = "  " + "  " * stage["depth"] + stage["name"] + ": {:.3f} s".format(stage["seconds"])
+            if stage.get("peakMemoryBytes") != None :
+                line += ", peak {:.1f} MB".format(stage["peakMemoryBytes"] / 1e6)
+            if stage.get("childMaxRssKilobytes") != None :
+                line += ", command peak {:.1f} MB".format(stage["childMaxRssKilobytes"] / 1e3)
+            lines.append(line)
+        if len(self.cells) > 0 :
+            lines.append("Slowest cells:")
+            for cell in sorted(self.cells, key=lambda cell : cell["seconds"], reverse=True)[:10] :
+                peak = ", peak {:.1f} MB".format(cell["peakMemoryBytes"] / 1e6) if cell.get("peakMemoryBytes") != None else ""
+                lines.append("  {} cell {}: {:.3f} s{}  ({})".format(cell["stage"], cell["index"], cell["seconds"], peak, cell["firstLine"]))
+        if len(self.calls) > 0 :
+            lines.append("Calls:")
+            for (functionName, call) in sorted(self.calls.items(), key=lambda item : item[1]["totalSeconds"], reverse=True) :
+                lines.append("  {}: {} calls, {:.3f} s total, {:.3f} s max".format(functionName, call["count"], call["totalSeconds"], call["maxSeconds"]))
+        return "\n".join(lines)
+
+def _isMainThread() -> bool :
+    import threading
+    return threading.current_thread() is threading.main_thread()
+
+class _RecordedStage :
+    # a stage being timed by a PerformanceRecorder (see PerformanceRecorder.stage)
+    def __init__(self, recorder : PerformanceRecorder, name : str, details : dict) :
+        self.recorder = recorder
+        depth = len(recorder._openStages)
+        if not _isMainThread() : # started by a stage of the main thread
+            depth += len(recorder._mainThreadStages)
+        self.record = dict(details, name=name, depth=depth)
+        self._childPeak = 0
+        self._traceMemory = recorder.traceMemory and _isMainThread()
+
+    def __enter__(self) :
+        self.recorder.stages.append(self.record)
+        if self._traceMemory :
+            import tracemalloc
+            if len(self.recorder._openStages) > 0 : # the peak is about to be reset, so hand what it was to the parent
+                parent = self.recorder._openStages[-1]
+                parent._childPeak = max(parent._childPeak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.recorder._openStages.append(self)
+        self._profiler = None
+        if self.record["name"] == self.recorder.profileStage :
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        self.record["seconds"] = time.perf_counter() - self._start
+        if self._profiler != None :
+            self._profiler.disable()
+            profileFile = self.recorder.profileFile
+            if profileFile == None :
+                profileFile = self.record["name"] + ".prof"
+            self._profiler.dump_stats(profileFile)
+        if exc_type != None :
+            self.record["error"] = repr(exc_value)
+        self.recorder._openStages.pop()
+        if self._traceMemory :
+            import tracemalloc
+            self.record["peakMemoryBytes"] = max(self._childPeak, tracemalloc.get_traced_memory()[1])
+            if len(self.recorder._openStages) > 0 :
+                parent = self.recorder._openStages[-1]
+                parent._childPeak = max(parent._childPeak, self.record["peakMemoryBytes"])
+
+class _NoStage :
+    # stands in for a _RecordedStage when nothing is being recorded
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        pass
+
+    @property
+    def record(self) -> dict :
+        return {}
+
+_noStage = _NoStage()
+
+def recordStage(name : str, **details) :
+    """
+    A scope that records a stage with the active PerformanceRecorder (and does nothing if there isn't one).
+    """
+    if performanceRecorder == None :
+        return _noStage
+    return performanceRecorder.stage(name, **details)
+
+def _timedCall(function) :
+    # records the time of each call of the function with the active PerformanceRecorder
+    @functools.wraps(function)
+    def timedFunction(*args, **kwargs) :
+        if performanceRecorder == None :
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try :
+            return function(*args, **kwargs)
+        finally :
+            performanceRecorder.recordCall(function.__name__, time.perf_counter() - start)
+    return timedFunction
+
+def display(*objs) -> None :
+    """
+    Displays the objects with IPython when in an interactive mode, otherwise prints them 
+    (which is what IPython does outside of a Jupyter-like window anyway).
+    """
+    if isInInteractiveMode() :
+        from IPython.display import display as ipythonDisplay
+        ipythonDisplay(*objs)
+    else :
+        print(*objs)
 
 def isRunningJupyter():
     """
@@ -33,15 +289,41 @@ def isInInteractiveMode() :
 def printMarkdown(markdown : str) -> None :
     """
     Prints the passed in string as a Markdown string when run in an interactive mode.
-    Otherwise just prints the string.
+    Otherwise just prints the string (or adds it to the document being captured, see DocumentCapture).
     """
     if (not silent):
-        if(isInInteractiveMode()) :
+        if(documentCapture != None) :
+            documentCapture.addMarkdown(markdown)
+        elif(isInInteractiveMode()) :
+            from IPython.display import Markdown
             display(Markdown(markdown))
         else :
             print(markdown)
  
-def cleanOutUnwantedArguments(exp : sy.Expr, argsToClean : List[sy.Symbol] = None) -> sy.Expr:
+def _preorderTraversal(exp) :
+    """
+    Walks every node of exp, including the elements of mutable matrices (which are not sympy Basic's).
+    """
+    if isinstance(exp, sy.MatrixBase) and not isinstance(exp, sy.Basic) :
+        for element in exp :
+            yield from sy.preorder_traversal(element)
+    else :
+        yield from sy.preorder_traversal(exp)
+
+def _orderedFreeSymbols(exp : sy.Expr) -> List[sy.Symbol] :
+    """
+    The free symbols of exp in the order they first appear (free_symbols is a set, which 
+    would make the order of the arguments of a rewritten function random).
+    """
+    freeSymbols = exp.free_symbols
+    symbols = []
+    for node in sy.preorder_traversal(exp) :
+        if isinstance(node, sy.Symbol) and node in freeSymbols and node not in symbols :
+            symbols.append(node)
+    return symbols
+
+@_timedCall
+def cleanOutUnwantedArguments(exp : sy.Expr, argsToClean : List[sy.Symbol] = None, strict : bool = False) -> sy.Expr:
     """
     For sympy Functions you have made yourself from the Function type, 
     create an expression that doesn't have extra arguments.  For example:
@@ -53,19 +335,74 @@ def cleanOutUnwantedArguments(exp : sy.Expr, argsToClean : List[sy.Symbol] = Non
     sy.Function('g')(y)*sy.cos(x)
 
     This is mainly used for pretty printing of expressions.  
-    An empty or null argsToClean will remove all arguments
+    An empty or null argsToClean will remove all arguments.
+
+    Functions that are differentiated with respect to an argument that would be cleaned are 
+    left alone (otherwise Derivative(g(t), t) would become the derivative of a symbol, which is 0).
+    By default this is found by looking at the Derivatives in the expression and all of the 
+    replacements are made at once.  The strict mode is the older approach of substituting 
+    one function at a time and calling simplify to see if the expression collapsed to 0, 
+    which is much slower on large expressions.
 
     Args:
         exp (sy.Expr): The expression to clean
         argsToClean (List[sy.Symbol]): The symbol arguments to clean from exp.  
         A null or empty list will clean all arguments (free_symbols)
+        strict (bool, optional): Use the substitute-and-simplify approach. Defaults to False.
 
     Returns:
         sy.Expr: An expression with the desired arguments cleaned 
     """
-
     if argsToClean == None:
         argsToClean = []
+    if strict :
+        return _cleanOutUnwantedArgumentsStrictly(exp, argsToClean)
+
+    replacements = _argumentReplacements(_preorderTraversal(exp), argsToClean)
+    if len(replacements) == 0 :
+        return exp
+    return exp.xreplace(replacements)
+
+def _argumentReplacements(nodes, argsToClean : List[sy.Symbol]) -> dict :
+    """
+    Works out the rewritten functions for cleanOutUnwantedArguments from the nodes of an expression 
+    (only the functions and derivatives among them matter).
+    """
+    from sympy.core.function import AppliedUndef
+    functions = set()
+    derivatives = set()
+    for node in nodes :
+        if isinstance(node, AppliedUndef) :
+            functions.add(node)
+        elif isinstance(node, sy.Derivative) :
+            derivatives.add(node)
+
+    replacements = {}
+    removedSymbols = {}
+    for function in functions :
+        allSymbols = _orderedFreeSymbols(function)
+        if len(argsToClean) == 0 :
+            symbolsToLeaveInFinalTerm = []
+        else :
+            symbolsToLeaveInFinalTerm = [symbol for symbol in allSymbols if symbol not in argsToClean]
+
+        if len(symbolsToLeaveInFinalTerm) == 0 :
+            rewrittenFunction = sy.Symbol(function.name)
+        else:
+            rewrittenFunction = sy.Function(function.name)(*symbolsToLeaveInFinalTerm)
+        if rewrittenFunction != function :
+            replacements[function] = rewrittenFunction
+            removedSymbols[function] = set(allSymbols) - set(symbolsToLeaveInFinalTerm)
+
+    for derivative in derivatives :
+        variables = set(derivative.variables)
+        for function in derivative.expr.atoms(AppliedUndef) :
+            if function in replacements and len(variables & removedSymbols[function]) > 0 :
+                del replacements[function]
+    return replacements
+
+def _cleanOutUnwantedArgumentsStrictly(exp : sy.Expr, argsToClean : List[sy.Symbol]) -> sy.Expr:
+    from sympy.core.function import AppliedUndef
     for arg in exp.atoms(AppliedUndef) :
        
         symbolsToLeaveInFinalTerm = []
@@ -85,9 +422,30 @@ def cleanOutUnwantedArguments(exp : sy.Expr, argsToClean : List[sy.Symbol] = Non
             exp = maybeExp 
     return exp
 
+def _dotSymbolName(name : str, order : int) -> str :
+    """
+    The LaTeX-friendly name for the order'th time derivative of name; dots up to 
+    third order and a parenthesized superscript after that.
+    """
+    if order == 1 :
+        return r'\dot{' + name + "}"
+    if order == 2 :
+        return r'\ddot{' + name + "}"
+    if order == 3 :
+        return r'\dddot{' + name + "}"
+    return name + "^{(" + str(order) + ")}"
+
+@_timedCall
 def convertTimeDerivativeToDotSymbol(exp : sy.Expr, t : sy.Expr =None) -> sy.Expr:  
     """Converts the passed in expression into one with time derivatives 
-    up to second order, are replaced with symbols using dot notation
+    (of any order) replaced with symbols using dot notation, and functions 
+    of time replaced with plain symbols.  The whole expression (including the elements 
+    of matrices and both sides of equations) is walked once and all of the replacements 
+    are made in a single xreplace.
+
+    Functions that also show up in a derivative that isn't purely with respect to time 
+    (for example Derivative(z(t, x), x)) are not replaced, since replacing them with a 
+    symbol would make that derivative 0.
 
     Args:
         exp (sy.Expr): Some sympy expression
@@ -98,26 +456,245 @@ def convertTimeDerivativeToDotSymbol(exp : sy.Expr, t : sy.Expr =None) -> sy.Exp
     """
     if t == None :
         t = sy.Symbol('t')
-    for arg in exp.args :
-        if not t in arg.args  :
-            continue
-        sym = sy.Symbol(arg.name)
-        derivative1 = sy.Derivative(arg, t)     
-        if derivative1.is_zero :
-            continue   
-        derivative2 = sy.Derivative(derivative1, t)
-        dot1 = sy.Symbol(r'\dot{' + arg.name + "}")
-        dot2 = sy.Symbol(r'\ddot{' + arg.name + "}")
-
-        exp = exp.subs(derivative2, dot2)
-        exp = exp.subs(derivative1, dot1)
-        exp = exp.subs(arg, sym)
-    return exp
+    replacements = _timeDerivativeReplacements(_preorderTraversal(exp), t)
+    if len(replacements) == 0 :
+        return exp
+    return exp.xreplace(replacements)
+
+def _timeDerivativeReplacements(nodes, t : sy.Expr) -> dict :
+    """
+    Works out the dot symbols for convertTimeDerivativeToDotSymbol from the nodes of an expression 
+    (only the functions and derivatives among them matter).
+    """
+    from sympy.core.function import AppliedUndef
+    timeFunctions = set()
+    protectedFunctions = set()
+    replacements = {}
+    for node in nodes :
+        if isinstance(node, AppliedUndef) :
+            if t in node.args :
+                timeFunctions.add(node)
+        elif isinstance(node, sy.Derivative) :
+            counts = [count for (variable, count) in node.variable_count if variable == t]
+            isTimeDerivativeOfFunction = (isinstance(node.expr, AppliedUndef) and 
+                                          t in node.expr.args and 
+                                          len(counts) == len(node.variable_count) and
+                                          all(count.is_Integer for count in counts))
+            if isTimeDerivativeOfFunction :
+                replacements[node] = sy.Symbol(_dotSymbolName(node.expr.name, int(sum(counts))))
+            else :
+                protectedFunctions.update(node.expr.atoms(AppliedUndef))
+
+    for function in timeFunctions - protectedFunctions :
+        replacements[function] = sy.Symbol(function.name)
+    return replacements
+
+class EquationCleaningCache :
+    """
+    A bounded, least-recently-used cache of cleaned expressions.  Sympy expressions hash and 
+    compare on their structure, so an expression that is rebuilt from scratch (say, by 
+    re-running a notebook cell) will still find the entry made the first time it was cleaned.
+    Set enabled to False to bypass the cache entirely.
+    """
+    def __init__(self, maxSize : int = 512) :
+        self._entries = OrderedDict()
+        self._maxSize = maxSize
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxSize(self) -> int :
+        return self._maxSize
+
+    @maxSize.setter
+    def maxSize(self, value : int) :
+        self._maxSize = value
+        self._evict()
+
+    def __len__(self) -> int :
+        return len(self._entries)
+
+    @staticmethod
+    def makeKey(exp, argsToClean : List[sy.Symbol] = None, t : sy.Expr = None) :
+        """
+        Makes the key for an expression and the cleaning options.  Mutable matrices are not 
+        hashable, so their immutable counterpart (and the original type) is used instead.
+        """
+        if isinstance(exp, sy.MatrixBase) :
+            exp = (type(exp), exp.as_immutable())
+        if argsToClean != None :
+            argsToClean = tuple(argsToClean)
+        return (exp, argsToClean, t)
 
-def showEquation(lhsOrEquation, rhs=None, cleanEqu=defaultCleanEquations) :    
+    def get(self, key) :
+        """
+        Returns the cached value for key (marking it as the most recently used), or None on a miss.
+        """
+        if key in self._entries :
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value) -> None :
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def clear(self) -> None :
+        """
+        Removes all entries and resets the hit and miss counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self) -> None :
+        while len(self._entries) > max(self._maxSize, 0) :
+            self._entries.popitem(last=False)
+
+cleaningCache = EquationCleaningCache()
+
+parallelCleaningThreshold = None # matrices with at least this many distinct elements are cleaned over a process pool (None to never use one, see cleanMatrix)
+parallelCleaningProcesses = None # the number of processes in that pool, None for the number of CPUs
+
+def _cleaningNodes(elements) -> set :
+    # the functions and derivatives in the elements, which is all that the replacements are worked out from
+    from sympy.core.function import AppliedUndef
+    nodes = set()
+    for element in elements :
+        for node in sy.preorder_traversal(element) :
+            if isinstance(node, (AppliedUndef, sy.Derivative)) :
+                nodes.add(node)
+    return nodes
+
+def _replaceInElements(elements, replacements : dict) -> list :
+    return [element.xreplace(replacements) for element in elements]
+
+def _rewriteDistinctElements(elements, makeReplacements, pool) -> dict :
+    """
+    Maps each of the (distinct) elements to the element with the replacements that makeReplacements 
+    works out from the nodes of all of them.  Both walking the elements and rewriting them are 
+    split over the pool if there is one.
+    """
+    if pool == None :
+        chunks = [elements]
+        nodes = _cleaningNodes(elements)
+    else :
+        chunkSize = -(-len(elements) // (parallelCleaningProcesses or cpu_count() or 1))
+        chunks = [elements[i:i + chunkSize] for i in range(0, len(elements), chunkSize)]
+        nodes = set().union(*pool.map(_cleaningNodes, chunks))
+    replacements = makeReplacements(nodes)
+    if len(replacements) == 0 :
+        return dict(zip(elements, elements))
+    if pool == None :
+        rewritten = _replaceInElements(elements, replacements)
+    else :
+        rewritten = [element for chunk in pool.map(_replaceInElements, chunks, [replacements] * len(chunks)) for element in chunk]
+    return dict(zip(elements, rewritten))
+
+def _processPoolContext() :
+    # forking a process with threads (like a Jupyter kernel) isn't safe, so the workers of process pools are 
+    # started from a clean forkserver (or spawned where there is none) with sympy and this module already imported
+    import multiprocessing
+    if "forkserver" in multiprocessing.get_all_start_methods() :
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["sympy", __name__])
+    else :
+        context = multiprocessing.get_context("spawn")
+    return context
+
+def _makeCleaningPool() :
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(parallelCleaningProcesses, mp_context=_processPoolContext())
+
+@_timedCall
+def cleanMatrix(matrix : sy.MatrixBase, argsToClean : List[sy.Symbol] = None, t : sy.Expr = None) -> sy.MatrixBase :
+    """
+    Cleans a matrix the same way cleanExpression does (without the cache), but repeated elements 
+    (common in Jacobians and costate equations) are only walked and rewritten once.  The replacements 
+    are still worked out from the whole matrix, so the result is the same as cleaning it as one expression.
+
+    Matrices with at least parallelCleaningThreshold distinct elements are split over a pool of 
+    parallelCleaningProcesses processes.  Starting the pool and sending the elements to it has a real 
+    cost, so it only pays off for large matrices of large expressions.  The processes are started 
+    fresh (not forked), which is safe in a Jupyter kernel, but like any multiprocessing they import 
+    the script that is run, so a script that turns the pool on needs an if __name__ == "__main__" guard.
+
+    Args:
+        matrix (sy.MatrixBase): The matrix to clean
+        argsToClean (List[sy.Symbol], optional): Passed on to cleanOutUnwantedArguments. Defaults to None.
+        t (sy.Expr, optional): Passed on to convertTimeDerivativeToDotSymbol. Defaults to None.
+
+    Returns:
+        sy.MatrixBase: The cleaned matrix, of the same type as matrix
+    """
+    if argsToClean == None :
+        argsToClean = []
+    if t == None :
+        t = sy.Symbol('t')
+    elements = list(dict.fromkeys(matrix))
+    pool = None
+    if parallelCleaningThreshold != None and len(elements) >= parallelCleaningThreshold :
+        pool = _makeCleaningPool()
+    try :
+        dotted = _rewriteDistinctElements(elements, lambda nodes : _timeDerivativeReplacements(nodes, t), pool)
+        cleaned = _rewriteDistinctElements(list(dict.fromkeys(dotted.values())), lambda nodes : _argumentReplacements(nodes, argsToClean), pool)
+    finally :
+        if pool != None :
+            pool.shutdown()
+    return matrix.applyfunc(lambda element : cleaned[dotted[element]])
+
+@_timedCall
+def cleanExpression(exp, argsToClean : List[sy.Symbol] = None, t : sy.Expr = None) :
+    """
+    Converts time derivatives to dot notation and cleans out unwanted function arguments 
+    (see convertTimeDerivativeToDotSymbol and cleanOutUnwantedArguments).  Results are 
+    kept in cleaningCache so cleaning the same expression with the same options again is a lookup.
+
+    Args:
+        exp: The expression (or matrix) to clean
+        argsToClean (List[sy.Symbol], optional): Passed on to cleanOutUnwantedArguments. Defaults to None.
+        t (sy.Expr, optional): Passed on to convertTimeDerivativeToDotSymbol. Defaults to None.
+
+    Returns:
+        The cleaned expression
+    """
+    def clean() :
+        if isinstance(exp, sy.MatrixBase) :
+            return cleanMatrix(exp, argsToClean, t)
+        return cleanOutUnwantedArguments(convertTimeDerivativeToDotSymbol(exp, t), argsToClean)
+
+    if not cleaningCache.enabled :
+        return clean()
+    try :
+        key = EquationCleaningCache.makeKey(exp, argsToClean, t)
+        cleaned = cleaningCache.get(key)
+    except TypeError : # something in the expression isn't hashable, just don't cache it
+        return clean()
+    if cleaned == None :
+        cleaned = clean()
+        cleaningCache.put(key, cleaned)
+    if isinstance(cleaned, sy.MatrixBase) and not isinstance(cleaned, sy.ImmutableMatrix) :
+        return cleaned.copy() # don't hand out the cached instance of a mutable matrix
+    return cleaned
+
+@_timedCall
+def showEquation(lhsOrEquation, rhs=None, cleanEqu=defaultCleanEquations, renderLatex=None, compact=None, summarize=False) :    
     """
     Shows the equation.  The first item is a sympy equation and no rhs will be given.  It can also be a string or number but the rhs 
     must be specified in that case.
+
+    If renderLatex is True (defaulting to defaultRenderLatex), the LaTeX is made with toLatex, which caches it 
+    across builds, and displayed as math instead of handing the expression to the display to render.
+
+    If compact is True, common subexpressions are pulled out and shown first as named intermediate symbols 
+    (see compactSymbolName), followed by the much smaller equation in terms of them.  compact defaults to 
+    None, which turns it on for expressions with more than compactDisplayThreshold nodes.  summarize 
+    (which implies compact) only shows the first compactMaxItems intermediate symbols and terms of the 
+    equation, so what is shown stays bounded however large the expression gets.
     """
     def shouldIClean(side) :
         return (isinstance(side, sy.Function) or 
@@ -151,158 +728,627 @@ def showEquation(lhsOrEquation, rhs=None, cleanEqu=defaultCleanEquations) :
             realRhs = sy.symbols(rhs)
        
     if(cleanEqu and shouldIClean(realRhs)) : 
-        realRhs = convertTimeDerivativeToDotSymbol(realRhs)
-        realRhs = cleanOutUnwantedArguments(realRhs)        
+        realRhs = cleanExpression(realRhs)
     if(cleanEqu and shouldIClean(realLhs)) : 
-        realLhs = convertTimeDerivativeToDotSymbol(realLhs)
-        realLhs = cleanOutUnwantedArguments(realLhs)
+        realLhs = cleanExpression(realLhs)
         
 
     if(not silent) :
         if(isinstance(realLhs, sy.Eq) or realRhs == None) :
-            display(realLhs) 
+            toShow = realLhs
         else :
-            display(sy.Eq(realLhs, realRhs))
+            toShow = sy.Eq(realLhs, realRhs)
+        if(renderLatex == None) :
+            renderLatex = defaultRenderLatex
+        if(compact == None) :
+            compact = compactDisplayThreshold != None and _isLargerThan(toShow, compactDisplayThreshold)
+        if((compact or summarize) and isinstance(toShow, (sy.Basic, sy.MatrixBase))) :
+            _displayCompactly(toShow, renderLatex, summarize)
+        else :
+            _displayEquation(toShow, renderLatex)
 
-import subprocess
-from os import listdir, unlink, remove, walk, rmdir
-from os.path import isfile, join, basename, dirname, splitext, realpath
+def _displayLatex(latex : str) -> None :
+    if(documentCapture != None) :
+        documentCapture.addEquation(latex)
+    elif(isInInteractiveMode()) :
+        from IPython.display import Math
+        display(Math(latex)) # Math adds the \displaystyle that sympy's own rendering has
+    else :
+        print("$$" + latex + "$$")
 
-class ReportGeneratorFromPythonFileWithCells :      
-    @staticmethod
-    def WriteIpynbToDesiredFormatWithPandoc(pythonFilePath, outputFilePath = None, extension = "pdf", sources = None, csl=None, keepDirectoryClean = True) :
-        if outputFilePath != None :
-            extension = splitext(pythonFilePath)[1]
+def _displayEquation(toShow, renderLatex : bool) -> None :
+    if(documentCapture != None or renderLatex) :
+        _displayLatex(toLatex(toShow))
+    else :
+        display(toShow)
+
+compactDisplayThreshold = 2000 # showEquation shows expressions with more nodes than this compactly (None to only do it when asked)
+compactSymbolName = r"\xi_{{{}}}" # the name of the intermediate symbols of compact equations, formatted with their number
+compactMaxItems = 10 # how many intermediate symbols, terms, factors, and matrix rows and columns a summarized equation shows
+compactMaxCharacters = 5000 # the longest LaTeX a summarized equation shows for one expression
+
+def _isLargerThan(exp, nodeCount : int) -> bool :
+    # stops counting once there are more than nodeCount nodes, so it is cheap on huge expressions
+    for (i, node) in enumerate(_preorderTraversal(exp)) :
+        if i >= nodeCount :
+            return True
+    return False
+
+def _compactSymbols(exp) :
+    # the intermediate symbols, skipping any names already in the expression
+    names = {str(symbol) for symbol in exp.free_symbols}
+    number = 1
+    while True :
+        name = compactSymbolName.format(number)
+        if name not in names :
+            yield sy.Symbol(name)
+        number += 1
+
+def _displayCompactly(toShow, renderLatex : bool, summarize : bool) -> None :
+    """
+    Shows the common subexpressions of toShow (of both sides of an equation) as intermediate symbols, 
+    and then toShow in terms of them.  When summarizing, only the first compactMaxItems of the 
+    intermediate symbols are shown, and each of them and the final equation is cut down (see _displaySummarized).
+    """
+    if isinstance(toShow, sy.Eq) :
+        (definitions, (reducedLhs, reduced)) = sy.cse([toShow.lhs, toShow.rhs], symbols=_compactSymbols(toShow))
+        sides = [reducedLhs, reduced]
+    else :
+        (definitions, (reduced,)) = sy.cse([toShow], symbols=_compactSymbols(toShow))
+        sides = [reduced]
+    shownDefinitions = definitions[:compactMaxItems] if summarize else definitions
+    for (symbol, value) in shownDefinitions :
+        if summarize :
+            _displaySummarized([symbol, value], renderLatex)
         else :
-            outputFilePath = pythonFilePath.replace(".py", "."+extension)
-        ipynbFile = pythonFilePath.replace(".py", ".ipynb")
-        mdFileName = pythonFilePath.replace(".py", ".md")
-        directory = dirname(pythonFilePath)
-        
-        if sources == None or csl == None:
-            files = [f for f in listdir(directory) if isfile(join(directory, f))]
-            if sources == None :
-                for file in files :
-                    if file.endswith("bib") :
-                        sources = file
-                        break
-
-            if csl == None :
-                for file in files :
-                    if file.endswith("csl") :
-                        csl = file
-                        break
+            _displayEquation(sy.Eq(symbol, value, evaluate=False), renderLatex)
+    if len(shownDefinitions) < len(definitions) :
+        printMarkdown(r"$\dots$ and " + str(len(definitions) - len(shownDefinitions)) + " more intermediate expressions")
 
-        
-        with CleanDirectoryScope(directory, [basename(outputFilePath)], keepDirectoryClean) :
-            if not ScopeIfFileDoesNotExist.isFileControlledByScope(ipynbFile) :
-                ReportGeneratorFromPythonFileWithCells.ConvertPythonToJupyter(pythonFilePath, directory)
-                jupyterCommand = "jupyter nbconvert --execute --to markdown --no-input " + ipynbFile
-                ReportGeneratorFromPythonFileWithCells.runCommandPrintingOutput(jupyterCommand)
-                ReportGeneratorFromPythonFileWithCells.RemoveSinglePercentLinesFromFile(mdFileName)
-                pandocCommand = "pandoc " + mdFileName + " -s -N -o " + outputFilePath +" --citeproc --bibliography=" + join(directory, sources) + " --csl=" + join(directory, csl)
-                ReportGeneratorFromPythonFileWithCells.runCommandPrintingOutput(pandocCommand, directory)
-                if not isfile(outputFilePath) :
-                    raise Exception("File was not created sucessfully")
+    if summarize :
+        _displaySummarized(sides, renderLatex)
+    elif isinstance(toShow, sy.Eq) :
+        _displayEquation(sy.Eq(reducedLhs, reduced, evaluate=False), renderLatex)
+    else :
+        _displayEquation(reduced, renderLatex)
+
+def _truncateForSummary(exp, omitted : dict) :
+    # exp with every sum and product (anywhere in it) of more than compactMaxItems terms cut down to its 
+    # first compactMaxItems followed by dots, and matrices to their first compactMaxItems rows and columns, 
+    # counting what was left out in omitted
+    if isinstance(exp, sy.MatrixBase) :
+        (rows, columns) = exp.shape
+        omitted["rows"] += max(rows - compactMaxItems, 0)
+        omitted["columns"] += max(columns - compactMaxItems, 0)
+        return exp[:min(rows, compactMaxItems), :min(columns, compactMaxItems)].applyfunc(lambda element : _truncateForSummary(element, omitted))
+    if not isinstance(exp, sy.Basic) or len(exp.args) == 0 :
+        return exp
+    if isinstance(exp, (sy.Add, sy.Mul)) :
+        (args, kind, dots) = (exp.as_ordered_terms(), "terms", r"\dots") if isinstance(exp, sy.Add) else (exp.as_ordered_factors(), "factors", r"\cdots")
+        args = [_truncateForSummary(arg, omitted) for arg in args[:compactMaxItems]] + ([sy.Symbol(dots)] if len(args) > compactMaxItems else [])
+        omitted[kind] += max(len(exp.args) - compactMaxItems, 0)
+        # the printer would sort the dots in with the terms, so this is printed without reordering
+        return exp.func(*args, evaluate=False)
+    args = [_truncateForSummary(arg, omitted) for arg in exp.args]
+    if all(arg is original for (arg, original) in zip(args, exp.args)) :
+        return exp
+    with sy.evaluate(False) :
+        return exp.func(*args)
+
+def _displaySummarized(sides : list, renderLatex : bool) -> None :
+    """
+    Shows the expression (or the sides of an equation) with its large sums, products and matrices cut down 
+    (see _truncateForSummary) and a note of how much was left out.  An expression whose LaTeX is still longer 
+    than compactMaxCharacters is only described.  Sides that are small enough are shown as they are.
+    """
+    omitted = {"terms" : 0, "factors" : 0, "rows" : 0, "columns" : 0}
+    shownSides = [_truncateForSummary(side, omitted) for side in sides]
+    latexSides = [sy.latex(side, **dict(latexPrinterSettings, order="none")) for side in shownSides]
+    tooLong = [len(latex) > compactMaxCharacters for latex in latexSides]
+    if not any(omitted.values()) and not any(tooLong) :
+        _displayEquation(sides[0] if len(sides) == 1 else sy.Eq(sides[0], sides[1], evaluate=False), renderLatex)
+        return
+    latexSides = [r"\text{(an expression " + str(len(latex)) + " characters long)}" if long else latex for (latex, long) in zip(latexSides, tooLong)]
+    notes = [str(count) + " more " + kind for (kind, count) in omitted.items() if count > 0]
+    _displayLatex(" = ".join(latexSides) + (r" \quad \text{(" + ", ".join(notes) + ")}" if len(notes) > 0 else ""))
+
+def defaultCacheDirectory(name : str) -> str :
+    """
+    The folder that the on-disk cache called name is kept in: a subfolder of the SPP_CACHE_DIRECTORY 
+    environment variable if it is set, otherwise of ~/.cache/sympyPaperPrinter.
+    """
+    from os import environ
+    from os.path import expanduser
+    root = environ.get("SPP_CACHE_DIRECTORY")
+    if root == None or root == "" :
+        root = join(expanduser("~"), ".cache", "sympyPaperPrinter")
+    return join(root, name)
+
+def _writeFileAtomically(filePath : str, data) -> None :
+    # written to a temporary file that then replaces filePath, so another build (or thread) never reads half of a file
+    import threading
+    from os import replace, getpid
+    from os.path import dirname
+    makedirs(dirname(filePath), exist_ok=True)
+    temporaryFile = filePath + "." + str(getpid()) + "-" + str(threading.get_ident()) + ".tmp"
+    if isinstance(data, str) :
+        with open(temporaryFile, "w", encoding="utf-8") as f :
+            f.write(data)
+    else :
+        with open(temporaryFile, "wb") as f :
+            f.write(data)
+    replace(temporaryFile, filePath)
+
+def _cachedFiles(directory : str, extension : str) -> list :
+    # (modification time, size, path) of the files of an on-disk cache
+    from os import scandir
+    files = []
+    try :
+        with scandir(directory) as entries :
+            for entry in entries :
+                if entry.name.endswith(extension) :
+                    try :
+                        info = entry.stat()
+                    except FileNotFoundError :
+                        continue
+                    files.append((info.st_mtime, info.st_size, entry.path))
+    except FileNotFoundError :
+        pass
+    return files
+
+def _evictCachedFiles(directory : str, extension : str, maxBytes : int) -> int :
+    # deletes the least recently used files down to three quarters of maxBytes, so the folder isn't 
+    # scanned again on every put, and returns how many bytes are left
+    from os import unlink
+    files = sorted(_cachedFiles(directory, extension))
+    total = sum(size for (modified, size, path) in files)
+    for (modified, size, path) in files :
+        if total <= maxBytes * 3 // 4 :
+            break
+        try :
+            unlink(path)
+        except FileNotFoundError : # another process got to it first
+            pass
+        total -= size
+    return total
+
+localKeyPrefix = "local-" # starts the cache keys that are only good for this process (see makeExpressionKey)
+
+def _replaceDummies(obj, replacements : dict) :
+    if isinstance(obj, (list, tuple)) :
+        return type(obj)(_replaceDummies(item, replacements) for item in obj)
+    if isinstance(obj, (sy.Basic, sy.MatrixBase)) :
+        return obj.xreplace(replacements)
+    return obj
+
+def _dummiesIn(obj) -> set :
+    if isinstance(obj, (list, tuple)) :
+        return set().union(*[_dummiesIn(item) for item in obj])
+    if isinstance(obj, (sy.Basic, sy.MatrixBase)) :
+        return obj.atoms(sy.Dummy)
+    return set()
+
+def makeExpressionKey(objects : list, details : list) -> str :
+    """
+    A sha256 of the srepr of the sympy objects and the detail strings that is the same in every process.  
+    The srepr of a Dummy has an index that changes from process to process, so the Dummies are replaced by 
+    symbols numbered in the order of their names (and then of when they were made).  If some are left (in 
+    something that can't be replaced in), the key starts with localKeyPrefix and the caches only keep it in memory.
+    """
+    import hashlib
+    dummies = sorted(_dummiesIn(objects), key=lambda dummy : (dummy.name, dummy.dummy_index))
+    replacements = {dummy : sy.Symbol("_sppDummy" + str(i) + "_" + dummy.name, **dummy.assumptions0) for (i, dummy) in enumerate(dummies)}
+    text = "\n".join([sy.srepr(_replaceDummies(obj, replacements)) for obj in objects] + details)
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return localKeyPrefix + key if "Dummy(" in text else key
+
+class LambdifyCache :
+    """
+    Keeps the callables made by lambdifyCached in memory, and the code generated for them in a folder 
+    so that later runs (like the next build of a report) skip generating the code again.  Like LatexCache, 
+    only the maxSize most recently used callables are kept in memory, and when the files add up to more than 
+    maxBytes the least recently used ones are deleted.  Set enabled to False to bypass the cache, and 
+    directory to None to only cache in memory.
+    """
+    def __init__(self, directory : str = None, maxBytes : int = 64 * 1024 * 1024, maxSize : int = 1024) :
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self._maxSize = maxSize
+        self.enabled = True
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._functions = OrderedDict()
+        self._approximateBytes = None
+
+    @property
+    def maxSize(self) -> int :
+        return self._maxSize
+
+    @maxSize.setter
+    def maxSize(self, value : int) :
+        self._maxSize = value
+        self._forget()
+
+    def __len__(self) -> int :
+        return len(self._functions)
 
     @staticmethod
-    def RemoveSinglePercentLinesFromFile(filePath) :
-        # note that the p2j routine leaves in a % for each #%% cell in the original py file
-        # this pair-of-loops here removes those lines
-        with open(filePath, "r") as f:
-            lines = f.readlines()
-        with open(filePath, "w") as f:
-            for line in lines:
-                if line.strip("\n") != "%":
-                    f.write(line)
+    def makeKey(args, expression, modules, cse : bool) -> str :
+        """
+        A key (see makeExpressionKey) of the expression and arguments, the backend, and the sympy version 
+        (the generated code can change between versions).
+        """
+        return makeExpressionKey([expression, args], [repr(modules), repr(cse), sy.__version__])
+
+    def getFunction(self, key : str, modules) :
+        """
+        Returns the callable for key from memory or rebuilt from the code on disk, or None on a miss.
+        """
+        if key in self._functions :
+            self._functions.move_to_end(key)
+            self.hits += 1
+            return self._functions[key]
+        if self.directory != None and not key.startswith(localKeyPrefix) :
+            from os import utime
+            codeFile = join(self.directory, key + ".py")
+            try :
+                with open(codeFile, "r", encoding="utf-8") as f :
+                    source = f.read()
+                utime(codeFile) # marks it as recently used
+            except OSError : # not there, or evicted by another process
+                source = None
+            if source != None :
+                function = LambdifyCache._makeFunction(source, modules, codeFile)
+                self._remember(key, function)
+                self.diskHits += 1
+                return function
+        self.misses += 1
+        return None
+
+    def putFunction(self, key : str, function, modules) -> None :
+        """
+        Keeps the function in memory, and its code on disk if everything the code uses comes from 
+        the backend (the namespace of anything else, like an implemented_function, can't be rebuilt).
+        """
+        import inspect
+        self._remember(key, function)
+        if self.directory == None or key.startswith(localKeyPrefix) :
+            return
+        namespace = LambdifyCache._makeNamespace(modules)
+        if any(name not in namespace for name in function.__code__.co_names) :
+            return
+        source = inspect.getsource(function)
+        _writeFileAtomically(join(self.directory, key + ".py"), source)
+        if self._approximateBytes == None :
+            self._approximateBytes = sum(size for (modified, size, path) in _cachedFiles(self.directory, ".py"))
+        else :
+            self._approximateBytes += len(source.encode("utf-8"))
+        if self._approximateBytes > self.maxBytes :
+            self._approximateBytes = _evictCachedFiles(self.directory, ".py", self.maxBytes)
+
+    def clear(self, removeFiles : bool = False) -> None :
+        """
+        Forgets the functions in memory (and deletes the code on disk if removeFiles is True).
+        """
+        self._functions.clear()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._approximateBytes = None
+        if removeFiles and self.directory != None :
+            import shutil
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _remember(self, key : str, function) -> None :
+        self._functions[key] = function
+        self._functions.move_to_end(key)
+        self._forget()
+
+    def _forget(self) -> None :
+        # drops the least recently used callables from memory (their code stays on disk)
+        while len(self._functions) > max(self._maxSize, 0) :
+            self._functions.popitem(last=False)
 
     @staticmethod
-    def ConvertPythonToJupyter(pythonFileToConvert, workingDirectory = None):
-        # I would like to someday replace p2j since it does a few things that are frustrating
-        # in my workflow (turning comment lines into markdown is the big one)
-        if workingDirectory == None :
-            workingDirectory = dirname(pythonFileToConvert)
-        ReportGeneratorFromPythonFileWithCells.runCommandPrintingOutput('p2j ' + pythonFileToConvert + ' -o', workingDirectory)
+    def _makeNamespace(modules) -> dict :
+        # lambdify fills the globals of the functions it makes with the backend, so a trivial one has the namespace generated code needs
+        return dict(sy.lambdify([], 0, modules).__globals__)
 
     @staticmethod
-    def runCommandPrintingOutput(command, workingDirectory = None) :
-        if workingDirectory == None :
-            workingDirectory = dirname(dirname(realpath(__file__)))
-        result = subprocess.run(command, capture_output=True, text=True, cwd=workingDirectory)
-        if(len(result.stderr.strip()) > 0):
-            print(result.stderr)
-            print(result.stdout)            
-
-class CleanDirectoryScope :
-    """
-    A scope that will record the contents of a directory upon entry, and 
-    on exit will delete all new files and new, empty, directories.  When working with a process 
-    where a bunch of extra files might clutter up an otherwise well manicured directory, 
-    this is a easy way to keep that directory clean.
-    """
-    def __init__(self, directory : str, localNewFilesToKeep : List[str] = [], keepDirectoryClean = True) :
-        for file in localNewFilesToKeep :
-            self.localNewFilesToKeep = join(directory, file)
+    def _makeFunction(source : str, modules, codeFile : str) :
+        namespace = LambdifyCache._makeNamespace(modules)
+        exec(compile(source, codeFile, "exec"), namespace)
+        return namespace["_lambdifygenerated"]
+
+lambdifyCache = LambdifyCache(defaultCacheDirectory("lambdify"))
+
+def lambdifyCached(args, expression, modules = "numpy", cse : bool = True) :
+    """
+    Like sy.lambdify, but the callable is cached in memory and its code on disk (see lambdifyCache), 
+    keyed by the expression, the arguments and the backend.  Common subexpressions are pulled out 
+    before the code is generated (unless cse is False), which makes evaluating large expressions faster.
+
+    Args:
+        args: The arguments of the callable, as for sy.lambdify
+        expression: The expression (or matrix, or list of them) to evaluate
+        modules (optional): The backend, as for sy.lambdify. Defaults to "numpy".
+        cse (bool, optional): Apply common subexpression elimination. Defaults to True.
+
+    Returns:
+        A function that evaluates the expression (vectorized over arrays with the numpy backend)
+    """
+    if not lambdifyCache.enabled :
+        return sy.lambdify(args, expression, modules, cse=cse)
+    key = LambdifyCache.makeKey(args, expression, modules, cse)
+    function = lambdifyCache.getFunction(key, modules)
+    if function == None :
+        function = sy.lambdify(args, expression, modules, cse=cse)
+        lambdifyCache.putFunction(key, function, modules)
+    return function
+
+defaultRenderLatex = False # if True, showEquation makes the LaTeX itself (through latexCache) and displays it as math
+latexPrinterSettings = {} # the settings passed on to sy.latex by toLatex
+
+class LatexCache :
+    """
+    A content-addressed cache of the LaTeX of expressions, in memory and in a folder that builds 
+    (and the worker processes of parallel builds) share.  Each string is a <key>.tex file, written 
+    atomically.  When the files add up to more than maxBytes, the least recently used ones (by 
+    modification time, which a hit refreshes) are deleted.  In memory, only the maxSize most recently 
+    used strings are kept.  Set enabled to False to bypass the cache, and directory to None to only cache in memory.
+    """
+    def __init__(self, directory : str = None, maxBytes : int = 64 * 1024 * 1024, maxSize : int = 4096) :
         self.directory = directory
-        self.keepDirectoryClean = keepDirectoryClean
+        self.maxBytes = maxBytes
+        self._maxSize = maxSize
+        self.enabled = True
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._latex = OrderedDict()
+        self._approximateBytes = None
 
-    def __enter__(self) :
-        self.filesInDirectory, self.directories = self.getFilesAndDirectoriesInDirectory()
-        return self
+    @property
+    def maxSize(self) -> int :
+        return self._maxSize
+
+    @maxSize.setter
+    def maxSize(self, value : int) :
+        self._maxSize = value
+        self._forget()
 
-    def __exit__(self, exc_type, exc_value, tb) :        
-        if not self.keepDirectoryClean :
+    def __len__(self) -> int :
+        return len(self._latex)
+
+    @staticmethod
+    def makeKey(expression, settings : dict) -> str :
+        """
+        A key (see makeExpressionKey) of the expression, the printer settings, and the sympy version.
+        """
+        return makeExpressionKey([expression], [repr(sorted(settings.items())), sy.__version__])
+
+    def get(self, key : str) -> str :
+        """
+        Returns the LaTeX for key from memory or disk, or None on a miss.
+        """
+        if key in self._latex :
+            self._latex.move_to_end(key)
+            self.hits += 1
+            return self._latex[key]
+        if self.directory != None and not key.startswith(localKeyPrefix) :
+            from os import utime
+            latexFile = join(self.directory, key + ".tex")
+            try :
+                with open(latexFile, "r", encoding="utf-8") as f :
+                    latex = f.read()
+                utime(latexFile) # marks it as recently used
+            except OSError : # not there, or evicted by another process
+                latex = None
+            if latex != None :
+                self._remember(key, latex)
+                self.diskHits += 1
+                return latex
+        self.misses += 1
+        return None
+
+    def put(self, key : str, latex : str) -> None :
+        self._remember(key, latex)
+        if self.directory == None or key.startswith(localKeyPrefix) :
             return
-        filesAtEnd, directoriesAtEnd = self.getFilesAndDirectoriesInDirectory()
-        for file in filesAtEnd :
-            if not file in self.filesInDirectory and not file in self.localNewFilesToKeep :
-                if isfile(file) :
-                    remove(file)
-                    
-        for dir in directoriesAtEnd :
-            if not dir in self.directories and len(listdir(dir)) == 0: # since we already removed files, only delete dir if empty
-                rmdir(dir)
-
-    def getFilesAndDirectoriesInDirectory(self) -> List[List[str]] :
-        files = []
-        directories = []
-        for (dirpath, dirnames, filenames) in walk(self.directory) :
-            for dir in dirnames :
-                directories.append(join(dirpath, dir))
-            for file in filenames :
-                files.append(join(dirpath, file))
-        return [files, directories]
-
-import uuid
-class ScopeIfFileDoesNotExist :
-    """
-    Creates a scope based on the existence of a file.  What happened is when I want a 
-    script to make a PDF of itself, the script might need to get rerun, which means 
-    the 'create pdf' part of the code runs again.  
-    """
-    # however, with the need to know the exact file location, this is less useful than 
-    # it was
-    scopedFiles = []
-
-    def __init__(self, directory, fileName = None) :
-        self.directory = directory
-        if fileName == None :
-            fileName = str(uuid.uuid4())
-        self.fileName =join(self.directory, fileName)
-    
-    def __enter__(self) :        
-        if isfile(self.fileName) :
-            with open(self.fileName, 'w') :
-                pass
-        ScopeIfFileDoesNotExist.scopedFiles.append(self.fileName)
+        _writeFileAtomically(join(self.directory, key + ".tex"), latex)
+        if self._approximateBytes == None :
+            self._approximateBytes = sum(size for (modified, size, path) in _cachedFiles(self.directory, ".tex"))
+        else :
+            self._approximateBytes += len(latex.encode("utf-8"))
+        if self._approximateBytes > self.maxBytes :
+            self._evict()
+
+    def clear(self, removeFiles : bool = False) -> None :
+        """
+        Forgets the LaTeX in memory (and deletes the files on disk if removeFiles is True).
+        """
+        self._latex.clear()
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._approximateBytes = None
+        if removeFiles and self.directory != None :
+            import shutil
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _remember(self, key : str, latex : str) -> None :
+        self._latex[key] = latex
+        self._latex.move_to_end(key)
+        self._forget()
+
+    def _forget(self) -> None :
+        # drops the least recently used strings from memory (they stay on disk)
+        while len(self._latex) > max(self._maxSize, 0) :
+            self._latex.popitem(last=False)
+
+    def _evict(self) -> None :
+        self._approximateBytes = _evictCachedFiles(self.directory, ".tex", self.maxBytes)
+
+latexCache = LatexCache(defaultCacheDirectory("latex"))
+
+def toLatex(expression) -> str :
+    """
+    The LaTeX of the expression (made with sy.latex and latexPrinterSettings), from latexCache if it has been made before.
+    """
+    if not latexCache.enabled :
+        return sy.latex(expression, **latexPrinterSettings)
+    key = LatexCache.makeKey(expression, latexPrinterSettings)
+    latex = latexCache.get(key)
+    if latex == None :
+        latex = sy.latex(expression, **latexPrinterSettings)
+        latexCache.put(key, latex)
+    return latex
+
+documentCapture = None # the DocumentCapture that printMarkdown and showEquation write to, if one is active
+
+def writeContentAddressedFile(directory : str, data : bytes, extension : str) -> str :
+    """
+    Writes the data to a file in directory named by its sha256, unless that file is already there (in 
+    which case it already has this content), so that unchanged figures aren't rewritten on every build.
+
+    Returns:
+        str: The name of the file
+    """
+    import hashlib
+    from os.path import isfile
+    fileName = hashlib.sha256(data).hexdigest()[:32] + "." + extension
+    filePath = join(directory, fileName)
+    if not isfile(filePath) :
+        _writeFileAtomically(filePath, data)
+    return fileName
+
+class DocumentCapture :
+    """
+    A scope that collects what printMarkdown and showEquation show (and the matplotlib figures that are shown) 
+    into a markdown document instead of displaying them.  Markdown is kept as-is, equations become LaTeX display 
+    math and figures are saved as figureFormat ("png", or "pdf" or "svg" for vector output) files in figureDirectory, 
+    named by their content so a figure that didn't change isn't written again (see writeContentAddressedFile).  
+    They are linked as figureLink/<file>, figureLink defaulting to the name of figureDirectory (right when the 
+    markdown is written to the folder figureDirectory is in).  Anything printed directly to stdout is not captured.
+    """
+    def __init__(self, figureDirectory : str, figureFormat : str = "png", figureLink : str = None) :
+        self.figureDirectory = figureDirectory
+        self.figureFormat = figureFormat
+        self.figureLink = figureLink if figureLink != None else basename(figureDirectory)
+        self.parts = []
+        self.figureFiles = []
+
+    capturedScripts = [] # the scripts being run by CaptureScriptToMarkdown
+
+    @staticmethod
+    def isCapturing(pythonFilePath : str) -> bool :
+        """
+        True if the script is the one being captured (so a script that makes a report of itself doesn't do it again while being captured).
+        """
+        return realpath(pythonFilePath) in DocumentCapture.capturedScripts
+
+    def addMarkdown(self, markdown : str) -> None :
+        self.parts.append(markdown)
+
+    def addEquation(self, latex : str) -> None :
+        self.parts.append("$$" + latex + "$$")
+
+    def addFigure(self, figure) -> None :
+        import io
+        import matplotlib
+        buffer = io.BytesIO()
+        # without a date in the metadata and with a fixed salt for the ids of svg elements, the same figure is the same file
+        metadata = {"pdf" : {"CreationDate" : None}, "svg" : {"Date" : None}}.get(self.figureFormat)
+        with matplotlib.rc_context({"svg.hashsalt" : "sympyPaperPrinter"}) :
+            figure.savefig(buffer, format=self.figureFormat, bbox_inches="tight", metadata=metadata)
+        figureName = writeContentAddressedFile(self.figureDirectory, buffer.getvalue(), self.figureFormat)
+        self.figureFiles.append(join(self.figureDirectory, figureName))
+        self.parts.append("![](" + self.figureLink + "/" + figureName + ")")
+
+    def addOpenFigures(self) -> None :
+        """
+        Adds (and closes) all of the open matplotlib figures, like the inline backend of Jupyter does at the end of a cell.
+        """
+        if "matplotlib.pyplot" not in sys.modules :
+            return
+        plt = sys.modules["matplotlib.pyplot"]
+        for number in plt.get_fignums() :
+            self.addFigure(plt.figure(number))
+        plt.close("all")
+
+    def getMarkdown(self) -> str :
+        return "\n\n".join(self.parts) + "\n"
+
+    def _capturePyplot(self, plt) -> None :
+        # draw with Agg and have plt.show add the figures to the document (which is what the script showing them wants)
+        self._originalBackend = plt.get_backend()
+        plt.switch_backend("Agg")
+        self._originalShow = plt.show
+        plt.show = lambda *args, **kwargs : self.addOpenFigures()
+
+    def __enter__(self) :
+        global documentCapture
+        self._previousCapture = documentCapture
+        documentCapture = self
+        self._originalShow = None
+        self._pyplotImportHook = None
+        # importing pyplot (and switching its backend) is slow, so it is only done here if something already did it, 
+        # otherwise pyplot is captured when the script imports it
+        if "matplotlib.pyplot" in sys.modules :
+            self._capturePyplot(sys.modules["matplotlib.pyplot"])
+        else :
+            self._pyplotImportHook = _ModuleImportHook("matplotlib.pyplot", self._capturePyplot)
+            sys.meta_path.insert(0, self._pyplotImportHook)
         return self
 
     def __exit__(self, exc_type, exc_value, tb) :
-        ScopeIfFileDoesNotExist.scopedFiles.remove(self.fileName)
-        if not self.fileAlreadyExists and isfile(self.fileName) :
-            remove(self.fileName)
-            
-    @staticmethod
-    def isFileControlledByScope(filepath) :
-        return filepath in ScopeIfFileDoesNotExist.scopedFiles
+        global documentCapture
+        self.addOpenFigures()
+        if self._pyplotImportHook in sys.meta_path :
+            sys.meta_path.remove(self._pyplotImportHook)
+        if self._originalShow != None :
+            plt = sys.modules["matplotlib.pyplot"]
+            plt.show = self._originalShow
+            plt.switch_backend(self._originalBackend)
+        documentCapture = self._previousCapture
+
+class _ModuleImportHook :
+    # a finder for sys.meta_path that calls onImport with the module named moduleName once it has been imported 
+    # (by whichever finder would have found it otherwise), and then takes itself off of sys.meta_path
+    def __init__(self, moduleName : str, onImport) :
+        self.moduleName = moduleName
+        self.onImport = onImport
+
+    def find_spec(self, fullname, path, target=None) :
+        if fullname != self.moduleName :
+            return None
+        for finder in sys.meta_path :
+            if finder is self or not hasattr(finder, "find_spec") :
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec != None and spec.loader != None :
+                spec.loader = _HookedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def loaded(self, module) -> None :
+        if self in sys.meta_path :
+            sys.meta_path.remove(self)
+        self.onImport(module)
+
+class _HookedLoader :
+    # the loader of a module found by a _ModuleImportHook, which tells the hook once the module ran
+    def __init__(self, loader, hook : _ModuleImportHook) :
+        self.loader = loader
+        self.hook = hook
+
+    def create_module(self, spec) :
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module) -> None :
+        self.loader.exec_module(module)
+        self.hook.loaded(module)
 
+    def __getattr__(self, name) :
+        return getattr(self.loader, name)
@@ -0,0 +1,1434 @@
+# The report-generation side of the Sympy Paper Printer: turning a python file with #%% cells into a pdf 
+# (or another format) with pandoc.  This is loaded the first time one of these classes is used from 
+# sympyPaperPrinter so that just printing equations doesn't pay for importing all of this.
+import sympyPaperPrinter as spp
+import subprocess
+import sys
+import json
+import pickle
+import hashlib
+import fnmatch
+import shutil
+import tempfile
+import time
+import traceback
+import runpy
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from os import listdir, close, unlink, remove, replace, walk, rmdir, makedirs, scandir, stat, getcwd, chdir, pathsep, sep, cpu_count, environ
+from os.path import isfile, isdir, getmtime, join, basename, dirname, splitext, realpath, relpath
+from typing import List
+
+class ReportGeneratorFromPythonFileWithCells :      
+    cacheDirectoryName = ".sppcache"
+    kernelPool = None # set with UseWarmKernels
+
+    @staticmethod
+    def WriteIpynbToDesiredFormatWithPandoc(pythonFilePath, outputFilePath = None, extension = "pdf", sources = None, csl=None, keepDirectoryClean = True, incremental = False, intermediateDirectory = None) :
+        """
+        Converts the python file to a notebook, executes it, and converts the results to the desired format with pandoc.
+        extension can also be a list of formats, in which case the notebook is executed once and pandoc is run for 
+        all of them at the same time (see RunPandocForFormats).
+
+        When incremental is True, the executed output of each cell is cached (see NotebookCellCache) 
+        in a .sppcache folder next to the script, and only the cells from the first changed cell 
+        onward are executed again.
+
+        The intermediate notebook and markdown files are written next to the script unless an 
+        intermediateDirectory is given (the cells are still run from the folder of the script).  In that 
+        case it is the intermediateDirectory that is kept clean, so builds of scripts in the same folder 
+        don't remove each other's files.
+        """
+        outputFilePaths = ReportGeneratorFromPythonFileWithCells.GetOutputFilePaths(pythonFilePath, outputFilePath, extension)
+        directory = dirname(pythonFilePath)
+        if intermediateDirectory == None :
+            intermediateDirectory = directory
+        ipynbFile = join(intermediateDirectory, basename(pythonFilePath).replace(".py", ".ipynb"))
+        mdFileName = join(intermediateDirectory, basename(pythonFilePath).replace(".py", ".md"))
+        (sources, csl) = ReportGeneratorFromPythonFileWithCells.FindSourcesAndCsl(directory, sources, csl)
+
+        excludedDirectories = [".git", ReportGeneratorFromPythonFileWithCells.cacheDirectoryName]
+        with spp.recordStage("build", script=pythonFilePath), CleanDirectoryScope(intermediateDirectory, [basename(f) for f in outputFilePaths], keepDirectoryClean, excludedDirectories) :
+            if not ScopeIfFileDoesNotExist.isFileControlledByScope(pythonFilePath.replace(".py", ".ipynb")) and not spp.DocumentCapture.isCapturing(pythonFilePath) :
+                figureFormat = ReportGeneratorFromPythonFileWithCells.GetFigureFormat(outputFilePaths)
+                with spp.recordStage("convert to notebook") :
+                    ReportGeneratorFromPythonFileWithCells.ConvertPythonToJupyter(pythonFilePath, ipynbFile=ipynbFile)
+                    ReportGeneratorFromPythonFileWithCells._SetFigureFormatInFirstCell(ipynbFile, figureFormat)
+                if incremental :
+                    cacheDirectory = ReportGeneratorFromPythonFileWithCells.GetCacheDirectory(pythonFilePath)
+                    ReportGeneratorFromPythonFileWithCells.ExecuteNotebookIncrementally(ipynbFile, cacheDirectory, directory)
+                ReportGeneratorFromPythonFileWithCells.ConvertNotebookToMarkdown(ipynbFile, not incremental, directory)
+                figureFiles = ReportGeneratorFromPythonFileWithCells.MoveFiguresToCache(mdFileName, pythonFilePath, figureFormat)
+                ReportGeneratorFromPythonFileWithCells.RunPandocForFormats(mdFileName, outputFilePaths, directory, sources, csl)
+                ReportGeneratorFromPythonFileWithCells.CollectUnusedFigures(ReportGeneratorFromPythonFileWithCells.GetFigureDirectory(pythonFilePath), figureFiles)
+
+    @staticmethod
+    def WriteDirectlyToDesiredFormatWithPandoc(pythonFilePath, outputFilePath = None, extension = "pdf", sources = None, csl=None, keepDirectoryClean = True, vectorFigures = False) :
+        """
+        Like WriteIpynbToDesiredFormatWithPandoc, but instead of going through a notebook, the script is run 
+        in this process and what it shows with printMarkdown and showEquation (and its matplotlib figures) 
+        is captured straight into the markdown that is handed to pandoc (see CaptureScriptToMarkdown).
+        With vectorFigures, figures are saved as pdf files if every output is a pdf or LaTeX file (and svg if every output is html).
+        """
+        outputFilePaths = ReportGeneratorFromPythonFileWithCells.GetOutputFilePaths(pythonFilePath, outputFilePath, extension)
+        directory = dirname(pythonFilePath)
+        mdFileName = pythonFilePath.replace(".py", ".md")
+        (sources, csl) = ReportGeneratorFromPythonFileWithCells.FindSourcesAndCsl(directory, sources, csl)
+        excludedDirectories = [".git", ReportGeneratorFromPythonFileWithCells.cacheDirectoryName]
+        with spp.recordStage("build", script=pythonFilePath), CleanDirectoryScope(directory, [basename(f) for f in outputFilePaths], keepDirectoryClean, excludedDirectories) :
+            if not spp.DocumentCapture.isCapturing(pythonFilePath) :
+                figureFormat = "png"
+                if vectorFigures and all(f.endswith(".html") for f in outputFilePaths) :
+                    figureFormat = "svg"
+                elif vectorFigures :
+                    figureFormat = ReportGeneratorFromPythonFileWithCells.GetFigureFormat(outputFilePaths)
+                ReportGeneratorFromPythonFileWithCells.CaptureScriptToMarkdown(pythonFilePath, mdFileName, figureFormat)
+                ReportGeneratorFromPythonFileWithCells.RunPandocForFormats(mdFileName, outputFilePaths, directory, sources, csl)
+
+    @staticmethod
+    def GetOutputFilePaths(pythonFilePath, outputFilePath = None, extension = "pdf") -> List[str] :
+        """
+        The files a build writes.  extension is one format or a list of them.  With a list, outputFilePath 
+        (if given) is the path the outputs are named after, with each extension in place of its own.
+        """
+        if isinstance(extension, str) :
+            if outputFilePath == None :
+                outputFilePath = pythonFilePath.replace(".py", "."+extension)
+            return [outputFilePath]
+        if outputFilePath == None :
+            outputFilePath = pythonFilePath
+        return [splitext(outputFilePath)[0] + "." + e for e in extension]
+
+    @staticmethod
+    def GetFigureFormat(outputFilePaths : List[str]) -> str :
+        """
+        The format of the figures for the outputs: pdf (so they stay vector images) if every output is a pdf or 
+        LaTeX file, and png otherwise.
+        """
+        if all(splitext(f)[1] in (".pdf", ".tex", ".latex") for f in outputFilePaths) :
+            return "pdf"
+        return "png"
+
+    @staticmethod
+    def CaptureScriptToMarkdown(pythonFilePath, mdFileName = None, figureFormat = "png") -> str :
+        """
+        Runs the script (as __main__, from its own folder) with a DocumentCapture active and writes the 
+        captured markdown to mdFileName (defaulting to next to the script).  Figures go in the figure 
+        folder of the script (see GetFigureDirectory).
+
+        Returns:
+            str: The markdown file that was written
+        """
+        if mdFileName == None :
+            mdFileName = splitext(pythonFilePath)[0] + ".md"
+        pythonFilePath = realpath(pythonFilePath)
+        directory = dirname(pythonFilePath)
+        figureDirectory = ReportGeneratorFromPythonFileWithCells.GetFigureDirectory(pythonFilePath)
+        figureLink = relpath(figureDirectory, dirname(realpath(mdFileName))).replace(sep, "/")
+        originalDirectory = getcwd()
+        originalPath = list(sys.path)
+        originalArgv = sys.argv
+        spp.DocumentCapture.capturedScripts.append(pythonFilePath)
+        try :
+            chdir(directory)
+            sys.path.insert(0, directory)
+            sys.argv = [pythonFilePath]
+            with spp.recordStage("capture"), spp.DocumentCapture(figureDirectory, figureFormat, figureLink) as capture :
+                runpy.run_path(pythonFilePath, run_name="__main__")
+        finally :
+            spp.DocumentCapture.capturedScripts.remove(pythonFilePath)
+            sys.argv = originalArgv
+            sys.path[:] = originalPath
+            chdir(originalDirectory)
+        with open(mdFileName, "w", encoding="utf-8") as f :
+            f.write(capture.getMarkdown())
+        ReportGeneratorFromPythonFileWithCells.CollectUnusedFigures(figureDirectory, capture.figureFiles)
+        return mdFileName
+
+    @staticmethod
+    def GetFigureDirectory(pythonFilePath) -> str :
+        """
+        The folder the figures of the script's reports are kept in, named by their content (in the .sppcache 
+        folder, which CleanDirectoryScope is told to leave alone, so they last from one build to the next).
+        """
+        return join(ReportGeneratorFromPythonFileWithCells.GetCacheDirectory(pythonFilePath), "figures")
+
+    @staticmethod
+    def MoveFiguresToCache(mdFileName, pythonFilePath, figureFormat = "png") -> List[str] :
+        """
+        Moves the images that nbconvert wrote next to the markdown (in the <notebook>_files folder) into the 
+        figure folder of the script (see GetFigureDirectory), where a figure that is already there isn't written 
+        again, and points the markdown at them (relative to the script's folder, which is on pandoc's resource path).  
+        Links to any other file (like an image of the user's linked from a markdown cell) are left alone.
+
+        nbconvert's markdown never links a pdf output, so when figureFormat isn't png, a linked image that 
+        nbconvert also wrote in that format (see _SetFigureFormatInFirstCell) is replaced by that version.
+
+        Returns:
+            List[str]: The figure files the markdown uses
+        """
+        import re
+        markdownDirectory = dirname(realpath(mdFileName))
+        figureDirectory = ReportGeneratorFromPythonFileWithCells.GetFigureDirectory(pythonFilePath)
+        figureLink = relpath(figureDirectory, dirname(realpath(pythonFilePath))).replace(sep, "/")
+        outputFilesDirectory = splitext(basename(mdFileName))[0] + "_files"
+        figureFiles = []
+
+        def moveFigure(match) :
+            linkParts = match.group(2).split("/")
+            if len(linkParts) != 2 or linkParts[0] != outputFilesDirectory or linkParts[1] in ("", ".", "..") :
+                return match.group(0)
+            imageFile = join(markdownDirectory, outputFilesDirectory, linkParts[1])
+            if not isfile(imageFile) :
+                return match.group(0)
+            formatFile = splitext(imageFile)[0] + "." + figureFormat
+            if formatFile != imageFile and isfile(formatFile) :
+                remove(imageFile)
+                imageFile = formatFile
+            with open(imageFile, "rb") as f :
+                figureName = spp.writeContentAddressedFile(figureDirectory, f.read(), splitext(imageFile)[1][1:])
+            remove(imageFile)
+            figureFiles.append(join(figureDirectory, figureName))
+            return "![" + match.group(1) + "](" + figureLink + "/" + figureName + ")"
+        with open(mdFileName, "r", encoding="utf-8") as f :
+            markdown = f.read()
+        markdown = re.sub(r"!\[([^\]]*)\]\(([^)\s]+)\)", moveFigure, markdown)
+        with open(mdFileName, "w", encoding="utf-8") as f :
+            f.write(markdown)
+        return figureFiles
+
+    @staticmethod
+    def CollectUnusedFigures(figureDirectory, usedFigureFiles : List[str]) -> None :
+        """
+        Deletes the figures in figureDirectory that the last build didn't use (so the folder doesn't keep every version of every figure).
+        """
+        if not isdir(figureDirectory) :
+            return
+        used = {realpath(f) for f in usedFigureFiles}
+        with scandir(figureDirectory) as entries :
+            for entry in entries :
+                if entry.is_file() and realpath(entry.path) not in used :
+                    remove(entry.path)
+
+    @staticmethod
+    def FindSourcesAndCsl(directory, sources = None, csl = None) :
+        """
+        Fills in the bibliography and csl file (if they weren't given) with the first .bib and .csl file in the directory.
+        Either is left as None if there isn't one.
+        """
+        if sources == None or csl == None:
+            files = [f for f in listdir(directory) if isfile(join(directory, f))]
+            if sources == None :
+                for file in files :
+                    if file.endswith("bib") :
+                        sources = file
+                        break
+
+            if csl == None :
+                for file in files :
+                    if file.endswith("csl") :
+                        csl = file
+                        break
+        return (sources, csl)
+
+    @staticmethod
+    def RunPandoc(mdFileName, outputFilePath, directory, sources, csl) :
+        """
+        Runs pandoc (from the folder of the markdown file, with the script's directory also on the resource path) 
+        to convert the markdown to the output file, using the bibliography and csl file in directory 
+        (citations are only processed if there is a bibliography).
+        """
+        pandocCommand = ReportGeneratorFromPythonFileWithCells.PandocCommand(mdFileName, outputFilePath, directory, sources, csl)
+        with spp.recordStage("pandoc", outputFile=outputFilePath) :
+            result = ReportGeneratorFromPythonFileWithCells.runCommandPrintingOutput(pandocCommand, dirname(mdFileName))
+        if not isfile(outputFilePath) :
+            if len(result.stderr.strip()) > 0 :
+                raise Exception("File was not created sucessfully: " + result.stderr.strip())
+            raise Exception("File was not created sucessfully")
+
+    @staticmethod
+    def PandocCommand(mdFileName, outputFilePath, directory, sources, csl) -> List[str] :
+        """
+        The pandoc command that RunPandoc runs (from the folder of the markdown file).
+        """
+        markdownDirectory = dirname(mdFileName)
+        resourcePath = markdownDirectory if realpath(markdownDirectory) == realpath(directory) else markdownDirectory + pathsep + directory
+        pandocCommand = ["pandoc", mdFileName, "-s", "-N", "-o", outputFilePath, "--resource-path=" + resourcePath]
+        if sources != None :
+            pandocCommand.extend(["--citeproc", "--bibliography=" + join(directory, sources)])
+        if csl != None :
+            pandocCommand.append("--csl=" + join(directory, csl))
+        return pandocCommand
+
+    @staticmethod
+    def RunPandocForFormats(mdFileName, outputFilePaths : List[str], directory, sources, csl) -> None :
+        """
+        Runs pandoc (see RunPandoc) for each of the output files at the same time, since they all read the 
+        same markdown.  Every format is attempted, and if any fail, the exception raised lists the error of each one.  
+        An output file that is the markdown file itself (a md report made next to the script) is written under 
+        another name and only replaces the markdown once every format has been made from it.
+        """
+        pandocOutputPaths = [join(dirname(outputFilePath), "spp-pandoc-" + basename(outputFilePath)) if realpath(outputFilePath) == realpath(mdFileName) else outputFilePath for outputFilePath in outputFilePaths]
+        def runPandoc(pandocOutputPath) :
+            try :
+                ReportGeneratorFromPythonFileWithCells.RunPandoc(mdFileName, pandocOutputPath, directory, sources, csl)
+                return None
+            except Exception as error :
+                return error
+        if len(outputFilePaths) == 1 :
+            results = [runPandoc(pandocOutputPaths[0])]
+        else :
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(len(outputFilePaths)) as pool :
+                results = list(pool.map(runPandoc, pandocOutputPaths))
+        for (outputFilePath, pandocOutputPath) in zip(outputFilePaths, pandocOutputPaths) :
+            if pandocOutputPath != outputFilePath and isfile(pandocOutputPath) :
+                replace(pandocOutputPath, outputFilePath)
+        errors = [(outputFilePath, error) for (outputFilePath, error) in zip(outputFilePaths, results) if error != None]
+        if len(outputFilePaths) == 1 and len(errors) == 1 :
+            raise errors[0][1]
+        if len(errors) > 0 :
+            raise Exception("pandoc failed for {} of {} formats:\n".format(len(errors), len(outputFilePaths)) + "\n".join(basename(outputFilePath) + ": " + str(error) for (outputFilePath, error) in errors))
+
+    @staticmethod
+    def GetCacheDirectory(pythonFilePath) -> str :
+        """
+        The folder (next to the script) that incremental builds of the script cache their cells in.
+        """
+        scriptName = splitext(basename(pythonFilePath))[0]
+        return join(dirname(pythonFilePath), ReportGeneratorFromPythonFileWithCells.cacheDirectoryName, scriptName)
+
+    @staticmethod
+    def WatchAndRebuild(pythonFilePath, extension = "pdf", sources = None, csl = None, **kwargs) -> None :
+        """
+        Makes the report, and makes it again every time the script, bibliography or csl file is saved, 
+        until interrupted (see ReportWatcher, which the keyword arguments are passed to).
+        """
+        ReportWatcher(pythonFilePath, extension, sources, csl, **kwargs).watch()
+
+    @staticmethod
+    def UseWarmKernels(size : int = 1, preloadModules : List[str] = None, cellTimeout : float = 1800) -> "WarmKernelPool" :
+        """
+        Starts a pool of warm kernels that notebooks will be executed in (in-process with nbclient) 
+        instead of starting a new kernel with jupyter nbconvert for every report.  Call StopWarmKernels 
+        when done with them.  A cell that runs for longer than cellTimeout seconds fails its report.  
+        This needs nbclient and jupyter_client, and nbconvert (which converts the executed notebooks to markdown 
+        in-process); an ImportError is raised if any of them is missing.
+        """
+        import importlib.util
+        if importlib.util.find_spec("nbconvert") == None :
+            raise ImportError("nbconvert is needed to convert the notebooks the warm kernels execute", name="nbconvert")
+        ReportGeneratorFromPythonFileWithCells.StopWarmKernels()
+        ReportGeneratorFromPythonFileWithCells.kernelPool = WarmKernelPool(size, preloadModules, cellTimeout=cellTimeout)
+        return ReportGeneratorFromPythonFileWithCells.kernelPool
+
+    @staticmethod
+    def StopWarmKernels() -> None :
+        if ReportGeneratorFromPythonFileWithCells.kernelPool != None :
+            ReportGeneratorFromPythonFileWithCells.kernelPool.shutdown()
+            ReportGeneratorFromPythonFileWithCells.kernelPool = None
+
+    @staticmethod
+    def WriteManyIpynbToDesiredFormatWithPandoc(pythonFilePaths : List[str], **kwargs) -> List["ReportBuildResult"] :
+        """
+        Makes the report for each of the python files (the keyword arguments are passed to 
+        WriteIpynbToDesiredFormatWithPandoc), executing them in warm kernels.  The reports are made in 
+        threads, one for each kernel of the pool, so a pool of size n runs n notebooks at once.  If 
+        UseWarmKernels hasn't been called, a single kernel is started for the batch and stopped at the end.
+
+        When more than one report is made at once, each one works in its own temporary folder (in the 
+        intermediateDirectory if one is given) so builds of scripts in the same folder don't clean up 
+        each other's files.
+
+        Returns:
+            List[ReportBuildResult]: The result of each build, in the same order as the scripts (like WriteReportsInParallel)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        ownsPool = ReportGeneratorFromPythonFileWithCells.kernelPool == None
+        if ownsPool :
+            ReportGeneratorFromPythonFileWithCells.UseWarmKernels()
+        workers = max(1, min(len(ReportGeneratorFromPythonFileWithCells.kernelPool.kernelManagers), len(pythonFilePaths)))
+        try :
+            with ThreadPoolExecutor(workers) as executor :
+                results = list(executor.map(lambda pythonFilePath : _writeReportForBatch(pythonFilePath, kwargs, workers > 1), pythonFilePaths))
+        finally :
+            if ownsPool :
+                ReportGeneratorFromPythonFileWithCells.StopWarmKernels()
+        return results
+
+    @staticmethod
+    def FindReportScripts(rootDirectory, pattern = "*.py") -> List[str] :
+        """
+        Finds the python files under rootDirectory (skipping hidden folders) that match the pattern and have #%% cells.
+        """
+        scripts = []
+        for (dirpath, dirnames, filenames) in walk(rootDirectory) :
+            dirnames[:] = sorted(dir for dir in dirnames if not dir.startswith("."))
+            for file in sorted(fnmatch.filter(filenames, pattern)) :
+                with open(join(dirpath, file), "r", encoding="utf-8", errors="ignore") as f :
+                    if any(line.lstrip().startswith("#") and line.lstrip()[1:].lstrip().startswith("%%") for line in f) :
+                        scripts.append(join(dirpath, file))
+        return scripts
+
+    @staticmethod
+    def WriteReportsInParallel(pythonFilePaths, maxWorkers : int = None, **kwargs) -> List["ReportBuildResult"] :
+        """
+        Makes the reports for many scripts at once in a pool of processes (one per core by default).  Each 
+        build writes its intermediate files to its own temporary folder (in the intermediateDirectory if one 
+        is given) so that builds of scripts in the same folder can't clean up each other's files.  A summary 
+        of which reports succeeded is printed at the end.
+
+        The processes are started fresh rather than forked (see cleanMatrix), with the environment and working 
+        directory of this process, so a script that calls this needs an if __name__ == "__main__" guard.
+
+        Args:
+            pythonFilePaths: The scripts to build, or a folder to find them in (see FindReportScripts)
+            maxWorkers (int, optional): The number of processes. Defaults to None which is the number of cores.
+            kwargs: Passed on to WriteIpynbToDesiredFormatWithPandoc
+
+        Returns:
+            List[ReportBuildResult]: The result of each build, in the same order as the scripts
+        """
+        if isinstance(pythonFilePaths, str) :
+            pythonFilePaths = ReportGeneratorFromPythonFileWithCells.FindReportScripts(pythonFilePaths)
+        if maxWorkers == None :
+            maxWorkers = cpu_count() or 1
+        maxWorkers = max(1, min(maxWorkers, len(pythonFilePaths)))
+        with ProcessPoolExecutor(max_workers=maxWorkers, mp_context=spp._processPoolContext(), initializer=_initializeReportWorker, initargs=(dict(environ), getcwd())) as executor :
+            futures = [executor.submit(_writeReportForBatch, pythonFilePath, kwargs) for pythonFilePath in pythonFilePaths]
+            results = [future.result() for future in futures]
+        for result in results :
+            print(result)
+        print(str(sum(1 for result in results if result.succeeded)) + " of " + str(len(results)) + " reports were made sucessfully")
+        return results
+
+    @staticmethod
+    def ExecuteNotebook(ipynbFile, executedIpynbFile, workingDirectory = None) :
+        """
+        Executes the notebook and writes it (with its outputs) to executedIpynbFile.  This uses 
+        the warm kernels if there are some, and jupyter nbconvert otherwise.  Cells are run from 
+        workingDirectory, which defaults to the folder of the notebook.
+        """
+        if workingDirectory == None :
+            workingDirectory = dirname(realpath(ipynbFile))
+        cellPeaksFile = None
+        if spp.performanceRecorder != None and spp.performanceRecorder.traceMemory :
+            (handle, cellPeaksFile) = tempfile.mkstemp(prefix="spp-", suffix=".jsonl")
+            close(handle)
+            ReportGeneratorFromPythonFileWithCells._TraceCellMemoryInFirstCell(ipynbFile, cellPeaksFile)
+        with spp.recordStage("execute") :
+            if ReportGeneratorFromPythonFileWithCells.kernelPool != None :
+                with open(ipynbFile, "r", encoding="utf-8") as f :
+                    notebook = json.load(f)
+                notebook = ReportGeneratorFromPythonFileWithCells.kernelPool.executeNotebook(notebook, workingDirectory)
+                with open(executedIpynbFile, "w", encoding="utf-8") as f :
+                    json.dump(notebook, f)
+            else :
+                ReportGeneratorFromPythonFileWithCells._ChangeDirectoryInFirstCell(ipynbFile, workingDirectory)
+                executedName = splitext(basename(executedIpynbFile))[0]
+                command = ["jupyter", "nbconvert", "--execute", "--to", "notebook", "--output", executedName, "--output-dir", dirname(realpath(executedIpynbFile)), ipynbFile]
+                ReportGeneratorFromPythonFileWithCells.runCommandPrintingOutput(command, workingDirectory)
+        cellPeaks = None
+        if cellPeaksFile != None and isfile(cellPeaksFile) :
+            with open(cellPeaksFile, "r", encoding="utf-8") as f :
+                cellPeaks = {peak["executionCount"] : peak["peakMemoryBytes"] for peak in map(json.loads, f)}
+            remove(cellPeaksFile)
+        if spp.performanceRecorder != None and isfile(executedIpynbFile) :
+            with open(executedIpynbFile, "r", encoding="utf-8") as f :
+                spp.performanceRecorder.recordCells("execute", json.load(f)["cells"], cellPeaks)
+
+    @staticmethod
+    def _ChangeDirectoryInFirstCell(ipynbFile, workingDirectory) :
+        # jupyter nbconvert always runs the notebook from its own folder, so if that isn't 
+        # where the cells should run, start the notebook with a cell that moves there
+        if realpath(workingDirectory) == dirname(realpath(ipynbFile)) :
+            return
+        with open(ipynbFile, "r", encoding="utf-8") as f :
+            notebook = json.load(f)
+        source = "__import__('os').chdir(" + repr(realpath(workingDirectory)) + ")"
+        notebook["cells"].insert(0, {"cell_type" : "code", "execution_count" : None, "metadata" : {"sppInternal" : True}, "outputs" : [], "source" : source})
+        with open(ipynbFile, "w", encoding="utf-8") as f :
+            json.dump(notebook, f, indent=1)
+
+    @staticmethod
+    def _TraceCellMemoryInFirstCell(ipynbFile, cellPeaksFile) :
+        # start the notebook with a cell that has the kernel write the peak memory of each cell after it to 
+        # cellPeaksFile (the kernel is another process, so the recorder's own tracing doesn't see the cells)
+        with open(ipynbFile, "r", encoding="utf-8") as f :
+            notebook = json.load(f)
+        source = _cellMemoryStartSource.replace("{moduleSource}", repr(_cellMemoryModuleSource)).replace("{fileName}", repr(cellPeaksFile))
+        notebook["cells"].insert(0, {"cell_type" : "code", "execution_count" : None, "metadata" : {"sppInternal" : True}, "outputs" : [], "source" : source})
+        with open(ipynbFile, "w", encoding="utf-8") as f :
+            json.dump(notebook, f, indent=1)
+
+    @staticmethod
+    def _SetFigureFormatInFirstCell(ipynbFile, figureFormat) :
+        # start the notebook with a cell that has matplotlib also show its figures in figureFormat (as well as 
+        # png, since that is the one nbconvert links in the markdown, see MoveFiguresToCache)
+        if figureFormat == "png" :
+            return
+        with open(ipynbFile, "r", encoding="utf-8") as f :
+            notebook = json.load(f)
+        source = "%config InlineBackend.figure_formats = " + repr(["png", figureFormat])
+        notebook["cells"].insert(0, {"cell_type" : "code", "execution_count" : None, "metadata" : {"sppInternal" : True}, "outputs" : [], "source" : source})
+        with open(ipynbFile, "w", encoding="utf-8") as f :
+            json.dump(notebook, f, indent=1)
+
+    @staticmethod
+    def ConvertNotebookToMarkdown(ipynbFile, execute = True, workingDirectory = None) :
+        """
+        Converts the notebook to markdown (next to the notebook, without the code), executing it first if requested.  
+        With warm kernels the execution and the conversion are done in-process, otherwise jupyter nbconvert is run 
+        (once: when the time each cell takes is recorded, nbconvert only executes the notebook and the conversion 
+        is done in-process).
+        """
+        import importlib.util
+        if workingDirectory == None :
+            workingDirectory = dirname(realpath(ipynbFile))
+        convertInProcess = ReportGeneratorFromPythonFileWithCells.kernelPool != None
+        if execute and (convertInProcess or (spp.performanceRecorder != None and importlib.util.find_spec("nbconvert") != None)) :
+            # executing separately keeps the executed notebook around (with the time each cell took)
+            ReportGeneratorFromPythonFileWithCells.ExecuteNotebook(ipynbFile, ipynbFile, workingDirectory)
+            execute = False
+            convertInProcess = True
+
+        with spp.recordStage("markdown") :
+            if not convertInProcess :
+                command = ["jupyter", "nbconvert", "--to", "markdown", "--no-input", ipynbFile]
+                if execute :
+                    ReportGeneratorFromPythonFileWithCells._ChangeDirectoryInFirstCell(ipynbFile, workingDirectory)
+                    command.insert(2, "--execute")
+                ReportGeneratorFromPythonFileWithCells.runCommandPrintingOutput(command, workingDirectory)
+                return
+
+            import nbformat
+            from nbconvert import MarkdownExporter
+            from nbconvert.writers import FilesWriter
+            with open(ipynbFile, "r", encoding="utf-8") as f :
+                notebook = json.load(f)
+            notebookName = splitext(basename(ipynbFile))[0]
+            exporter = MarkdownExporter()
+            exporter.exclude_input = True
+            (body, resources) = exporter.from_notebook_node(nbformat.reads(json.dumps(notebook), as_version=4), resources={"output_files_dir" : notebookName + "_files", "unique_key" : notebookName})
+            FilesWriter(build_directory=dirname(realpath(ipynbFile))).write(body, resources, notebook_name=notebookName)
+
+    @staticmethod
+    def ExecuteNotebookIncrementally(ipynbFile, cacheDirectory, workingDirectory = None) :
+        """
+        Executes the code cells of the notebook from the first cell that changed since the last 
+        incremental build, and writes the notebook back out with the outputs of every code cell 
+        filled in (the cells before the changed one come from the cache).  Cells are run from 
+        workingDirectory, which defaults to the folder of the notebook.
+        """
+        if workingDirectory == None :
+            workingDirectory = dirname(realpath(ipynbFile))
+        with open(ipynbFile, "r", encoding="utf-8") as f :
+            notebook = json.load(f)
+        codeCells = [cell for cell in notebook["cells"] if cell["cell_type"] == "code"]
+        cache = NotebookCellCache(cacheDirectory)
+        hashes = NotebookCellCache.hashCells(codeCells)
+        firstCellToRun = cache.resumePoint(hashes)
+
+        if firstCellToRun < len(codeCells) :
+            executionNotebook = dict(notebook)
+            executionNotebook["cells"] = cache.makeExecutionCells(codeCells, hashes, firstCellToRun, realpath(workingDirectory))
+            executionFile = join(cacheDirectory, "execution.ipynb")
+            with open(executionFile, "w", encoding="utf-8") as f :
+                json.dump(executionNotebook, f)
+            executedFile = join(cacheDirectory, "executed.ipynb")
+            if isfile(executedFile) :
+                remove(executedFile)
+            ReportGeneratorFromPythonFileWithCells.ExecuteNotebook(executionFile, executedFile, workingDirectory)
+            if not isfile(executedFile) :
+                raise Exception("Notebook " + ipynbFile + " was not executed sucessfully")
+            with open(executedFile, "r", encoding="utf-8") as f :
+                executedCells = json.load(f)["cells"]
+            cache.storeExecutedCells(executedCells, hashes)
+            remove(executionFile)
+            remove(executedFile)
+
+        cache.fillOutputs(codeCells)
+        cache.save(hashes)
+        with open(ipynbFile, "w", encoding="utf-8") as f :
+            json.dump(notebook, f, indent=1)
+
+    @staticmethod
+    def RemoveSinglePercentLinesFromFile(filePath) :
+        """
+        Removes the lines that are just a % from the file.  p2j left one in the markdown for each #%% cell 
+        of the script, but the notebooks are no longer made with p2j, so the builds don't need this any more.
+        """
+        import warnings
+        warnings.warn("RemoveSinglePercentLinesFromFile is no longer needed, ConvertPythonToJupyter doesn't leave % lines behind", DeprecationWarning, stacklevel=2)
+        with open(filePath, "r") as f:
+            lines = f.readlines()
+        with open(filePath, "w") as f:
+            for line in lines:
+                if line.strip("\n") != "%":
+                    f.write(line)
+
+    @staticmethod
+    def ConvertPythonToJupyter(pythonFileToConvert, workingDirectory = None, *, ipynbFile = None) :
+        """
+        Converts a python file with #%% cells to a notebook with a code cell for each of the cells 
+        (including the code before the first #%%, if there is any).  Comment lines are left in the 
+        code, unlike p2j which turned them into markdown cells.
+
+        Args:
+            pythonFileToConvert (str): The python file to convert
+            workingDirectory (str, optional): Where p2j used to be run from.  Nothing is run any more, so it is ignored.
+            ipynbFile (str, optional): The notebook to write. Defaults to None which will put it next to the python file.
+
+        Returns:
+            str: The notebook that was written
+        """
+        if ipynbFile == None :
+            ipynbFile = splitext(pythonFileToConvert)[0] + ".ipynb"
+        cells = []
+        lines = []
+        def addCell() :
+            while len(lines) > 0 and lines[-1].strip() == "" :
+                lines.pop()
+            if len(lines) > 0 :
+                lines[-1] = lines[-1].rstrip("\n")
+                cells.append({"cell_type" : "code", "execution_count" : None, "metadata" : {}, "outputs" : [], "source" : list(lines)})
+            lines.clear()
+
+        with open(pythonFileToConvert, "r", encoding="utf-8") as f :
+            for line in f :
+                if line.lstrip().startswith("#") and line.lstrip()[1:].lstrip().startswith("%%") :
+                    addCell()
+                elif len(lines) > 0 or line.strip() != "" :
+                    lines.append(line)
+        addCell()
+
+        notebook = {"cells" : cells, 
+                    "metadata" : {"kernelspec" : {"display_name" : "Python 3", "language" : "python", "name" : "python3"},
+                                  "language_info" : {"name" : "python"}},
+                    "nbformat" : 4, 
+                    "nbformat_minor" : 4}
+        with open(ipynbFile, "w", encoding="utf-8") as f :
+            json.dump(notebook, f, indent=1)
+        return ipynbFile
+
+    @staticmethod
+    def runCommandPrintingOutput(command, workingDirectory = None) :
+        if workingDirectory == None :
+            workingDirectory = dirname(dirname(realpath(__file__)))
+        commandName = command if isinstance(command, str) else basename(command[0])
+        with spp.recordStage("command " + commandName) as stage :
+            childMaxRssBefore = _childMaxRssKilobytes()
+            result = subprocess.run(command, capture_output=True, text=True, cwd=workingDirectory)
+            childMaxRss = _childMaxRssKilobytes()
+            stage.record["returncode"] = result.returncode
+            stage.record["stdout"] = result.stdout[-2000:]
+            stage.record["stderr"] = result.stderr[-2000:]
+            if childMaxRss != None and childMaxRss > childMaxRssBefore :
+                stage.record["childMaxRssKilobytes"] = childMaxRss
+        if(len(result.stderr.strip()) > 0):
+            print(result.stderr)
+            print(result.stdout)            
+        return result
+
+def _childMaxRssKilobytes() :
+    # the largest resident memory of any finished child process so far (kilobytes on Linux, bytes on macOS), None on Windows
+    try :
+        import resource
+    except ImportError :
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+class ReportBuildResult :
+    """
+    The outcome of building one report with WriteReportsInParallel.
+    """
+    def __init__(self, pythonFilePath : str, seconds : float, error : str = None) :
+        self.pythonFilePath = pythonFilePath
+        self.seconds = seconds
+        self.error = error # the formatted traceback if the build failed
+
+    @property
+    def succeeded(self) -> bool :
+        return self.error == None
+
+    def __str__(self) -> str :
+        status = "succeeded" if self.succeeded else "FAILED"
+        text = self.pythonFilePath + " " + status + " in " + "{:.1f}".format(self.seconds) + " seconds"
+        if not self.succeeded :
+            text += "\n" + self.error
+        return text
+
+def _initializeReportWorker(environment : dict, workingDirectory : str) -> None :
+    # workers started by a forkserver have its environment and folder, not those of the process that wants the reports
+    environ.clear()
+    environ.update(environment)
+    chdir(workingDirectory)
+
+def _writeReportForBatch(pythonFilePath : str, kwargs : dict, useScratchDirectory : bool = True) -> ReportBuildResult :
+    # the work done for each script of WriteReportsInParallel (in a process, so it needs to be a module level 
+    # function to be pickled) and WriteManyIpynbToDesiredFormatWithPandoc
+    start = time.perf_counter()
+    kwargs = dict(kwargs)
+    scratchDirectory = None
+    if useScratchDirectory :
+        scratchDirectory = tempfile.mkdtemp(prefix="spp-", dir=kwargs.pop("intermediateDirectory", None))
+        kwargs["intermediateDirectory"] = scratchDirectory
+    try :
+        ReportGeneratorFromPythonFileWithCells.WriteIpynbToDesiredFormatWithPandoc(pythonFilePath, **kwargs)
+        return ReportBuildResult(pythonFilePath, time.perf_counter() - start)
+    except Exception :
+        return ReportBuildResult(pythonFilePath, time.perf_counter() - start, traceback.format_exc())
+    finally :
+        if scratchDirectory != None :
+            shutil.rmtree(scratchDirectory, ignore_errors=True)
+
+class AsyncReportGenerator :
+    """
+    Makes reports like ReportGeneratorFromPythonFileWithCells.WriteIpynbToDesiredFormatWithPandoc, but with 
+    asyncio subprocesses so that a service can run many builds from one event loop, and a build can't stall forever.
+
+    - stageTimeouts maps a stage ("execute" or "pandoc") to the seconds it may take (defaultTimeout for the 
+      stages that aren't in it, None for no limit).  A stage that runs over is killed and the build fails.
+    - At most maxConcurrentBuilds builds run at once, the rest wait their turn.
+    - The output of the commands is read as it is written and handed line by line to outputCallback(pythonFilePath, stage, line) 
+      (only the last lines are kept, for the error message if a command fails).
+    - Each build works in its own temporary folder, which is removed when the build finishes, fails or is cancelled, 
+      and the output files are only moved next to the script once pandoc has finished writing them.  Cancelling a 
+      build kills the commands it is running along with their children (like the kernel jupyter started), except 
+      on Windows where only the command itself is killed.
+    """
+    def __init__(self, maxConcurrentBuilds : int = 2, stageTimeouts : dict = None, defaultTimeout : float = None, outputCallback = None) :
+        self.maxConcurrentBuilds = maxConcurrentBuilds
+        self.stageTimeouts = stageTimeouts if stageTimeouts != None else {}
+        self.defaultTimeout = defaultTimeout
+        self.outputCallback = outputCallback
+        self._semaphore = None
+        self._semaphoreLoop = None
+
+    def _getSemaphore(self) -> asyncio.Semaphore :
+        # made for the event loop the builds run on (a semaphore can't be shared between loops)
+        loop = asyncio.get_running_loop()
+        if self._semaphoreLoop != loop :
+            self._semaphore = asyncio.Semaphore(self.maxConcurrentBuilds)
+            self._semaphoreLoop = loop
+        return self._semaphore
+
+    async def writeReport(self, pythonFilePath, outputFilePath = None, extension = "pdf", sources = None, csl = None) -> List[str] :
+        """
+        Executes the script as a notebook and runs pandoc for each format (at the same time) on the result.  Raises 
+        an exception if a stage fails or runs over its timeout.
+
+        Returns:
+            List[str]: The output files
+        """
+        async with self._getSemaphore() :
+            pythonFilePath = realpath(pythonFilePath)
+            directory = dirname(pythonFilePath)
+            outputFilePaths = ReportGeneratorFromPythonFileWithCells.GetOutputFilePaths(pythonFilePath, outputFilePath, extension)
+            (sources, csl) = ReportGeneratorFromPythonFileWithCells.FindSourcesAndCsl(directory, sources, csl)
+            scratchDirectory = tempfile.mkdtemp(prefix="spp-")
+            try :
+                ipynbFile = join(scratchDirectory, basename(pythonFilePath).replace(".py", ".ipynb"))
+                mdFileName = join(scratchDirectory, basename(pythonFilePath).replace(".py", ".md"))
+                figureFormat = ReportGeneratorFromPythonFileWithCells.GetFigureFormat(outputFilePaths)
+                ReportGeneratorFromPythonFileWithCells.ConvertPythonToJupyter(pythonFilePath, ipynbFile=ipynbFile)
+                ReportGeneratorFromPythonFileWithCells._SetFigureFormatInFirstCell(ipynbFile, figureFormat)
+                ReportGeneratorFromPythonFileWithCells._ChangeDirectoryInFirstCell(ipynbFile, directory)
+                command = ["jupyter", "nbconvert", "--execute", "--to", "markdown", "--no-input", ipynbFile]
+                await self.runCommand(command, scratchDirectory, pythonFilePath, "execute")
+                # the figures nbconvert wrote to the scratch folder go where the outputs can still find them
+                figureFiles = ReportGeneratorFromPythonFileWithCells.MoveFiguresToCache(mdFileName, pythonFilePath, figureFormat)
+
+                async def runPandoc(outputFilePath) :
+                    # written to a folder of its own so a markdown output doesn't overwrite the intermediate markdown
+                    scratchOutputFile = join(scratchDirectory, "output", basename(outputFilePath))
+                    makedirs(dirname(scratchOutputFile), exist_ok=True)
+                    command = ReportGeneratorFromPythonFileWithCells.PandocCommand(mdFileName, scratchOutputFile, directory, sources, csl)
+                    result = await self.runCommand(command, scratchDirectory, pythonFilePath, "pandoc")
+                    if not isfile(scratchOutputFile) :
+                        raise Exception("File was not created sucessfully: " + result.stderr.strip())
+                    shutil.move(scratchOutputFile, outputFilePath)
+                pandocTasks = [asyncio.ensure_future(runPandoc(outputFilePath)) for outputFilePath in outputFilePaths]
+                try :
+                    await asyncio.gather(*pandocTasks)
+                finally :
+                    # if a format failed (or the build was cancelled) the others are stopped too, and their 
+                    # commands killed, before the folder they are writing to is removed
+                    for task in pandocTasks :
+                        task.cancel()
+                    await asyncio.gather(*pandocTasks, return_exceptions=True)
+                ReportGeneratorFromPythonFileWithCells.CollectUnusedFigures(ReportGeneratorFromPythonFileWithCells.GetFigureDirectory(pythonFilePath), figureFiles)
+            finally :
+                shutil.rmtree(scratchDirectory, ignore_errors=True)
+            return outputFilePaths
+
+    async def writeReports(self, pythonFilePaths, **kwargs) -> List[ReportBuildResult] :
+        """
+        Makes the reports for many scripts (maxConcurrentBuilds at a time), see writeReport.
+
+        Args:
+            pythonFilePaths: The scripts to build, or a folder to find them in (see FindReportScripts)
+            kwargs: Passed on to writeReport
+
+        Returns:
+            List[ReportBuildResult]: The result of each build, in the same order as the scripts
+        """
+        if isinstance(pythonFilePaths, str) :
+            pythonFilePaths = ReportGeneratorFromPythonFileWithCells.FindReportScripts(pythonFilePaths)
+
+        async def build(pythonFilePath) :
+            start = time.perf_counter()
+            try :
+                await self.writeReport(pythonFilePath, **kwargs)
+                return ReportBuildResult(pythonFilePath, time.perf_counter() - start)
+            except Exception :
+                return ReportBuildResult(pythonFilePath, time.perf_counter() - start, traceback.format_exc())
+        return list(await asyncio.gather(*[build(pythonFilePath) for pythonFilePath in pythonFilePaths]))
+
+    async def runCommand(self, command : List[str], workingDirectory, pythonFilePath, stage : str) -> subprocess.CompletedProcess :
+        """
+        Runs the command, streaming its output to outputCallback, within the timeout of the stage.  The command 
+        (and anything it started) is killed if it runs over or the task is cancelled.  Raises an exception if the 
+        command fails.
+
+        Returns:
+            subprocess.CompletedProcess: The return code, and the last lines of stdout and stderr
+        """
+        from collections import deque
+        timeout = self.stageTimeouts.get(stage, self.defaultTimeout)
+        options = {"start_new_session" : True} if sys.platform != "win32" else {"creationflags" : subprocess.CREATE_NEW_PROCESS_GROUP}
+        process = await asyncio.create_subprocess_exec(*command, cwd=workingDirectory, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **options)
+        stdoutTail = deque(maxlen=50)
+        stderrTail = deque(maxlen=50)
+
+        def handleLine(line, tail) :
+            text = line.decode("utf-8", errors="replace")
+            tail.append(text)
+            if self.outputCallback != None :
+                self.outputCallback(pythonFilePath, stage, text)
+
+        async def readLines(stream, tail) :
+            # read in chunks and split the lines here, since readline fails on a line longer than the stream's
+            # limit (64 KiB), which a traceback that prints a large expression can easily write
+            pending = bytearray()
+            while True :
+                chunk = await stream.read(65536)
+                if not chunk :
+                    break
+                pending.extend(chunk)
+                end = pending.rfind(b"\n")
+                if end >= 0 :
+                    for line in bytes(pending[:end]).split(b"\n") :
+                        handleLine(line + b"\n", tail)
+                    del pending[:end + 1]
+            if len(pending) > 0 :
+                handleLine(bytes(pending), tail)
+        try :
+            await asyncio.wait_for(asyncio.gather(readLines(process.stdout, stdoutTail), readLines(process.stderr, stderrTail), process.wait()), timeout)
+        except asyncio.TimeoutError :
+            await AsyncReportGenerator._killProcess(process)
+            raise Exception("The " + stage + " stage of " + pythonFilePath + " took longer than " + str(timeout) + " seconds") from None
+        except BaseException : # cancelled
+            await AsyncReportGenerator._killProcess(process)
+            raise
+        result = subprocess.CompletedProcess(command, process.returncode, "".join(stdoutTail), "".join(stderrTail))
+        if result.returncode != 0 :
+            raise Exception(" ".join(command) + " failed with return code " + str(result.returncode) + ":\n" + result.stderr)
+        return result
+
+    @staticmethod
+    async def _killProcess(process) -> None :
+        if process.returncode == None :
+            try :
+                if sys.platform != "win32" :
+                    import signal
+                    from os import killpg
+                    killpg(process.pid, signal.SIGKILL) # the whole session, so the kernel goes too
+                else :
+                    process.kill()
+            except ProcessLookupError :
+                pass
+        await process.wait()
+
+class ReportWatcher :
+    """
+    Rebuilds a report every time its script, bibliography or csl file is saved (see watch), polling for changes.  
+    Builds are incremental (only the cells from the first changed #%% cell onward run again) in a warm kernel 
+    that is kept between builds, and when only the bibliography or csl file changed, only pandoc is run again 
+    on the markdown of the last build (which is kept in the .sppcache folder next to the script).
+    """
+    def __init__(self, pythonFilePath, extension = "pdf", sources = None, csl = None, pollSeconds : float = 0.5, debounceSeconds : float = 0.5, useWarmKernels : bool = True) :
+        self.pythonFilePath = realpath(pythonFilePath)
+        self.directory = dirname(self.pythonFilePath)
+        self.extension = extension
+        self.outputFilePaths = ReportGeneratorFromPythonFileWithCells.GetOutputFilePaths(self.pythonFilePath, None, extension)
+        (self.sources, self.csl) = ReportGeneratorFromPythonFileWithCells.FindSourcesAndCsl(self.directory, sources, csl)
+        self.pollSeconds = pollSeconds
+        self.debounceSeconds = debounceSeconds
+        self.useWarmKernels = useWarmKernels
+        self.intermediateDirectory = join(ReportGeneratorFromPythonFileWithCells.GetCacheDirectory(self.pythonFilePath), "markdown")
+        self._lastSnapshot = self.snapshot()
+
+    def watchedFiles(self) -> dict :
+        files = {"script" : self.pythonFilePath}
+        if self.sources != None :
+            files["sources"] = join(self.directory, self.sources)
+        if self.csl != None :
+            files["csl"] = join(self.directory, self.csl)
+        return files
+
+    def snapshot(self) -> dict :
+        # the modification time and size of each watched file (None while it is missing, like in the middle of some editors' saves)
+        state = {}
+        for (kind, path) in self.watchedFiles().items() :
+            try :
+                info = stat(path)
+                state[kind] = (info.st_mtime_ns, info.st_size)
+            except FileNotFoundError :
+                state[kind] = None
+        return state
+
+    def waitForChanges(self) -> set :
+        """
+        Polls until a watched file changes, and then until the files have stopped changing for debounceSeconds 
+        (so a burst of saves is one rebuild).
+
+        Returns:
+            set: What changed, out of "script", "sources" and "csl"
+        """
+        current = self.snapshot()
+        while current == self._lastSnapshot :
+            time.sleep(self.pollSeconds)
+            current = self.snapshot()
+        settled = time.monotonic()
+        while time.monotonic() - settled < self.debounceSeconds :
+            time.sleep(min(self.pollSeconds, self.debounceSeconds))
+            latest = self.snapshot()
+            if latest != current :
+                current = latest
+                settled = time.monotonic()
+        changed = {kind for kind in current if current[kind] != self._lastSnapshot.get(kind)}
+        self._lastSnapshot = current
+        return changed
+
+    def rebuild(self, changed : set) -> None :
+        """
+        Runs pandoc again if only the bibliography or csl file changed (and there is markdown from an earlier build), 
+        and otherwise builds the report incrementally.
+        """
+        start = time.perf_counter()
+        mdFileName = join(self.intermediateDirectory, basename(self.pythonFilePath).replace(".py", ".md"))
+        if "script" not in changed and isfile(mdFileName) :
+            ReportGeneratorFromPythonFileWithCells.RunPandocForFormats(mdFileName, self.outputFilePaths, self.directory, self.sources, self.csl)
+            what = "ran pandoc for "
+        else :
+            makedirs(self.intermediateDirectory, exist_ok=True)
+            ReportGeneratorFromPythonFileWithCells.WriteIpynbToDesiredFormatWithPandoc(self.pythonFilePath, None, self.extension, self.sources, self.csl, keepDirectoryClean=False, incremental=True, intermediateDirectory=self.intermediateDirectory)
+            what = "rebuilt "
+        print(what + basename(self.pythonFilePath) + " in " + "{:.1f}".format(time.perf_counter() - start) + " seconds")
+
+    def watch(self, maxRebuilds : int = None) -> None :
+        """
+        Builds the report, then rebuilds it after every change until interrupted (Ctrl+C), or until it has been 
+        rebuilt maxRebuilds times.  A build that fails prints its error and the watching carries on.
+        """
+        startedKernels = False
+        if self.useWarmKernels and ReportGeneratorFromPythonFileWithCells.kernelPool == None :
+            try :
+                ReportGeneratorFromPythonFileWithCells.UseWarmKernels()
+                startedKernels = True
+            except ImportError :
+                print("nbclient or nbconvert isn't installed, so every build will start a new kernel")
+        try :
+            self._lastSnapshot = self.snapshot()
+            changed = {"script"}
+            rebuilds = 0
+            while True :
+                try :
+                    self.rebuild(changed)
+                except Exception :
+                    print(traceback.format_exc())
+                if maxRebuilds != None and rebuilds >= maxRebuilds :
+                    break
+                changed = self.waitForChanges()
+                rebuilds += 1
+        except KeyboardInterrupt :
+            pass
+        finally :
+            if startedKernels :
+                ReportGeneratorFromPythonFileWithCells.StopWarmKernels()
+
+# Code run in a warm kernel when it starts, and before each notebook to put it back to that state.
+# What needs to be restored is kept on a module since %reset clears the namespace.
+_warmKernelStartSource = """{preloadModules}
+import sys as _sppSys, types as _sppTypes, sysconfig as _sppSysconfig, site as _sppSite
+_sppWarmKernel = _sppTypes.ModuleType("_sppWarmKernel")
+_sppWarmKernel.path = list(_sppSys.path)
+_sppWarmKernel.modules = frozenset(_sppSys.modules) | {"_sppWarmKernel"}
+_sppWarmKernel.libraryPaths = set(_sppSysconfig.get_paths()[name] for name in ("stdlib", "platstdlib", "purelib", "platlib"))
+_sppWarmKernel.libraryPaths.update(getattr(_sppSite, "getsitepackages", list)())
+_sppWarmKernel.libraryPaths.add(_sppSite.getusersitepackages())
+_sppWarmKernel.libraryPaths = tuple(_sppWarmKernel.libraryPaths)
+_sppWarmKernel.numpyPrintOptions = _sppSys.modules["numpy"].get_printoptions() if "numpy" in _sppSys.modules else None
+_sppSys.modules["_sppWarmKernel"] = _sppWarmKernel
+del _sppSys, _sppTypes, _sppSysconfig, _sppSite, _sppWarmKernel
+"""
+
+# Modules that were imported since the kernel was warmed up, and that are not part of the standard 
+# library or installed packages (a local sympyPaperPrinter for example), are removed so the next 
+# notebook imports them fresh.  Settings that notebooks commonly change on the modules that are kept 
+# (matplotlib's rcParams, which go back to matplotlib's defaults with the inline backend's own settings 
+# on top, and numpy's print options) are put back too, so a report doesn't depend on what ran before it.
+_warmKernelResetSource = """%reset -f
+import sys as _sppSys, os as _sppOs
+if "_sppCellMemory" in _sppSys.modules :
+    _sppSys.modules["_sppCellMemory"].stop()
+_sppWarmKernel = _sppSys.modules["_sppWarmKernel"]
+_sppSys.path[:] = _sppWarmKernel.path
+for _sppName, _sppModule in list(_sppSys.modules.items()) :
+    if _sppName in _sppWarmKernel.modules :
+        continue
+    _sppFile = getattr(_sppModule, "__file__", None)
+    if _sppFile != None and not _sppOs.path.realpath(_sppFile).startswith(_sppWarmKernel.libraryPaths) :
+        del _sppSys.modules[_sppName]
+if "matplotlib.pyplot" in _sppSys.modules :
+    _sppSys.modules["matplotlib.pyplot"].close("all")
+if "matplotlib" in _sppSys.modules :
+    _sppSys.modules["matplotlib"].rcdefaults()
+if "matplotlib_inline.config" in _sppSys.modules :
+    _sppInlineBackend = _sppSys.modules["matplotlib_inline.config"].InlineBackend.instance()
+    _sppInlineBackend.figure_formats = {"png"}
+    if "matplotlib" in _sppSys.modules :
+        _sppSys.modules["matplotlib"].rcParams.update(_sppInlineBackend.rc)
+    del _sppInlineBackend
+if _sppWarmKernel.numpyPrintOptions != None :
+    _sppSys.modules["numpy"].set_printoptions(**_sppWarmKernel.numpyPrintOptions)
+_sppOs.chdir({workingDirectory})
+del _sppSys, _sppOs, _sppWarmKernel
+"""
+
+# A module that the kernel runs around each cell to write the peak memory (traced with tracemalloc) 
+# of the cell to a file, keyed by its execution count, while a PerformanceRecorder traces memory.  
+# It is kept in sys.modules so the hooks are only registered once in a warm kernel.
+_cellMemoryModuleSource = """import json, tracemalloc
+fileName = None
+startedTracing = False
+
+def start(newFileName) :
+    global fileName, startedTracing
+    fileName = newFileName
+    if not tracemalloc.is_tracing() :
+        tracemalloc.start()
+        startedTracing = True
+
+def stop() :
+    global fileName, startedTracing
+    fileName = None
+    if startedTracing :
+        tracemalloc.stop()
+        startedTracing = False
+
+def beforeCell(info) :
+    if fileName != None :
+        tracemalloc.reset_peak()
+
+def afterCell(result) :
+    if fileName != None :
+        with open(fileName, "a", encoding="utf-8") as f :
+            f.write(json.dumps({"executionCount" : result.execution_count, "peakMemoryBytes" : tracemalloc.get_traced_memory()[1]}) + "\\n")
+"""
+
+_cellMemoryStartSource = """import sys as _sppSys, types as _sppTypes
+if "_sppCellMemory" not in _sppSys.modules :
+    _sppCellMemory = _sppTypes.ModuleType("_sppCellMemory")
+    exec({moduleSource}, _sppCellMemory.__dict__)
+    _sppSys.modules["_sppCellMemory"] = _sppCellMemory
+    get_ipython().events.register("pre_run_cell", _sppCellMemory.beforeCell)
+    get_ipython().events.register("post_run_cell", _sppCellMemory.afterCell)
+    del _sppCellMemory
+_sppSys.modules["_sppCellMemory"].start({fileName})
+del _sppSys, _sppTypes
+"""
+
+class WarmKernelPool :
+    """
+    A pool of running Jupyter kernels that have already imported the heavy modules (sympy, numpy, scipy, 
+    matplotlib) so that executing a notebook doesn't pay for starting a kernel and importing them every time.  
+    Before each notebook, the namespace of the kernel is reset (along with sys.path, any local modules 
+    that were imported, matplotlib's rcParams and numpy's print options).  This needs nbclient and jupyter_client (and nbconvert for ConvertNotebookToMarkdown 
+    to convert what the kernels executed, see UseWarmKernels).
+
+    A cell that runs for longer than cellTimeout seconds (None for no limit) fails the notebook.  A kernel 
+    that dies (or times out) is restarted and warmed up again before it goes back in the pool, and the 
+    notebook it was running fails.
+    """
+    defaultPreloadModules = ["sympy", "numpy", "scipy", "matplotlib", "matplotlib.pyplot"]
+
+    def __init__(self, size : int = 1, preloadModules : List[str] = None, kernelName : str = "python3", cellTimeout : float = 1800) :
+        from jupyter_client.manager import KernelManager
+        import queue
+        if preloadModules == None :
+            preloadModules = WarmKernelPool.defaultPreloadModules
+        preloadSource = "\n".join(["try :\n    import " + module + "\nexcept ImportError :\n    pass" for module in preloadModules])
+        self.cellTimeout = cellTimeout
+        self._startSource = _warmKernelStartSource.replace("{preloadModules}", preloadSource)
+        self.kernelManagers = []
+        self._availableKernels = queue.Queue()
+        for i in range(size) :
+            # with the (default) blocking client, nbclient waits for a reply without ever checking that the 
+            # kernel is still alive, so a kernel that died would hang the build
+            kernelManager = KernelManager(kernel_name=kernelName, client_class="jupyter_client.asynchronous.AsyncKernelClient")
+            kernelManager.start_kernel()
+            self.kernelManagers.append(kernelManager)
+            self._runCells(kernelManager, [self._startSource], timeout=cellTimeout)
+            self._availableKernels.put(kernelManager)
+
+    @staticmethod
+    def _runCells(kernelManager, sources : List[str], notebook : dict = None, timeout : float = None) :
+        import nbformat
+        from nbclient import NotebookClient
+        if notebook == None :
+            notebook = nbformat.v4.new_notebook()
+        else :
+            notebook = nbformat.reads(json.dumps(notebook), as_version=4) # this also joins multi-line sources
+        setupCells = [nbformat.v4.new_code_cell(source) for source in sources]
+        notebook.cells = setupCells + notebook.cells
+        client = NotebookClient(notebook, km=kernelManager, timeout=timeout)
+        try :
+            client.execute()
+        finally :
+            # nbclient only closes the channels of the kernels it started, so every notebook would leak its sockets
+            if client.kc != None :
+                client.kc.stop_channels()
+        notebook.cells = notebook.cells[len(setupCells):]
+        return notebook
+
+    def _restartKernel(self, kernelManager) -> None :
+        kernelManager.restart_kernel(now=True)
+        WarmKernelPool._runCells(kernelManager, [self._startSource], timeout=self.cellTimeout)
+
+    def executeNotebook(self, notebook : dict, workingDirectory : str) -> dict :
+        """
+        Resets one of the kernels and executes the notebook in it (from workingDirectory), returning the executed notebook.
+        """
+        from nbclient.exceptions import CellTimeoutError
+        kernelManager = self._availableKernels.get()
+        try :
+            if not kernelManager.is_alive() :
+                self._restartKernel(kernelManager)
+            resetSource = _warmKernelResetSource.replace("{workingDirectory}", repr(workingDirectory))
+            try :
+                executed = WarmKernelPool._runCells(kernelManager, [resetSource], notebook, self.cellTimeout)
+            except CellTimeoutError :
+                # the cell is still running, so the kernel isn't any use to the next notebook
+                self._restartKernel(kernelManager)
+                raise
+            except Exception as error :
+                if kernelManager.is_alive() :
+                    raise
+                self._restartKernel(kernelManager)
+                raise Exception("The kernel died while executing the notebook (it has been restarted for the next one)") from error
+            if not kernelManager.is_alive() :
+                self._restartKernel(kernelManager)
+                raise Exception("The kernel died while executing the notebook (it has been restarted for the next one)")
+            return executed
+        finally :
+            self._availableKernels.put(kernelManager)
+
+    def shutdown(self) -> None :
+        for kernelManager in self.kernelManagers :
+            kernelManager.shutdown_kernel(now=True)
+        self.kernelManagers = []
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        self.shutdown()
+
+# Code run in the kernel to save the variables after a cell (ignoring what the kernel itself put 
+# in the namespace, which the setup cell records in _sppKernelNames).  Modules are saved by name (and
+# re-imported), anything that doesn't pickle, or that pickles as a reference to something defined 
+# in __main__ (which won't exist in a new kernel), makes the snapshot incomplete.
+# Names that start with _spp are this code's own, and IPython keeps its input and output history in 
+# _, __, ___, _<n>, _i, _ii, _iii, _i<n>, _ih, _oh, _dh, In and Out.  Any other variable (even one 
+# starting with _) is the user's, and the snapshot is only complete if all of them could be pickled.
+_snapshotCellSource = """import pickle as _sppPickle, types as _sppTypes, sys as _sppSys, re as _sppRe
+_sppState = {"complete" : True, "path" : list(_sppSys.path), "modules" : {}, "values" : {}}
+for _sppName, _sppValue in list(globals().items()) :
+    if _sppName in _sppKernelNames or _sppName.startswith("_spp") or _sppName in ("In", "Out") or _sppRe.fullmatch(r"_{1,3}|_\\d+|_i{1,3}|_i\\d+|_[iod]h", _sppName) :
+        continue
+    if isinstance(_sppValue, _sppTypes.ModuleType) :
+        _sppState["modules"][_sppName] = _sppValue.__name__
+        continue
+    try :
+        _sppPickled = _sppPickle.dumps(_sppValue)
+        if b"__main__" in _sppPickled :
+            _sppState["complete"] = False
+        else :
+            _sppState["values"][_sppName] = _sppPickled
+    except Exception :
+        _sppState["complete"] = False
+with open({fileName}, "wb") as _sppFile :
+    _sppPickle.dump(_sppState, _sppFile)
+del _sppPickle, _sppTypes, _sppSys, _sppRe, _sppState, _sppFile
+"""
+
+_restoreCellSource = """import pickle as _sppPickle, importlib as _sppImportlib, sys as _sppSys
+with open({fileName}, "rb") as _sppFile :
+    _sppState = _sppPickle.load(_sppFile)
+_sppSys.path[:] = _sppState["path"]
+for _sppName, _sppModule in _sppState["modules"].items() :
+    globals()[_sppName] = _sppImportlib.import_module(_sppModule)
+for _sppName, _sppValue in _sppState["values"].items() :
+    globals()[_sppName] = _sppPickle.loads(_sppValue)
+del _sppPickle, _sppImportlib, _sppSys, _sppState, _sppFile
+"""
+
+class NotebookCellCache :
+    """
+    The on-disk cache used by incremental builds.  Each code cell is identified by a hash of its 
+    source chained with the hashes of all of the code cells before it, so a cell's hash only stays 
+    the same if nothing that ran before it changed.  The manifest holds the outputs of each cell, and 
+    after each executed cell the variables of the kernel are pickled so a later build can restore them 
+    and start executing part way through the notebook.
+
+    Only variables that can be pickled can be restored.  If a cell leaves behind something that can't 
+    (a lambda, a function defined in the script...) the builds will resume from an earlier cell.  Changes 
+    that cells make to the state of imported modules are not restored.
+    """
+    manifestFileName = "manifest.json"
+
+    def __init__(self, cacheDirectory : str) :
+        self.cacheDirectory = cacheDirectory
+        self.cells = {}
+        makedirs(cacheDirectory, exist_ok=True)
+        manifestFile = join(cacheDirectory, NotebookCellCache.manifestFileName)
+        if isfile(manifestFile) :
+            with open(manifestFile, "r", encoding="utf-8") as f :
+                self.cells = json.load(f)["cells"]
+
+    @staticmethod
+    def hashCells(codeCells) -> List[str] :
+        hashes = []
+        previousHash = ""
+        for cell in codeCells :
+            source = cell["source"] if isinstance(cell["source"], str) else "".join(cell["source"])
+            previousHash = hashlib.sha256((previousHash + "\n" + source).encode("utf-8")).hexdigest()
+            hashes.append(previousHash)
+        return hashes
+
+    def snapshotFile(self, cellHash : str) -> str :
+        return join(self.cacheDirectory, "snapshot-" + cellHash + ".pickle")
+
+    def resumePoint(self, hashes : List[str]) -> int :
+        """
+        The index of the first code cell that needs to be executed.  This is the first cell 
+        without cached outputs, moved back to just after the closest earlier cell with a complete snapshot.
+        """
+        firstChangedCell = 0
+        while firstChangedCell < len(hashes) and hashes[firstChangedCell] in self.cells :
+            firstChangedCell += 1
+        if firstChangedCell == len(hashes) :
+            return firstChangedCell
+        for resumeAt in range(firstChangedCell, 0, -1) :
+            previousHash = hashes[resumeAt-1]
+            if self.cells[previousHash]["snapshotComplete"] and isfile(self.snapshotFile(previousHash)) :
+                return resumeAt
+        return 0
+
+    def makeExecutionCells(self, codeCells, hashes : List[str], firstCellToRun : int, workingDirectory : str) :
+        """
+        Makes the cells that will be executed: a cell that moves to the working directory (and restores 
+        the snapshot from before firstCellToRun if there is one), and then each code cell from 
+        firstCellToRun onward followed by a cell that snapshots the variables.  The cells the build 
+        added before firstCellToRun (like the figure format) set up the kernel rather than leave variables 
+        behind, so they are run again in the first cell.
+        """
+        setupSource = "_sppKernelNames = set(globals())\nimport os as _sppOs\n_sppOs.chdir(" + repr(workingDirectory) + ")\ndel _sppOs\n"
+        for cell in codeCells[:firstCellToRun] :
+            if cell.get("metadata", {}).get("sppInternal") :
+                source = cell["source"] if isinstance(cell["source"], str) else "".join(cell["source"])
+                setupSource += source + "\n"
+        if firstCellToRun > 0 :
+            setupSource += _restoreCellSource.replace("{fileName}", repr(self.snapshotFile(hashes[firstCellToRun-1])))
+        cells = [NotebookCellCache._makeInternalCell(setupSource)]
+        for i in range(firstCellToRun, len(codeCells)) :
+            cell = dict(codeCells[i])
+            cell["metadata"] = dict(cell.get("metadata", {}), sppCellHash=hashes[i], sppCellIndex=i)
+            cell["outputs"] = []
+            cells.append(cell)
+            cells.append(NotebookCellCache._makeInternalCell(_snapshotCellSource.replace("{fileName}", repr(self.snapshotFile(hashes[i])))))
+        return cells
+
+    @staticmethod
+    def _makeInternalCell(source : str) :
+        return {"cell_type" : "code", "execution_count" : None, "metadata" : {"sppInternal" : True}, "outputs" : [], "source" : source}
+
+    def storeExecutedCells(self, executedCells, hashes : List[str]) -> None :
+        for cell in executedCells :
+            cellHash = cell["metadata"].get("sppCellHash")
+            if cellHash == None :
+                continue
+            snapshotComplete = False
+            if isfile(self.snapshotFile(cellHash)) :
+                with open(self.snapshotFile(cellHash), "rb") as f :
+                    snapshotComplete = pickle.load(f)["complete"]
+            self.cells[cellHash] = {"outputs" : cell["outputs"], "execution_count" : cell["execution_count"], "snapshotComplete" : snapshotComplete}
+
+    def fillOutputs(self, codeCells) -> None :
+        """
+        Puts the cached outputs into the code cells (of the notebook being built).
+        """
+        for (cell, cellHash) in zip(codeCells, NotebookCellCache.hashCells(codeCells)) :
+            cell["outputs"] = self.cells[cellHash]["outputs"]
+            cell["execution_count"] = self.cells[cellHash]["execution_count"]
+
+    def save(self, hashes : List[str]) -> None :
+        """
+        Writes the manifest with only the cells of the current build, and removes snapshots that are no longer used.
+        """
+        self.cells = {cellHash : self.cells[cellHash] for cellHash in hashes}
+        for file in listdir(self.cacheDirectory) :
+            if file.startswith("snapshot-") and file[len("snapshot-"):-len(".pickle")] not in self.cells :
+                remove(join(self.cacheDirectory, file))
+        with open(join(self.cacheDirectory, NotebookCellCache.manifestFileName), "w", encoding="utf-8") as f :
+            json.dump({"cells" : self.cells}, f)
+
+class CleanDirectoryScope :
+    """
+    A scope that will record the contents of a directory upon entry, and 
+    on exit will delete all new files and new, empty, directories.  When working with a process 
+    where a bunch of extra files might clutter up an otherwise well manicured directory, 
+    this is a easy way to keep that directory clean.
+
+    Folders in excludedDirectories (relative to the directory, like .git) are neither scanned nor cleaned.  
+    With onlyTrackNewlyModifiedFiles, folders whose modification time didn't change aren't scanned again 
+    on exit (nothing was added to them) and only new files modified after entering the scope are deleted 
+    (so a file copied in with its old timestamp is left alone).  Both allow for file systems with coarse 
+    timestamps (FAT keeps them to 2 seconds), so folders modified shortly before entering are always scanned again.
+    """
+    timestampResolutionSeconds = 2.0
+    def __init__(self, directory : str, localNewFilesToKeep : List[str] = None, keepDirectoryClean = True, excludedDirectories : List[str] = None, onlyTrackNewlyModifiedFiles = False) :
+        if localNewFilesToKeep == None :
+            localNewFilesToKeep = []
+        if excludedDirectories == None :
+            excludedDirectories = []
+        self.localNewFilesToKeep = set(join(directory, file) for file in localNewFilesToKeep)
+        self.excludedDirectories = set(join(directory, dir) for dir in excludedDirectories)
+        self.directory = directory
+        self.keepDirectoryClean = keepDirectoryClean
+        self.onlyTrackNewlyModifiedFiles = onlyTrackNewlyModifiedFiles
+        self.entryTime = None # set on entering the scope
+        self._snapshots = {}
+
+    def __enter__(self) :
+        self.entryTime = time.time()
+        self._snapshots = {}
+        self.filesInDirectory, self.directories = self.getFilesAndDirectoriesInDirectory()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :        
+        if not self.keepDirectoryClean :
+            return
+        previousSnapshots = self._snapshots if self.onlyTrackNewlyModifiedFiles else None
+        filesAtEnd, directoriesAtEnd = self.getFilesAndDirectoriesInDirectory(previousSnapshots)
+        for file in filesAtEnd - self.filesInDirectory :
+            if not self.isKept(file) and isfile(file) :
+                if self.onlyTrackNewlyModifiedFiles and getmtime(file) < self.entryTime - CleanDirectoryScope.timestampResolutionSeconds :
+                    continue
+                remove(file)
+
+        newDirectories = sorted(directoriesAtEnd - self.directories, key=len, reverse=True) # deepest first
+        for dir in newDirectories :
+            if len(listdir(dir)) == 0: # since we already removed files, only delete dir if empty
+                rmdir(dir)
+
+    def isKept(self, file : str) -> bool :
+        """
+        True if the file is one of the files to keep, or is in one of the directories to keep.
+        """
+        path = file
+        while path not in self.localNewFilesToKeep :
+            parent = dirname(path)
+            if parent == path or len(parent) < len(self.directory) :
+                return False
+            path = parent
+        return True
+
+    def getFilesAndDirectoriesInDirectory(self, previousSnapshots : dict = None) :
+        """
+        Finds all of the files and folders under the directory (other than the excluded ones).  If 
+        previousSnapshots are given, folders whose modification time is the same as in those snapshots 
+        (and wasn't within the timestamp resolution of entering the scope, when a change might not 
+        have moved it on) are not listed again.  Outside of the scope every folder is listed.
+
+        Returns:
+            The set of files and the set of directories (both full paths)
+        """
+        files = set()
+        directories = set()
+        snapshots = {}
+        if self.entryTime == None :
+            previousSnapshots = None
+        else :
+            unchangedBeforeNs = int((self.entryTime - CleanDirectoryScope.timestampResolutionSeconds) * 1e9)
+        directoriesToScan = [self.directory]
+        while len(directoriesToScan) > 0 :
+            current = directoriesToScan.pop()
+            try :
+                modifiedTime = stat(current).st_mtime_ns
+            except OSError :
+                continue
+            if previousSnapshots != None and current in previousSnapshots and previousSnapshots[current][0] == modifiedTime and modifiedTime < unchangedBeforeNs :
+                snapshot = previousSnapshots[current]
+            else :
+                filesHere = []
+                directoriesHere = []
+                with scandir(current) as entries :
+                    for entry in entries :
+                        if entry.is_dir(follow_symlinks=False) :
+                            if entry.path not in self.excludedDirectories :
+                                directoriesHere.append(entry.path)
+                        else :
+                            filesHere.append(entry.path)
+                snapshot = (modifiedTime, filesHere, directoriesHere)
+            snapshots[current] = snapshot
+            files.update(snapshot[1])
+            directories.update(snapshot[2])
+            directoriesToScan.extend(snapshot[2])
+        self._snapshots = snapshots
+        return [files, directories]
+
+import uuid
+class ScopeIfFileDoesNotExist :
+    """
+    Creates a scope based on the existence of a file.  What happened is when I want a 
+    script to make a PDF of itself, the script might need to get rerun, which means 
+    the 'create pdf' part of the code runs again.  
+    """
+    # however, with the need to know the exact file location, this is less useful than 
+    # it was
+    scopedFiles = []
+
+    def __init__(self, directory, fileName = None) :
+        self.directory = directory
+        if fileName == None :
+            fileName = str(uuid.uuid4())
+        self.fileName =join(self.directory, fileName)
+    
+    def __enter__(self) :        
+        if isfile(self.fileName) :
+            with open(self.fileName, 'w') :
+                pass
+        ScopeIfFileDoesNotExist.scopedFiles.append(self.fileName)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        ScopeIfFileDoesNotExist.scopedFiles.remove(self.fileName)
+        if not self.fileAlreadyExists and isfile(self.fileName) :
+            remove(self.fileName)
+            
+    @staticmethod
+    def isFileControlledByScope(filepath) :
+        return filepath in ScopeIfFileDoesNotExist.scopedFiles
@@ -0,0 +1,11 @@
+# Importing this before sympyPaperPrinter points its on-disk caches (and those of the kernels and 
+# processes the tests start, through the environment) at a temporary folder that is removed at exit, 
+# so the tests neither read from nor write to the real ~/.cache/sympyPaperPrinter.
+import atexit
+import os
+import shutil
+import tempfile
+
+cacheDirectory = tempfile.mkdtemp(prefix="sppTestCache")
+os.environ["SPP_CACHE_DIRECTORY"] = cacheDirectory
+atexit.register(shutil.rmtree, cacheDirectory, True)
@@ -0,0 +1,92 @@
+# Stub jupyter and pandoc executables for the tests and benchmarks, so the report pipeline can be run
+# without a kernel or LaTeX (and so commands that fail, or hang, can be made on purpose).  They are
+# POSIX scripts, so anything using them is skipped on Windows.
+import os
+import sys
+
+_jupyterSource = '''#!{python}
+# stands in for jupyter nbconvert, without running anything
+import json, os, subprocess, sys, time
+config = {config}
+arguments = sys.argv[1:]
+notebookFile = arguments[-1]
+if config["logFile"] != None :
+    with open(config["logFile"], "a", encoding="utf-8") as f :
+        f.write(" ".join(["jupyter", str(os.getpid())] + arguments) + "\\n")
+print("executing " + os.path.basename(notebookFile), flush=True)
+if any(name in os.path.basename(notebookFile) for name in config["slowNotebooks"]) :
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(" + repr(config["sleepSeconds"]) + ")"])
+    if config["childPidFile"] != None :
+        with open(config["childPidFile"], "w") as f :
+            f.write(str(child.pid))
+    time.sleep(config["sleepSeconds"])
+with open(notebookFile, "r", encoding="utf-8") as f :
+    notebook = json.load(f)
+if "markdown" in arguments :
+    with open(os.path.splitext(notebookFile)[0] + ".md", "w", encoding="utf-8") as f :
+        for cell in notebook["cells"] :
+            f.write("".join(cell["source"]) + "\\n\\n")
+else :
+    outputFile = os.path.join(arguments[arguments.index("--output-dir") + 1], arguments[arguments.index("--output") + 1] + ".ipynb")
+    with open(outputFile, "w", encoding="utf-8") as f :
+        json.dump(notebook, f)
+'''
+
+_pandocSource = '''#!{python}
+# stands in for pandoc, copying the markdown to the output file after a line saying what it was converted to
+import os, sys, time
+config = {config}
+arguments = sys.argv[1:]
+outputFile = arguments[arguments.index("-o") + 1]
+extension = os.path.splitext(outputFile)[1][1:]
+if config["logFile"] != None :
+    with open(config["logFile"], "a", encoding="utf-8") as f :
+        f.write(" ".join(["pandoc", str(os.getpid())] + arguments) + "\\n")
+if extension in config["slowFormats"] :
+    time.sleep(config["sleepSeconds"])
+if extension in config["failingFormats"] :
+    time.sleep(config["failAfterSeconds"])
+    sys.exit("no " + extension + " here")
+with open(arguments[0], "r", encoding="utf-8") as f :
+    markdown = f.read()
+with open(outputFile, "w", encoding="utf-8") as f :
+    f.write("<!-- " + extension + " -->\\n" + markdown)
+'''
+
+def writeStubExecutables(directory : str, logFile : str = None, slowNotebooks = (), failingFormats = (), slowFormats = (), sleepSeconds : float = 60, childPidFile : str = None, failAfterSeconds : float = 0) -> str :
+    """
+    Writes the stub jupyter and pandoc executables to a bin folder in the directory and returns the folder
+    (to put first on the PATH).
+
+    Args:
+        logFile (str, optional): A file each command appends its name, process id and arguments to.
+        slowNotebooks (optional): Notebooks with any of these in their name take sleepSeconds to execute, and start
+        a child process (like a kernel) that lives as long, whose pid is written to childPidFile.
+        failingFormats (optional): The extensions the stub pandoc fails to write (after failAfterSeconds).
+        slowFormats (optional): The extensions that take the stub pandoc sleepSeconds to write.
+    """
+    config = {"logFile" : logFile, "slowNotebooks" : list(slowNotebooks), "failingFormats" : list(failingFormats),
+              "slowFormats" : list(slowFormats), "sleepSeconds" : sleepSeconds, "childPidFile" : childPidFile, "failAfterSeconds" : failAfterSeconds}
+    binDirectory = os.path.join(directory, "bin")
+    os.makedirs(binDirectory, exist_ok=True)
+    for (name, source) in [("jupyter", _jupyterSource), ("pandoc", _pandocSource)] :
+        path = os.path.join(binDirectory, name)
+        with open(path, "w", encoding="utf-8") as f :
+            f.write(source.replace("{python}", sys.executable).replace("{config}", repr(config)))
+        os.chmod(path, 0o755)
+    return binDirectory
+
+class StubExecutablesOnPath :
+    """
+    A scope that puts the stub executables (see writeStubExecutables, which the arguments are passed to) first on the PATH.
+    """
+    def __init__(self, directory : str, **options) :
+        self.binDirectory = writeStubExecutables(directory, **options)
+
+    def __enter__(self) :
+        self._previousPath = os.environ.get("PATH", "")
+        os.environ["PATH"] = self.binDirectory + os.pathsep + self._previousPath
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) :
+        os.environ["PATH"] = self._previousPath
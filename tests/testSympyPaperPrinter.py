@@ -4,8 +4,14 @@ from sympy.core import evaluate
 import os
 import sys
 sys.path.insert(1, os.path.dirname(sys.path[0])) # need to import 1 directories up (so spp is a subfolder)
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__))) # and the shared test helpers next to this file
+import isolatedCaches # (for its side effect) keeps the tests out of the real caches
 import sympyPaperPrinter as spp
 import unittest
+import tempfile
+import io
+import contextlib
+import subprocess
 from datetime import datetime
 
 class CustomStdout():
@@ -28,6 +34,7 @@ class CustomStdout():
 class testSympyPaperPrinterClass(unittest.TestCase) :
     def testSilentMarkdown(self) :
         orgOut = sys.stdout
+        previousSilent = spp.silent
         try :
             customOut = CustomStdout()
             sys.stdout = customOut
@@ -40,6 +47,7 @@ class testSympyPaperPrinterClass(unittest.TestCase) :
             assert not someMdString in customOut.log
         finally :
             sys.stdout = orgOut
+            spp.silent = previousSilent
     
     def testFilteringOfSympyFunctionArguments(self) :
         x = sy.Symbol('x')
@@ -79,7 +87,339 @@ class testSympyPaperPrinterClass(unittest.TestCase) :
         zS = sy.Symbol('z')
         expectedSymbol = zS*sy.Symbol(r'\dot{z}')*sy.Symbol(r'\ddot{z}')*y
         assert expectedSymbol == cleanedExpression
-    
 
-        
+    def testCleaningCacheHitsOnStructurallyIdenticalExpressions(self) :
+        spp.cleaningCache.clear()
+        t = sy.Symbol('t')
+        firstExpression = sy.Function('z')(t).diff(t)*sy.Function('g')(t)
+        secondExpression = sy.Function('z')(t).diff(t)*sy.Function('g')(t)
+        firstCleaned = spp.cleanExpression(firstExpression)
+        secondCleaned = spp.cleanExpression(secondExpression)
+        assert firstCleaned == secondCleaned
+        assert spp.cleaningCache.misses == 1
+        assert spp.cleaningCache.hits == 1
+        spp.cleanExpression(firstExpression, [t])
+        assert spp.cleaningCache.misses == 2 # different options are a different entry
+
+    def testCleaningCacheEvictsLeastRecentlyUsed(self) :
+        cache = spp.EquationCleaningCache(maxSize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert len(cache) == 2
+        assert cache.get('b') == None
+        assert cache.get('a') == 1
+        cache.maxSize = 1
+        assert len(cache) == 1
+        assert cache.get('a') == 1 # the most recently used entry survives
 
+    def testStrictAndFastCleaningAgree(self) :
+        x = sy.Symbol('x')
+        y = sy.Symbol('y')
+        t = sy.Symbol('t')
+        z = sy.Function('z')(t)
+        testExpression = sy.Function("g")(x,y,t)*sy.cos(x)*sy.Derivative(z, t)
+        fastExpression = spp.cleanOutUnwantedArguments(testExpression, [x,t])
+        strictExpression = spp.cleanOutUnwantedArguments(testExpression, [x,t], strict=True)
+        assert fastExpression == strictExpression
+
+        # strict mode only notices a derivative collapsing if the whole expression becomes 0
+        testExpression = testExpression + sy.Function('h')(t)
+        fastExpression = spp.cleanOutUnwantedArguments(testExpression, [x,t])
+        assert fastExpression == sy.Function("g")(y)*sy.cos(x)*sy.Derivative(z, t) + sy.Symbol('h')
+
+    def testFastCleaningKeepsDifferentiatedFunctionsAndCleansMatrices(self) :
+        x = sy.Symbol('x')
+        t = sy.Symbol('t')
+        z = sy.Function('z')(t, x)
+        q = sy.Function('q')(t, x)
+        testMatrix = sy.Matrix([[z.diff(x), sy.Function('w')(t)], [q.diff(t), 0]])
+        cleanedMatrix = spp.cleanOutUnwantedArguments(testMatrix, [t])
+        assert cleanedMatrix[0, 0] == sy.Function('z')(x).diff(x)
+        assert cleanedMatrix[0, 1] == sy.Symbol('w')
+        assert cleanedMatrix[1, 0] == q.diff(t) # cleaning t out of q would make this 0
+
+    def testConvertingNestedAndHigherOrderTimeDerivativesToDots(self):
+        t = sy.Symbol('t')
+        x = sy.Function('x')(t)
+        y = sy.Function('y')(t)
+        testExpression = 2 + sy.cos(x)*sy.Derivative(y, t) + x.diff(t, 3)*y.diff(t, 5)
+        cleanedExpression = spp.convertTimeDerivativeToDotSymbol(testExpression)
+        expectedExpression = (2 + sy.cos(sy.Symbol('x'))*sy.Symbol(r'\dot{y}') + 
+                              sy.Symbol(r'\dddot{x}')*sy.Symbol(r'y^{(5)}'))
+        assert cleanedExpression == expectedExpression
+
+        testMatrix = sy.Matrix([[x.diff(t), 0], [0, y]])
+        cleanedMatrix = spp.convertTimeDerivativeToDotSymbol(testMatrix)
+        assert cleanedMatrix == sy.Matrix([[sy.Symbol(r'\dot{x}'), 0], [0, sy.Symbol('y')]])
+
+        cleanedEquation = spp.convertTimeDerivativeToDotSymbol(sy.Eq(x.diff(t, 2), -x))
+        assert cleanedEquation == sy.Eq(sy.Symbol(r'\ddot{x}'), -sy.Symbol('x'))
+
+    def testImportingAndPrintingDoesNotLoadHeavyModules(self) :
+        # sympy is only imported once an expression is used, IPython only when displaying interactively, 
+        # and the report generation code only when one of its classes is used
+        repositoryDirectory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        code = ("import sys\n"
+                "sys.path.insert(0, " + repr(repositoryDirectory) + ")\n"
+                "import sympyPaperPrinter as spp\n"
+                "print(sorted(m for m in ['sympy', 'IPython', 'sympyPaperPrinterReports'] if m in sys.modules))\n"
+                "spp.printMarkdown('text')\n"
+                "spp.showEquation('x', spp.t)\n"
+                "print(sorted(m for m in ['sympy', 'IPython', 'sympyPaperPrinterReports'] if m in sys.modules))\n")
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        assert result.stdout.splitlines() == ["[]", "text", "Eq(x, t)", "['sympy']"]
+
+    def testDocumentCaptureOnlyHooksPyplotOnceTheScriptImportsIt(self) :
+        repositoryDirectory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        with tempfile.TemporaryDirectory() as directory :
+            # a stand-in for matplotlib, so that what the capture does to pyplot can be seen
+            os.makedirs(os.path.join(directory, "matplotlib"))
+            with open(os.path.join(directory, "matplotlib", "__init__.py"), "w") :
+                pass
+            with open(os.path.join(directory, "matplotlib", "pyplot.py"), "w") as f :
+                f.write("backend = 'TkAgg'\n"
+                        "def get_backend() : return backend\n"
+                        "def switch_backend(name) :\n"
+                        "    global backend\n"
+                        "    backend = name\n"
+                        "def show() : print('shown in a window')\n"
+                        "def get_fignums() : return []\n"
+                        "def close(which) : pass\n")
+            code = ("import sys\n"
+                    "sys.path.insert(0, " + repr(repositoryDirectory) + ")\n"
+                    "sys.path.insert(0, " + repr(directory) + ")\n"
+                    "import sympyPaperPrinter as spp\n"
+                    "finders = list(sys.meta_path)\n"
+                    "with spp.DocumentCapture(" + repr(directory) + ") :\n"
+                    "    pass\n"
+                    "print('matplotlib.pyplot' in sys.modules, sys.meta_path == finders)\n"
+                    "with spp.DocumentCapture(" + repr(directory) + ") :\n"
+                    "    import matplotlib.pyplot as plt\n"
+                    "    plt.show()\n"
+                    "    print(plt.get_backend())\n"
+                    "plt.show()\n"
+                    "print(plt.get_backend(), sys.meta_path == finders)\n")
+            result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+        assert result.stdout.splitlines() == ["False True", "Agg", "shown in a window", "TkAgg True"]
+
+    def testPerformanceRecorderRecordsNestedStagesAndCalls(self) :
+        x = sy.Function('x')(spp.t)
+        with spp.PerformanceRecorder(traceMemory=True) as recorder :
+            with spp.recordStage("build", script="report.py") :
+                with spp.recordStage("clean") :
+                    spp.cleanExpression(x.diff(spp.t) + x)
+                    keptAlive = [0] * 100000
+        assert spp.performanceRecorder == None
+        assert [(stage["name"], stage["depth"]) for stage in recorder.stages] == [("build", 0), ("clean", 1)]
+        assert recorder.stages[0]["script"] == "report.py"
+        assert recorder.stages[0]["seconds"] >= recorder.stages[1]["seconds"]
+        assert recorder.stages[0]["peakMemoryBytes"] >= recorder.stages[1]["peakMemoryBytes"] >= 8 * len(keptAlive)
+        assert recorder.calls["cleanExpression"]["count"] == 1
+        assert "build" in recorder.summary()
+
+    def testPerformanceRecorderLeavesTheCallersMemoryTracingOn(self) :
+        import tracemalloc
+        tracemalloc.start()
+        try :
+            with spp.PerformanceRecorder(traceMemory=True) as recorder :
+                with spp.recordStage("build") :
+                    pass
+            assert tracemalloc.is_tracing()
+            assert "peakMemoryBytes" in recorder.stages[0]
+        finally :
+            tracemalloc.stop()
+        with spp.PerformanceRecorder(traceMemory=True) :
+            pass
+        assert not tracemalloc.is_tracing() # but stops the tracing it started itself
+
+    def testPerformanceRecorderReadsCellTimesFromExecutedNotebooks(self) :
+        def cell(source, start, end, internal=False) :
+            return {"cell_type" : "code", "source" : source, "metadata" : {"sppInternal" : internal, "execution" : {"iopub.execute_input" : start, "shell.execute_reply" : end}}}
+        cells = [cell("import os", "2024-01-01T00:00:00.000Z", "2024-01-01T00:00:05.000Z", internal=True),
+                 {"cell_type" : "markdown", "source" : "# Title", "metadata" : {}},
+                 cell("a = 1\nb = 2", "2024-01-01T00:00:00.000Z", "2024-01-01T00:00:00.250Z"),
+                 cell("c = 3", "2024-01-01T00:00:01.000Z", "2024-01-01T00:00:03.500Z")]
+        cells[3]["execution_count"] = 7
+        recorder = spp.PerformanceRecorder()
+        recorder.recordCells("execute", cells, cellPeaks={7 : 2500000})
+        assert [(cell["index"], cell["seconds"], cell["firstLine"]) for cell in recorder.cells] == [(0, 0.25, "a = 1"), (1, 2.5, "c = 3")]
+        assert [cell.get("peakMemoryBytes") for cell in recorder.cells] == [None, 2500000]
+        assert recorder.summary().splitlines()[2].strip().startswith("execute cell 1: 2.500 s, peak 2.5 MB")
+        cells[2]["metadata"]["sppCellIndex"] = 5 # only the cells from the first one that changed were executed
+        cells[3]["metadata"]["sppCellIndex"] = 6
+        recorder = spp.PerformanceRecorder()
+        recorder.recordCells("execute", cells)
+        assert [cell["index"] for cell in recorder.cells] == [5, 6]
+
+    def testPerformanceRecorderOnlyTracesTheMemoryOfMainThreadStages(self) :
+        import threading
+        with spp.PerformanceRecorder(traceMemory=True) as recorder :
+            with spp.recordStage("build") :
+                def runInThread() :
+                    with spp.recordStage("pandoc") :
+                        with spp.recordStage("read") :
+                            pass
+                threads = [threading.Thread(target=runInThread) for i in range(2)]
+                for thread in threads :
+                    thread.start()
+                for thread in threads :
+                    thread.join()
+        assert sorted((stage["name"], stage["depth"]) for stage in recorder.stages) == [("build", 0), ("pandoc", 1), ("pandoc", 1), ("read", 2), ("read", 2)]
+        assert ["peakMemoryBytes" in stage for stage in recorder.stages if stage["name"] != "build"] == [False] * 4
+        assert "peakMemoryBytes" in recorder.stages[0]
+
+    def testCleaningMatricesElementWiseMatchesCleaningTheWholeMatrix(self) :
+        t = spp.t
+        x = sy.Symbol('x')
+        z = sy.Function('z')(t, x)
+        q = sy.Function('q')(t)
+        # z is only protected by the derivative in one element, but has to be left alone everywhere
+        matrix = sy.Matrix([[q.diff(t) * z, q.diff(t) * z, z], [sy.Derivative(z, x), q.diff(t, 2), q.diff(t) * z]])
+        expected = spp.cleanOutUnwantedArguments(spp.convertTimeDerivativeToDotSymbol(matrix))
+        assert spp.cleanMatrix(matrix) == expected
+        assert spp.cleanMatrix(matrix)[0, 2] == z
+        assert isinstance(spp.cleanMatrix(sy.ImmutableMatrix(matrix)), sy.ImmutableMatrix)
+        try :
+            spp.parallelCleaningThreshold = 1
+            spp.parallelCleaningProcesses = 2
+            assert spp.cleanMatrix(matrix) == expected
+        finally :
+            spp.parallelCleaningThreshold = None
+            spp.parallelCleaningProcesses = None
+
+    def testLambdifyCachedReusesCodeFromMemoryAndDisk(self) :
+        x = sy.Symbol('x')
+        y = sy.Symbol('y')
+        expression = sy.sin(x * y) + sy.cos(x * y)**2 + x
+        previousCache = spp.lambdifyCache
+        with tempfile.TemporaryDirectory() as directory :
+            try :
+                spp.lambdifyCache = spp.LambdifyCache(directory)
+                function = spp.lambdifyCached([x, y], expression, "math")
+                assert "x0 = x*y" in open(os.path.join(directory, os.listdir(directory)[0])).read()
+                assert spp.lambdifyCached([x, y], expression, "math") is function
+                assert spp.lambdifyCached([y, x], expression, "math") is not function
+                spp.lambdifyCache.clear() # as if it was a new run
+                fromDisk = spp.lambdifyCached([x, y], expression, "math")
+                assert spp.lambdifyCache.diskHits == 1 and spp.lambdifyCache.misses == 0
+                assert math.isclose(fromDisk(0.5, 2.0), math.sin(1.0) + math.cos(1.0)**2 + 0.5)
+
+                # a Dummy made the same way (as in the next run) has a different index, but the same key
+                keys = [spp.LambdifyCache.makeKey([x, beta], x + beta, "math", True) for beta in [sy.Dummy('beta'), sy.Dummy('beta')]]
+                assert keys[0] == keys[1] and not keys[0].startswith(spp.localKeyPrefix)
+                assert keys[0] != spp.LambdifyCache.makeKey([x, sy.Dummy('gamma')], x + sy.Dummy('gamma'), "math", True)
+                local = spp.makeExpressionKey([{"beta" : sy.Dummy('beta')}], []) # a Dummy that can't be replaced
+                assert local.startswith(spp.localKeyPrefix)
+
+                spp.lambdifyCache = spp.LambdifyCache(directory, maxBytes=400, maxSize=2)
+                oldKey = spp.LambdifyCache.makeKey([x, y], expression, "math", True)
+                os.utime(os.path.join(directory, oldKey + ".py"), (0, 0))
+                functions = [spp.lambdifyCached([x], x + i, "math") for i in range(6)]
+                files = os.listdir(directory)
+                assert oldKey + ".py" not in files # the least recently used code went first
+                assert sum(os.path.getsize(os.path.join(directory, f)) for f in files) <= 400
+                assert len(spp.lambdifyCache) == 2 # only the most recently used are kept in memory
+                assert spp.lambdifyCached([x], x + 5, "math") is functions[5]
+            finally :
+                spp.lambdifyCache = previousCache
+
+    def testLatexCacheSharesLatexBetweenRunsAndEvictsLeastRecentlyUsed(self) :
+        x = sy.Function('x')(spp.t)
+        equation = sy.Eq(sy.Symbol('y'), x.diff(spp.t)**2 / 2)
+        previousCache = spp.latexCache
+        with tempfile.TemporaryDirectory() as directory :
+            try :
+                spp.latexCache = spp.LatexCache(directory)
+                assert spp.toLatex(equation) == sy.latex(equation)
+                spp.latexCache.clear() # as if it was a new run (or another process)
+                assert spp.toLatex(equation) == sy.latex(equation)
+                assert spp.latexCache.diskHits == 1 and spp.latexCache.misses == 0
+                # each run makes its Dummies with different indices, which mustn't change the key
+                assert spp.LatexCache.makeKey(sy.Dummy('beta') * x, {}) == spp.LatexCache.makeKey(sy.Dummy('beta') * x, {})
+                spp.latexPrinterSettings = {"mul_symbol" : "dot"}
+                assert spp.toLatex(x * spp.t) == sy.latex(x * spp.t, mul_symbol="dot")
+
+                spp.latexCache = spp.LatexCache(directory, maxBytes=60)
+                oldKey = spp.LatexCache.makeKey(equation, {})
+                os.utime(os.path.join(directory, oldKey + ".tex"), (0, 0))
+                for i in range(4) :
+                    spp.toLatex(sy.Symbol("a_{" + str(i) + "}") + i)
+                files = os.listdir(directory)
+                assert oldKey + ".tex" not in files
+                assert sum(os.path.getsize(os.path.join(directory, f)) for f in files) <= 60
+
+                spp.latexCache = spp.LatexCache(None, maxSize=2)
+                symbols = [sy.Symbol("b_{" + str(i) + "}") for i in range(3)]
+                for symbol in symbols :
+                    spp.toLatex(symbol)
+                assert len(spp.latexCache) == 2 # only the most recently used are kept in memory
+                spp.toLatex(symbols[0])
+                assert spp.latexCache.misses == 4
+                spp.toLatex(symbols[2])
+                assert spp.latexCache.hits == 1
+            finally :
+                spp.latexPrinterSettings = {}
+                spp.latexCache = previousCache
+
+    def testShowEquationCanRenderItsOwnLatex(self) :
+        previousSilent = spp.silent
+        spp.silent = False
+        try :
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output) :
+                spp.showEquation("y", sy.Symbol('x')**2, renderLatex=True)
+            assert output.getvalue() == "$$y = x^{2}$$\n"
+        finally :
+            spp.silent = previousSilent
+
+    def testShowEquationCompactsLargeExpressions(self) :
+        previousSilent = spp.silent
+        spp.silent = False
+        try :
+            x = sy.Symbol('x')
+            y = sy.Symbol('y')
+            expression = sum((sy.sin(x + y)**i + sy.cos(x * y + i))**2 for i in range(1, 15))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output) :
+                spp.showEquation("z", expression, compact=True)
+            lines = output.getvalue().splitlines()
+            assert sorted(line.split(", ")[1] for line in lines[:2]) == ["sin(x + y))", "x*y)"]
+            assert lines[2].startswith("Eq(z, ") and "sin" not in lines[2]
+
+            previousThreshold = spp.compactDisplayThreshold
+            try :
+                spp.compactDisplayThreshold = 20
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output) :
+                    spp.showEquation("z", expression)
+                    spp.showEquation("w", x + y) # small expressions are shown as they are
+                assert output.getvalue().splitlines()[2:] == lines[2:] + ["Eq(w, x + y)"]
+            finally :
+                spp.compactDisplayThreshold = previousThreshold
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output) :
+                spp.showEquation("z", expression, summarize=True)
+            summary = output.getvalue().splitlines()[2]
+            assert summary.startswith("$$z = ") and summary.endswith(r"\dots \quad \text{(4 more terms)}$$")
+
+            # products and matrices are cut down too
+            terms = sy.symbols("a_0:50")
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output) :
+                spp.showEquation("z", 2 * sy.Add(*terms) * sy.Mul(*terms), summarize=True)
+                spp.showEquation("M", sy.Matrix(20, 30, lambda i, j : terms[i]**(j + 2)), summarize=True)
+            (product, matrix) = output.getvalue().splitlines()
+            assert product.endswith(r"\cdots \quad \text{(41 more factors)}$$")
+            assert r"a_{19}" not in matrix and matrix.endswith(r"\text{(10 more rows, 20 more columns)}$$")
+            assert len(product) < 1000 and len(matrix) < 20000
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output) :
+                spp.showEquation(expression, 0, compact=True) # a large left hand side is compacted too
+            lines = output.getvalue().splitlines()
+            assert len(lines) == 3 and lines[2].startswith("Eq(") and lines[2].endswith(", 0)") and "sin" not in lines[2]
+        finally :
+            spp.silent = previousSilent
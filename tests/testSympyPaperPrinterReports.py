@@ -0,0 +1,587 @@
+import os
+import sys
+sys.path.insert(1, os.path.dirname(sys.path[0])) # need to import 1 directories up (so spp is a subfolder)
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__))) # and the shared test helpers next to this file
+import isolatedCaches # (for its side effect) keeps the tests out of the real caches
+import sympyPaperPrinter as spp
+from stubExecutables import StubExecutablesOnPath
+import unittest
+import tempfile
+import shutil
+import pickle
+import json
+import io
+import contextlib
+import importlib.util
+import asyncio
+import re
+import time
+
+class testSympyPaperPrinterReportsClass(unittest.TestCase) :
+    def testNotebookCellHashesChainThroughEarlierCells(self) :
+        cells = [{"source" : "a = 1"}, {"source" : ["b = a\n", "print(b)"]}, {"source" : "c = b"}]
+        hashes = spp.NotebookCellCache.hashCells(cells)
+        cells[1]["source"] = "b = a + 1"
+        changedHashes = spp.NotebookCellCache.hashCells(cells)
+        assert hashes[0] == changedHashes[0]
+        assert hashes[1] != changedHashes[1]
+        assert hashes[2] != changedHashes[2] # the last cell is the same, but something before it changed
+
+    def testNotebookCellCacheResumesAfterLastCompleteSnapshot(self) :
+        with tempfile.TemporaryDirectory() as cacheDirectory :
+            cache = spp.NotebookCellCache(cacheDirectory)
+            hashes = spp.NotebookCellCache.hashCells([{"source" : str(i)} for i in range(4)])
+            assert cache.resumePoint(hashes) == 0
+            for (cellHash, complete) in zip(hashes[:3], [True, True, False]) :
+                with open(cache.snapshotFile(cellHash), "wb") as f :
+                    pickle.dump({"complete" : complete}, f)
+            cache.storeExecutedCells([{"metadata" : {"sppCellHash" : cellHash}, "outputs" : [], "execution_count" : 1} for cellHash in hashes[:3]], hashes)
+            assert cache.resumePoint(hashes) == 2 # cell 3 is new, but the snapshot after cell 2 is incomplete
+            cache.save(hashes[:3])
+            assert spp.NotebookCellCache(cacheDirectory).resumePoint(hashes[:3]) == 3
+            codeCells = [{"cell_type" : "code", "metadata" : {}, "outputs" : [], "source" : str(i)} for i in range(4)]
+            executionCells = cache.makeExecutionCells(codeCells, hashes, 2, cacheDirectory)
+            # the cells that run keep their place in the whole notebook (for the cell times that are recorded)
+            assert [cell["metadata"]["sppCellIndex"] for cell in executionCells if "sppCellHash" in cell["metadata"]] == [2, 3]
+
+    def testCleanDirectoryScopeKeepsAllRequestedFilesAndDirectories(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            with spp.CleanDirectoryScope(directory, ["a.pdf", "b.html", "cache"]) :
+                os.makedirs(os.path.join(directory, "cache"))
+                for file in ["a.pdf", "b.html", "c.md", os.path.join("cache", "d.json")] :
+                    with open(os.path.join(directory, file), "w") :
+                        pass
+            assert sorted(os.listdir(directory)) == ["a.pdf", "b.html", "cache"]
+            assert os.listdir(os.path.join(directory, "cache")) == ["d.json"]
+
+    def testCleanDirectoryScopeListsTheDirectoryOutsideOfTheScope(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            os.makedirs(os.path.join(directory, "sub"))
+            with open(os.path.join(directory, "sub", "a.txt"), "w") :
+                pass
+            scope = spp.CleanDirectoryScope(directory, onlyTrackNewlyModifiedFiles=True)
+            (files, directories) = scope.getFilesAndDirectoriesInDirectory({})
+            assert files == {os.path.join(directory, "sub", "a.txt")}
+            assert directories == {os.path.join(directory, "sub")}
+
+    def testConvertPythonToJupyterMakesACodeCellPerCell(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "script.py")
+            with open(pythonFile, "w") as f :
+                f.write("import math\n\n#%%\n# a comment that stays code\nx = 1\n\n\n# %%\n\n#%%\nprint(x)\n")
+            ipynbFile = spp.ReportGeneratorFromPythonFileWithCells.ConvertPythonToJupyter(pythonFile)
+            assert ipynbFile == os.path.join(directory, "script.ipynb")
+            with open(ipynbFile, "r") as f :
+                notebook = json.load(f)
+            sources = [cell["source"] for cell in notebook["cells"]]
+            assert all(cell["cell_type"] == "code" for cell in notebook["cells"])
+            assert sources == [["import math"], ["# a comment that stays code\n", "x = 1"], ["print(x)"]]
+            # the second positional argument is still the working directory p2j was run from
+            assert spp.ReportGeneratorFromPythonFileWithCells.ConvertPythonToJupyter(pythonFile, directory) == ipynbFile
+            assert sorted(os.listdir(directory)) == ["script.ipynb", "script.py"]
+
+    def testRemoveSinglePercentLinesFromFileStillWorks(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            mdFile = os.path.join(directory, "script.md")
+            with open(mdFile, "w") as f :
+                f.write("%\n# Title\n%\ntext 5%\n")
+            with self.assertWarns(DeprecationWarning) :
+                spp.ReportGeneratorFromPythonFileWithCells.RemoveSinglePercentLinesFromFile(mdFile)
+            with open(mdFile, "r") as f :
+                assert f.read() == "# Title\ntext 5%\n"
+
+    @unittest.skipIf(importlib.util.find_spec("nbclient") == None or importlib.util.find_spec("nbconvert") == None, "nbclient or nbconvert is not installed")
+    def testWarmKernelsAreResetBetweenNotebooks(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "script.py")
+            with open(pythonFile, "w") as f :
+                f.write("import os\nprint('x' in globals(), os.getcwd() == " + repr(os.path.realpath(directory)) + ")\nx = 1\n")
+            generator = spp.ReportGeneratorFromPythonFileWithCells
+            with spp.WarmKernelPool(preloadModules=[]) as pool :
+                generator.kernelPool = pool
+                try :
+                    for i in range(2) :
+                        ipynbFile = generator.ConvertPythonToJupyter(pythonFile)
+                        generator.ConvertNotebookToMarkdown(ipynbFile)
+                        with open(os.path.join(directory, "script.md"), "r") as f :
+                            assert "False True" in f.read()
+                finally :
+                    generator.kernelPool = None
+
+    @unittest.skipIf(importlib.util.find_spec("nbclient") == None or not os.path.isdir("/dev/fd"), "nbclient is not installed or open files can't be counted")
+    def testWarmKernelsDoNotLeakFilesAcrossManyNotebooks(self) :
+        notebook = {"cells" : [{"cell_type" : "code", "execution_count" : None, "metadata" : {}, "outputs" : [], "source" : "x = 1"}], "metadata" : {}, "nbformat" : 4, "nbformat_minor" : 5}
+        with tempfile.TemporaryDirectory() as directory, spp.WarmKernelPool(preloadModules=[]) as pool :
+            for i in range(3) :
+                pool.executeNotebook(notebook, directory)
+            openFiles = len(os.listdir("/dev/fd"))
+            for i in range(20) :
+                pool.executeNotebook(notebook, directory)
+            assert len(os.listdir("/dev/fd")) <= openFiles + 2 # not the ~10 sockets that every notebook used to leave open
+
+    @unittest.skipIf(importlib.util.find_spec("nbclient") == None or importlib.util.find_spec("matplotlib") == None, "nbclient or matplotlib is not installed")
+    def testWarmKernelsPutMatplotlibSettingsBack(self) :
+        def makeNotebook(source) :
+            return {"cells" : [{"cell_type" : "code", "execution_count" : None, "metadata" : {}, "outputs" : [], "source" : source}], "metadata" : {}, "nbformat" : 4, "nbformat_minor" : 5}
+        with tempfile.TemporaryDirectory() as directory, spp.WarmKernelPool(preloadModules=["matplotlib", "matplotlib.pyplot"]) as pool :
+            pool.executeNotebook(makeNotebook("import matplotlib.pyplot as plt\nplt.rcParams['lines.linewidth'] = 7.0"), directory)
+            executed = pool.executeNotebook(makeNotebook("import matplotlib\nprint(matplotlib.rcParams['lines.linewidth'] == matplotlib.rcParamsDefault['lines.linewidth'])"), directory)
+            assert executed["cells"][0]["outputs"][0]["text"].strip() == "True"
+
+    @unittest.skipIf(importlib.util.find_spec("nbclient") == None, "nbclient is not installed")
+    def testWarmKernelThatDiesFailsTheNotebookAndIsRestarted(self) :
+        def makeNotebook(source) :
+            return {"cells" : [{"cell_type" : "code", "execution_count" : None, "metadata" : {}, "outputs" : [], "source" : source}], "metadata" : {}, "nbformat" : 4, "nbformat_minor" : 5}
+        with tempfile.TemporaryDirectory() as directory, spp.WarmKernelPool(preloadModules=[], cellTimeout=60) as pool :
+            start = time.monotonic()
+            with self.assertRaises(Exception) :
+                pool.executeNotebook(makeNotebook("import os\nos._exit(1)"), directory)
+            assert time.monotonic() - start < 30 # not the cell timeout (or forever)
+            executed = pool.executeNotebook(makeNotebook("print(6 * 7)"), directory)
+            assert executed["cells"][0]["outputs"][0]["text"].strip() == "42"
+
+    def testCellMemoryHookWritesThePeakOfEachCell(self) :
+        import types
+        import tracemalloc
+        import sympyPaperPrinterReports
+        module = types.ModuleType("_sppCellMemory")
+        exec(sympyPaperPrinterReports._cellMemoryModuleSource, module.__dict__)
+        with tempfile.TemporaryDirectory() as directory :
+            fileName = os.path.join(directory, "peaks.jsonl")
+            module.start(fileName)
+            try :
+                for (executionCount, size) in [(3, 4000000), (4, 10)] :
+                    module.beforeCell(None)
+                    allocated = bytearray(size)
+                    del allocated
+                    module.afterCell(types.SimpleNamespace(execution_count=executionCount))
+            finally :
+                module.stop()
+            assert not tracemalloc.is_tracing()
+            module.afterCell(types.SimpleNamespace(execution_count=5)) # stopped, so nothing is written
+            with open(fileName, "r", encoding="utf-8") as f :
+                peaks = [json.loads(line) for line in f]
+        assert [peak["executionCount"] for peak in peaks] == [3, 4]
+        assert peaks[0]["peakMemoryBytes"] >= 4000000 > peaks[1]["peakMemoryBytes"]
+
+    @unittest.skipIf(importlib.util.find_spec("nbclient") == None or importlib.util.find_spec("nbconvert") == None, "nbclient or nbconvert is not installed")
+    def testWarmKernelsRecordThePeakMemoryOfEachCell(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "script.py")
+            with open(pythonFile, "w") as f :
+                f.write("#%%\nx = bytearray(20000000)\ndel x\n#%%\ny = 1\n")
+            generator = spp.ReportGeneratorFromPythonFileWithCells
+            with spp.WarmKernelPool(preloadModules=[]) as pool, spp.PerformanceRecorder(traceMemory=True) as recorder :
+                generator.kernelPool = pool
+                try :
+                    generator.ConvertNotebookToMarkdown(generator.ConvertPythonToJupyter(pythonFile))
+                finally :
+                    generator.kernelPool = None
+        assert [cell["index"] for cell in recorder.cells] == [0, 1]
+        assert recorder.cells[0]["peakMemoryBytes"] >= 20000000 > recorder.cells[1]["peakMemoryBytes"]
+
+    @unittest.skipIf(importlib.util.find_spec("nbclient") == None or importlib.util.find_spec("nbconvert") == None or os.name == "nt", "nbclient or nbconvert is not installed, or the stub pandoc is a POSIX script")
+    def testBatchRunsOneNotebookInEachWarmKernelAtOnce(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFiles = [os.path.join(directory, name + ".py") for name in ["first", "second"]]
+            for pythonFile in pythonFiles :
+                with open(pythonFile, "w") as f :
+                    f.write("#%%\nimport time\nstart = time.time()\ntime.sleep(1.0)\n"
+                            "open(" + repr(pythonFile + ".times") + ", 'w').write(str(start) + ' ' + str(time.time()))\n")
+            generator = spp.ReportGeneratorFromPythonFileWithCells
+            with StubExecutablesOnPath(os.path.join(directory, "stubs")), spp.WarmKernelPool(size=2, preloadModules=[]) as pool :
+                generator.kernelPool = pool
+                try :
+                    results = generator.WriteManyIpynbToDesiredFormatWithPandoc(pythonFiles, extension="html")
+                finally :
+                    generator.kernelPool = None
+            assert [(result.pythonFilePath, result.succeeded) for result in results] == [(pythonFile, True) for pythonFile in pythonFiles]
+            windows = []
+            for pythonFile in pythonFiles :
+                assert os.path.isfile(pythonFile.replace(".py", ".html"))
+                with open(pythonFile + ".times") as f :
+                    windows.append([float(time) for time in f.read().split()])
+            assert windows[0][0] < windows[1][1] and windows[1][0] < windows[0][1] # the notebooks ran at the same time
+            assert sorted(os.listdir(directory)) == sorted(["first.html", "first.py", "first.py.times", "second.html", "second.py", "second.py.times", "stubs"])
+
+    @unittest.skipIf(importlib.util.find_spec("nbconvert") == None or os.name == "nt", "nbconvert is not installed or the stub jupyter is a POSIX script")
+    def testRecordingCellTimesOnlyStartsNbconvertOnce(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            logFile = os.path.join(directory, "commands.log")
+            ipynbFile = os.path.join(directory, "report.ipynb")
+            with open(ipynbFile, "w") as f :
+                json.dump({"cells" : [{"cell_type" : "markdown", "metadata" : {}, "source" : "# Title"}], "metadata" : {}, "nbformat" : 4, "nbformat_minor" : 5}, f)
+            with StubExecutablesOnPath(os.path.join(directory, "stubs"), logFile=logFile), spp.PerformanceRecorder() as recorder :
+                with contextlib.redirect_stdout(io.StringIO()) :
+                    spp.ReportGeneratorFromPythonFileWithCells.ConvertNotebookToMarkdown(ipynbFile)
+            with open(logFile) as f :
+                commands = f.read().splitlines()
+            assert len(commands) == 1 and "--execute" in commands[0] # the conversion to markdown was done in-process
+            with open(os.path.join(directory, "report.md")) as f :
+                assert "# Title" in f.read()
+            assert [stage["name"] for stage in recorder.stages if stage["depth"] == 0] == ["execute", "markdown"]
+
+    def testFindReportScriptsOnlyFindsScriptsWithCells(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            for (file, contents) in [("report.py", "#%%\nx = 1\n"), ("helper.py", "x = 1\n"), (os.path.join(".hidden", "report.py"), "# %%\n")] :
+                os.makedirs(os.path.dirname(os.path.join(directory, file)), exist_ok=True)
+                with open(os.path.join(directory, file), "w") as f :
+                    f.write(contents)
+            scripts = spp.ReportGeneratorFromPythonFileWithCells.FindReportScripts(directory)
+            assert scripts == [os.path.join(directory, "report.py")]
+
+    def testWriteReportsInParallelReportsFailures(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            missingScript = os.path.join(directory, "missing.py")
+            with contextlib.redirect_stdout(io.StringIO()) :
+                results = spp.ReportGeneratorFromPythonFileWithCells.WriteReportsInParallel([missingScript], maxWorkers=1)
+            assert len(results) == 1
+            assert not results[0].succeeded
+            assert "FileNotFoundError" in results[0].error
+            assert os.listdir(directory) == []
+
+    @unittest.skipIf(os.name == "nt", "the stub executables are POSIX scripts")
+    def testWriteReportsInParallelBuildsScriptsInTheSameFolder(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            scriptDirectory = os.path.join(directory, "scripts")
+            scratchDirectory = os.path.join(directory, "scratch")
+            os.makedirs(scriptDirectory)
+            os.makedirs(scratchDirectory)
+            pythonFiles = [os.path.join(scriptDirectory, name + ".py") for name in ["first", "second"]]
+            for pythonFile in pythonFiles :
+                with open(pythonFile, "w") as f :
+                    f.write("#%%\nprint(" + repr(os.path.basename(pythonFile)) + ")\n")
+            with open(os.path.join(scriptDirectory, "notes.md"), "w") as f :
+                f.write("the user's own notes\n")
+            with StubExecutablesOnPath(os.path.join(directory, "stubs")), contextlib.redirect_stdout(io.StringIO()) :
+                results = spp.ReportGeneratorFromPythonFileWithCells.WriteReportsInParallel(pythonFiles, maxWorkers=2, extension="html", intermediateDirectory=scratchDirectory)
+            assert [result.succeeded for result in results] == [True, True], [result.error for result in results]
+            assert sorted(os.listdir(scriptDirectory)) == ["first.html", "first.py", "notes.md", "second.html", "second.py"]
+            for pythonFile in pythonFiles :
+                with open(pythonFile.replace(".py", ".html")) as f :
+                    assert os.path.basename(pythonFile) in f.read() # each report is made from its own script
+            assert os.listdir(scratchDirectory) == []
+
+    def testCleanDirectoryScopeSkipsExcludedDirectoriesAndRemovesNewTrees(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            os.makedirs(os.path.join(directory, ".git"))
+            with spp.CleanDirectoryScope(directory, excludedDirectories=[".git"]) :
+                os.makedirs(os.path.join(directory, "new", "deeper"))
+                for file in [os.path.join(".git", "index"), os.path.join("new", "deeper", "a.png")] :
+                    with open(os.path.join(directory, file), "w") :
+                        pass
+            assert os.listdir(directory) == [".git"]
+            assert os.listdir(os.path.join(directory, ".git")) == ["index"]
+
+    def testCleanDirectoryScopeOnlyTrackingNewlyModifiedFiles(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            os.makedirs(os.path.join(directory, "untouched"))
+            with spp.CleanDirectoryScope(directory, onlyTrackNewlyModifiedFiles=True) :
+                for file in ["new.md", "copied.bib"] :
+                    with open(os.path.join(directory, file), "w") :
+                        pass
+                os.utime(os.path.join(directory, "copied.bib"), (0, 0)) # like a copy that keeps its timestamp
+            assert sorted(os.listdir(directory)) == ["copied.bib", "untouched"]
+
+    def testCleanDirectoryScopeRescansFoldersModifiedInTheSameTimestampTick(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            folder = os.path.join(directory, "figures")
+            os.makedirs(folder)
+            with spp.CleanDirectoryScope(directory, onlyTrackNewlyModifiedFiles=True) :
+                folderModified = os.stat(folder).st_mtime_ns
+                with open(os.path.join(folder, "new.png"), "w") :
+                    pass
+                os.utime(folder, ns=(folderModified, folderModified)) # like a file system that keeps 2 second timestamps
+            assert os.listdir(folder) == []
+
+    def testCaptureScriptToMarkdown(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "script.py")
+            with open(pythonFile, "w") as f :
+                f.write("import sympy as sy\n"
+                        "import sympyPaperPrinter as spp\n"
+                        "spp.printMarkdown('# Title')\n"
+                        "spp.showEquation('x', sy.Symbol('y')**2)\n"
+                        "spp.silent = True\n"
+                        "spp.printMarkdown('hidden')\n"
+                        "spp.silent = False\n"
+                        "spp.ReportGeneratorFromPythonFileWithCells.WriteDirectlyToDesiredFormatWithPandoc(__file__)\n")
+            orgSilent = spp.silent
+            try :
+                spp.silent = False
+                mdFile = spp.ReportGeneratorFromPythonFileWithCells.CaptureScriptToMarkdown(pythonFile)
+            finally :
+                spp.silent = orgSilent
+            with open(mdFile, "r") as f :
+                markdown = f.read()
+            assert markdown == "# Title\n\n$$x = y^{2}$$\n"
+            assert spp.documentCapture == None
+
+    @unittest.skipIf(os.name == "nt", "the stub executables are POSIX scripts")
+    def testBenchmarkSuiteBuildsReportsWithStubsAndFlagsRegressions(self) :
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "benchmarks"))
+        import benchmarkSuite
+        results = benchmarkSuite.benchmarkReports({"cells" : [2]}, 1)
+        assert sorted(results) == ["report capture cells=2", "report notebook cells=2"]
+        baseline = {"results" : {"fast" : 1.0, "slow" : 1.0}}
+        with contextlib.redirect_stdout(io.StringIO()) :
+            regressions = benchmarkSuite.compareToBaseline({"results" : {"fast" : 1.2, "slow" : 2.0, "new" : 1.0}}, baseline, 1.5)
+        assert regressions == ["slow"]
+
+    @unittest.skipIf(os.name == "nt", "the stub pandoc is a POSIX script")
+    def testRunPandocForFormatsReportsEachFailedFormat(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            logFile = os.path.join(directory, "commands.log")
+            mdFile = os.path.join(directory, "report.md")
+            with open(mdFile, "w") as f :
+                f.write("# Title\n")
+            outputFiles = spp.ReportGeneratorFromPythonFileWithCells.GetOutputFilePaths(os.path.join(directory, "report.py"), None, ["pdf", "html", "docx"])
+            with StubExecutablesOnPath(directory, logFile=logFile, failingFormats=["docx"]) :
+                with contextlib.redirect_stdout(io.StringIO()) :
+                    with self.assertRaises(Exception) as raised :
+                        spp.ReportGeneratorFromPythonFileWithCells.RunPandocForFormats(mdFile, outputFiles, directory, None, None)
+            assert "1 of 3" in str(raised.exception) and "report.docx: File was not created sucessfully: no docx here" in str(raised.exception)
+            assert os.path.isfile(outputFiles[0]) and os.path.isfile(outputFiles[1])
+            with open(logFile) as f :
+                assert "--citeproc" not in f.read() # there is no bibliography
+
+    @unittest.skipIf(os.name == "nt", "the stub pandoc is a POSIX script")
+    def testRunPandocForFormatsDoesNotOverwriteTheMarkdownItReads(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            mdFile = os.path.join(directory, "report.md")
+            with open(mdFile, "w") as f :
+                f.write("# Title\n")
+            outputFiles = spp.ReportGeneratorFromPythonFileWithCells.GetOutputFilePaths(os.path.join(directory, "report.py"), None, ["md", "html"])
+            assert outputFiles[0] == mdFile
+            # the html is only made once the md has been, so it would read the md report if that had replaced the markdown
+            with StubExecutablesOnPath(os.path.join(directory, "stubs"), slowFormats=["html"], sleepSeconds=0.5), contextlib.redirect_stdout(io.StringIO()) :
+                spp.ReportGeneratorFromPythonFileWithCells.RunPandocForFormats(mdFile, outputFiles, directory, None, None)
+            assert sorted(os.listdir(directory)) == ["report.html", "report.md", "stubs"]
+            for (outputFile, extension) in zip(outputFiles, ["md", "html"]) :
+                with open(outputFile) as f :
+                    assert f.read() == "<!-- " + extension + " -->\n# Title\n"
+
+    @unittest.skipIf(os.name == "nt", "the stub executables are POSIX scripts")
+    def testAsyncReportGeneratorStreamsOutputAndKillsStagesThatRunOver(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            stubs = StubExecutablesOnPath(directory, slowNotebooks=["slow"], childPidFile=os.path.join(directory, "child.pid"))
+            scriptDirectory = os.path.join(directory, "scripts")
+            os.makedirs(scriptDirectory)
+            for name in ["fast.py", "slow.py"] :
+                with open(os.path.join(scriptDirectory, name), "w") as f :
+                    f.write("#%%\nprint(1)\n")
+            scratchDirectory = os.path.join(directory, "scratch")
+            os.makedirs(scratchDirectory)
+
+            lines = []
+            generator = spp.AsyncReportGenerator(stageTimeouts={"execute" : 1.0}, outputCallback=lambda script, stage, line : lines.append((os.path.basename(script), stage, line.strip())))
+            previousTemporaryDirectory = tempfile.tempdir
+            tempfile.tempdir = scratchDirectory
+            try :
+                with stubs :
+                    results = asyncio.run(generator.writeReports([os.path.join(scriptDirectory, "fast.py"), os.path.join(scriptDirectory, "slow.py")], extension=["html", "md"]))
+            finally :
+                tempfile.tempdir = previousTemporaryDirectory
+            assert results[0].succeeded and not results[1].succeeded
+            assert "took longer than 1.0 seconds" in results[1].error
+            assert sorted(os.listdir(scriptDirectory)) == ["fast.html", "fast.md", "fast.py", "slow.py"]
+            assert ("fast.py", "execute", "executing fast.ipynb") in lines
+            assert os.listdir(scratchDirectory) == []
+            with open(os.path.join(directory, "child.pid")) as f :
+                childPid = int(f.read())
+            for i in range(50) : # the kernel-like child of the killed command goes too (once it has been reaped)
+                try :
+                    os.kill(childPid, 0)
+                except ProcessLookupError :
+                    break
+                time.sleep(0.1)
+            else :
+                self.fail("the child of the command that ran over is still running")
+
+    @unittest.skipIf(os.name == "nt", "the stub executables are POSIX scripts")
+    def testAsyncReportGeneratorStopsTheOtherFormatsWhenOneFails(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            logFile = os.path.join(directory, "commands.log")
+            pythonFile = os.path.join(directory, "report.py")
+            with open(pythonFile, "w") as f :
+                f.write("#%%\nprint(1)\n")
+            generator = spp.AsyncReportGenerator()
+
+            async def writeReport() :
+                start = time.perf_counter()
+                with self.assertRaises(Exception) as raised :
+                    await generator.writeReport(pythonFile, extension=["docx", "html"])
+                assert time.perf_counter() - start < 30 # the html wasn't waited for
+                with open(logFile) as f :
+                    (htmlPid,) = [int(line.split()[1]) for line in f if line.startswith("pandoc") and "report.html" in line]
+                with self.assertRaises(ProcessLookupError) : # killed (and reaped) before writeReport returned
+                    os.kill(htmlPid, 0)
+                return raised.exception
+
+            with StubExecutablesOnPath(directory, logFile=logFile, failingFormats=["docx"], failAfterSeconds=1.0, slowFormats=["html"]) :
+                error = asyncio.run(writeReport())
+            assert "no docx here" in str(error)
+            assert sorted(os.listdir(directory)) == ["bin", "commands.log", "report.py"]
+
+    def testAsyncReportGeneratorHandlesOutputLinesLongerThanTheStreamLimit(self) :
+        lines = []
+        generator = spp.AsyncReportGenerator(outputCallback=lambda pythonFilePath, stage, line : lines.append(line))
+        command = [sys.executable, "-c", "import sys\nsys.stderr.write('x' * 100000 + '\\nlast')"]
+        with tempfile.TemporaryDirectory() as directory :
+            result = asyncio.run(generator.runCommand(command, directory, "report.py", "execute"))
+        assert result.returncode == 0
+        assert lines == ["x" * 100000 + "\n", "last"]
+
+    @unittest.skipIf(os.name == "nt" or shutil.which("jupyter") == None or importlib.util.find_spec("matplotlib") == None, "the stub pandoc is a POSIX script, or jupyter or matplotlib isn't installed")
+    def testAsyncReportGeneratorKeepsTheFiguresTheReportLinksTo(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            stubs = StubExecutablesOnPath(os.path.join(directory, "stubs"))
+            os.remove(os.path.join(stubs.binDirectory, "jupyter")) # the notebook is really executed, for its figure
+            pythonFile = os.path.join(directory, "plot.py")
+            with open(pythonFile, "w") as f :
+                f.write("#%%\nimport matplotlib.pyplot as plt\nplt.plot([1, 2, 3], [1, 4, 9])\nplt.show()\n")
+            with stubs :
+                (mdFile,) = asyncio.run(spp.AsyncReportGenerator().writeReport(pythonFile, extension="md"))
+            with open(mdFile, "r") as f :
+                links = re.findall(r"!\[[^\]]*\]\(([^)]+)\)", f.read())
+            assert len(links) == 1 and links[0].startswith(".sppcache/plot/figures/")
+            assert os.path.isfile(os.path.join(directory, links[0]))
+
+    @unittest.skipIf(os.name == "nt", "the stub executables are POSIX scripts")
+    def testReportWatcherOnlyRunsPandocWhenJustTheBibliographyChanged(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            logFile = os.path.join(directory, "commands.log")
+            scriptDirectory = os.path.join(directory, "scripts")
+            os.makedirs(scriptDirectory)
+            pythonFile = os.path.join(scriptDirectory, "report.py")
+            with open(pythonFile, "w") as f :
+                f.write("#%%\nprint(1)\n")
+            with open(os.path.join(scriptDirectory, "sources.bib"), "w") as f :
+                f.write("@misc{a}\n")
+
+            watcher = spp.ReportWatcher(pythonFile, extension="html", pollSeconds=0.01, debounceSeconds=0.05, useWarmKernels=False)
+            with StubExecutablesOnPath(directory, logFile=logFile), contextlib.redirect_stdout(io.StringIO()) :
+                watcher.rebuild({"script"})
+                with open(os.path.join(scriptDirectory, "sources.bib"), "w") as f :
+                    f.write("@misc{a}\n@misc{b}\n")
+                changed = watcher.waitForChanges()
+                watcher.rebuild(changed)
+            assert changed == {"sources"}
+            with open(logFile) as f :
+                commands = [line.split()[0] for line in f]
+            assert commands.count("pandoc") == 2 and commands[-2:] == ["pandoc", "pandoc"]
+            assert os.path.isfile(os.path.join(scriptDirectory, "report.html"))
+
+    @unittest.skipIf(importlib.util.find_spec("matplotlib") == None, "matplotlib isn't installed")
+    def testCapturedFiguresAreNamedByContentAndNotRewritten(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "plots.py")
+            with open(pythonFile, "w") as f :
+                f.write("import matplotlib.pyplot as plt\n"
+                        "plt.plot([1, 2, 3], [1, 4, 9])\n"
+                        "plt.show()\n")
+            figureDirectory = spp.ReportGeneratorFromPythonFileWithCells.GetFigureDirectory(pythonFile)
+            for figureFormat in ["png", "pdf", "svg"] :
+                mdFile = spp.ReportGeneratorFromPythonFileWithCells.CaptureScriptToMarkdown(pythonFile, None, figureFormat)
+                (figureName,) = os.listdir(figureDirectory) # figures of the other formats were collected
+                assert figureName.endswith("." + figureFormat)
+                with open(mdFile, "r") as f :
+                    assert f.read() == "![](.sppcache/plots/figures/" + figureName + ")\n"
+                figureFile = os.path.join(figureDirectory, figureName)
+                os.utime(figureFile, (0, 0))
+                spp.ReportGeneratorFromPythonFileWithCells.CaptureScriptToMarkdown(pythonFile, None, figureFormat)
+                assert os.listdir(figureDirectory) == [figureName] # the same content makes the same file
+                assert os.path.getmtime(figureFile) == 0 # which wasn't written again
+
+    def testMoveFiguresToCacheRewritesMarkdownLinks(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "report.py")
+            scratchDirectory = os.path.join(directory, "scratch")
+            os.makedirs(os.path.join(scratchDirectory, "report_files"))
+            for (name, data) in [("output_1_0.png", b"first"), ("output_2_0.png", b"first"), ("output_3_0.png", b"second")] :
+                with open(os.path.join(scratchDirectory, "report_files", name), "wb") as f :
+                    f.write(data)
+            mdFile = os.path.join(scratchDirectory, "report.md")
+            with open(mdFile, "w") as f :
+                f.write("![png](report_files/output_1_0.png)\n\n![png](report_files/output_2_0.png)\n\n![png](report_files/output_3_0.png)\n\n![](https://example.com/logo.png)\n")
+            figureFiles = spp.ReportGeneratorFromPythonFileWithCells.MoveFiguresToCache(mdFile, pythonFile)
+            assert len(set(figureFiles)) == 2 and os.listdir(os.path.join(scratchDirectory, "report_files")) == []
+            with open(mdFile, "r") as f :
+                links = f.read().split("\n\n")
+            assert links[0] == links[1] and links[0] != links[2] and links[0].startswith("![png](.sppcache/report/figures/")
+            assert links[3] == "![](https://example.com/logo.png)\n"
+
+            with open(os.path.join(os.path.dirname(figureFiles[0]), "old.png"), "wb") as f :
+                f.write(b"old")
+            spp.ReportGeneratorFromPythonFileWithCells.CollectUnusedFigures(os.path.dirname(figureFiles[0]), figureFiles)
+            assert sorted(os.listdir(os.path.dirname(figureFiles[0]))) == sorted(set(os.path.basename(f) for f in figureFiles))
+
+    def testNotebookFiguresAreVectorForPdfOutputs(self) :
+        generator = spp.ReportGeneratorFromPythonFileWithCells
+        assert generator.GetFigureFormat(["report.pdf", "report.tex"]) == "pdf"
+        assert generator.GetFigureFormat(["report.pdf", "report.html"]) == "png"
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "report.py")
+            with open(pythonFile, "w") as f :
+                f.write("#%%\nx = 1\n")
+            ipynbFile = generator.ConvertPythonToJupyter(pythonFile)
+            generator._SetFigureFormatInFirstCell(ipynbFile, "pdf")
+            with open(ipynbFile, "r") as f :
+                firstCell = json.load(f)["cells"][0]
+            assert firstCell["metadata"]["sppInternal"] and "InlineBackend.figure_formats" in firstCell["source"]
+
+            os.makedirs(os.path.join(directory, "report_files"))
+            for (name, data) in [("output_1_0.png", b"raster"), ("output_1_0.pdf", b"vector")] :
+                with open(os.path.join(directory, "report_files", name), "wb") as f :
+                    f.write(data)
+            mdFile = os.path.join(directory, "report.md")
+            with open(mdFile, "w") as f :
+                f.write("![png](report_files/output_1_0.png)\n")
+            (figureFile,) = generator.MoveFiguresToCache(mdFile, pythonFile, "pdf")
+            assert figureFile.endswith(".pdf") and os.listdir(os.path.join(directory, "report_files")) == []
+            with open(figureFile, "rb") as f :
+                assert f.read() == b"vector"
+            with open(mdFile, "r") as f :
+                assert f.read().strip().endswith(".pdf)")
+
+    def testMoveFiguresToCacheLeavesTheUsersImagesAlone(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "report.py")
+            os.makedirs(os.path.join(directory, "report_files"))
+            os.makedirs(os.path.join(directory, "images"))
+            for name in ["diagram.png", os.path.join("images", "photo.png"), os.path.join("report_files", "output_1_0.png")] :
+                with open(os.path.join(directory, name), "wb") as f :
+                    f.write(name.encode("utf-8"))
+            mdFile = os.path.join(directory, "report.md") # no intermediate folder, so the markdown is next to the script
+            userLinks = "![Setup](diagram.png)\n\n![Photo](images/photo.png)\n\n![Up](report_files/../diagram.png)\n\n"
+            with open(mdFile, "w") as f :
+                f.write(userLinks + "![png](report_files/output_1_0.png)\n")
+            figureFiles = spp.ReportGeneratorFromPythonFileWithCells.MoveFiguresToCache(mdFile, pythonFile)
+            spp.ReportGeneratorFromPythonFileWithCells.CollectUnusedFigures(os.path.dirname(figureFiles[0]), figureFiles)
+            assert len(figureFiles) == 1
+            with open(mdFile, "r") as f :
+                markdown = f.read()
+            assert markdown.startswith(userLinks) and "report_files" not in markdown[len(userLinks):]
+            assert os.path.isfile(os.path.join(directory, "diagram.png")) and os.path.isfile(os.path.join(directory, "images", "photo.png"))
+
+    @unittest.skipIf(shutil.which("jupyter") == None or importlib.util.find_spec("nbconvert") == None, "jupyter nbconvert isn't installed")
+    def testIncrementalExecutionResumesAfterAnEditWithUnderscoreVariables(self) :
+        with tempfile.TemporaryDirectory() as directory :
+            pythonFile = os.path.join(directory, "report.py")
+            ipynbFile = os.path.join(directory, "report.ipynb")
+            cacheDirectory = os.path.join(directory, ".sppcache", "report")
+            firstCell = "#%%\nopen('runs.txt', 'a').write('first cell ran\\n')\ntotal = 2\n_scale = 3\n"
+
+            def build(secondCell) :
+                with open(pythonFile, "w") as f :
+                    f.write(firstCell + "#%%\n" + secondCell)
+                spp.ReportGeneratorFromPythonFileWithCells.ConvertPythonToJupyter(pythonFile, ipynbFile=ipynbFile)
+                spp.ReportGeneratorFromPythonFileWithCells.ExecuteNotebookIncrementally(ipynbFile, cacheDirectory, directory)
+                with open(ipynbFile, "r") as f :
+                    outputs = json.load(f)["cells"][1]["outputs"]
+                return "".join("".join(output.get("text", "")) for output in outputs)
+
+            assert build("print(total * _scale)\n") == "6\n"
+            assert build("print(total * _scale + 1)\n") == "7\n"
+            with open(os.path.join(directory, "runs.txt")) as f :
+                assert f.read() == "first cell ran\n" # the edit resumed from the snapshot after the first cell